@@ -0,0 +1,99 @@
+"""
+Benchmark of the downscaled Cellpose inference: speed versus agreement with the masks produced at full resolution.
+Without `--real-cellpose`, the stub returns the ground truth resized to the input, so only the cost and the accuracy of the labels upscaling are measured.
+
+Usage:
+    python benchmarks/bench_downscale.py --sizes 1024 2048 --scales 1.0 0.5 0.33 0.25
+"""
+
+import sys, os, json, argparse, platform
+from datetime import datetime
+import numpy as np
+
+from bench_pipeline import measure, git_revision, _results_dir
+
+
+def bench_scales(size, scales, repeat, density, stub, pipeline, verbose=False):
+    """
+    Segments a synthetic field of `size`x`size` pixels at each scale, and compares the labels to the full resolution ones.
+    """
+    from spots_in_yeasts.syntheticData import make_yeasts_field
+    from spots_in_yeasts.backendsAgreement import label_agreement
+
+    field = make_yeasts_field((size, size), density=density, cell_radius=18*size/512, n_slices=1, nuclei=False, seed=size)
+    bf    = field['hyperstack'][1]
+    if stub is not None:
+        stub.masks = field['labeled_cells'].astype(np.int32)
+
+    records   = []
+    reference = None
+    print(f"Field {size}x{size}: {field['labeled_cells'].max()} cells.")
+
+    for scale in sorted(scales, reverse=True):
+        for refine in ((True, False) if scale < 1.0 else (True,)):
+            def segment(image):
+                if refine:
+                    return pipeline.segment_yeasts_cells(image, False, None, scale)
+                # Same inference, but the labels are only upscaled with a nearest neighbour interpolation.
+                small = pipeline.resize(image.astype(np.float32), tuple(int(round(s * scale)) for s in image.shape), order=1, anti_aliasing=True, preserve_range=True)
+                return pipeline.upscale_labels(pipeline.segment_yeasts_cells(small, False), image.shape, False)
+
+            labels, m = measure(segment, lambda: (bf,), repeat, False, verbose)
+            if reference is None:
+                reference = labels
+            scores = label_agreement(reference, labels)
+            truth  = label_agreement(field['labeled_cells'], labels)
+            m.update({'size': size, 'scale': scale, 'refine': refine, 'f1': scores['f1'], 'mean_iou': scores['mean_iou'], 'mean_iou_truth': truth['mean_iou']})
+            m.pop('peak_mb')
+            records.append(m)
+            print(f"  scale {scale:<5} {'refined' if refine else 'nearest':<8} {m['wall']:8.3f}s  F1 {scores['f1']:.4f}  IoU {scores['mean_iou']:.4f} (truth: {truth['mean_iou']:.4f})")
+
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Speed versus agreement of the downscaled Cellpose inference.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 2048], help="Sides (in pixels) of the synthetic fields.")
+    parser.add_argument('--scales', type=float, nargs='+', default=[1.0, 0.5, 0.33, 0.25], help="Downscaling factors to evaluate.")
+    parser.add_argument('--repeat', type=int, default=1, help="Number of timed runs per scale (best is kept).")
+    parser.add_argument('--density', type=float, default=0.3, help="Fraction of the field covered by cells.")
+    parser.add_argument('--real-cellpose', action='store_true', help="Use the installed Cellpose instead of the stub.")
+    parser.add_argument('--verbose', action='store_true', help="Show what the stages print.")
+    parser.add_argument('--output', default=_results_dir, help="Folder receiving the JSON report.")
+    args = parser.parse_args(argv)
+
+    stub = None
+    if not args.real_cellpose:
+        import cellpose_stub
+        cellpose_stub.install()
+        stub = cellpose_stub
+
+    import spots_in_yeasts
+    from spots_in_yeasts import spotsInYeasts as pipeline
+
+    scales  = sorted(set(args.scales) | {1.0}, reverse=True) # Full resolution is the reference.
+    records = []
+    for size in args.sizes:
+        records += bench_scales(size, scales, args.repeat, args.density, stub, pipeline, args.verbose)
+
+    now    = datetime.now()
+    report = {
+        'benchmark': "downscale",
+        'version'  : spots_in_yeasts.__version__,
+        'revision' : git_revision(),
+        'date'     : now.isoformat(timespec='seconds'),
+        'machine'  : {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'cellpose' : "real" if args.real_cellpose else "stub",
+        'records'  : records
+    }
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"downscale-{report['version']}-{report['revision']}-{now.strftime('%Y-%m-%d-%H-%M-%S')}.json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to: {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
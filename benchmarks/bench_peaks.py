@@ -0,0 +1,104 @@
+"""
+Benchmark of the spots peak finder on the chamfer map, on fields of increasing spots density.
+`find_peaks` is compared to `peak_local_max` (which it replaces), and both must return the same peaks.
+
+Usage:
+    python benchmarks/bench_peaks.py --sizes 1024 2048 --spots 5 15 30
+"""
+
+import sys, os, json, argparse, platform
+from datetime import datetime
+import numpy as np
+
+from bench_pipeline import measure, git_revision, _results_dir
+
+
+def chamfer_map(stack, sigma=3.0):
+    """
+    Chamfer map of the spots mask, built as `segment_spots` does.
+    """
+    from scipy.ndimage import median_filter, gaussian_laplace, distance_transform_cdt
+    from skimage.filters import threshold_isodata
+
+    image = median_filter(np.max(stack, axis=0), size=3).astype(np.float64)
+    LoG   = gaussian_laplace(image, sigma=sigma)
+    mask  = LoG < threshold_isodata(LoG)
+    return distance_transform_cdt(mask.astype(np.float64))
+
+
+def bench_density(size, n_spots, repeat, peak_d, threshold_rel, pipeline):
+    """
+    Times both peak finders (and the filtering of the peaks outside cells) on a synthetic field with `n_spots` spots per cell.
+    """
+    from skimage.feature import peak_local_max
+    from spots_in_yeasts.syntheticData import make_yeasts_field
+
+    field   = make_yeasts_field((size, size), density=0.6, spots_per_cell=(n_spots, n_spots), seed=size)
+    cells   = field['labeled_cells']
+    chamfer = chamfer_map(field['hyperstack'][:, 0])
+
+    def before(image):
+        maximas = peak_local_max(image, min_distance=peak_d, threshold_rel=threshold_rel)
+        return np.array([m for m in maximas if cells[m[0], m[1]] > 0])
+
+    def after(image):
+        maximas = pipeline.find_peaks(image, peak_d, threshold_rel)
+        return maximas[cells[maximas[:, 0], maximas[:, 1]] > 0]
+
+    reference, m_ref = measure(before, lambda: (chamfer,), repeat, False)
+    peaks, m_new     = measure(after, lambda: (chamfer,), repeat, False)
+    identical = bool(np.array_equal(reference.reshape(-1, 2), peaks))
+
+    record = {
+        'size'      : size,
+        'spots'     : n_spots,
+        'peaks'     : int(len(peaks)),
+        'mask'      : round(float(np.mean(chamfer > 0)), 4),
+        'reference' : m_ref['wall'],
+        'wall'      : m_new['wall'],
+        'cpu'       : m_new['cpu'],
+        'identical' : identical
+    }
+    print(f"  {n_spots:>3} spots/cell  {record['peaks']:>6} peaks  peak_local_max {m_ref['wall']:7.3f}s  find_peaks {m_new['wall']:7.3f}s  x{m_ref['wall'] / m_new['wall']:.1f}{'' if identical else '  DIFFERENT'}")
+    return record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Speed of the spots peak finder on dense fields.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 2048], help="Sides (in pixels) of the synthetic fields.")
+    parser.add_argument('--spots', type=int, nargs='+', default=[5, 15, 30], help="Numbers of spots per cell to evaluate.")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of timed runs per field (best is kept).")
+    parser.add_argument('--peak-distance', type=int, default=5, help="Minimal distance between two spots.")
+    parser.add_argument('--threshold-rel', type=float, default=0.5, help="Relative threshold of the peaks.")
+    parser.add_argument('--output', default=_results_dir, help="Folder receiving the JSON report.")
+    args = parser.parse_args(argv)
+
+    import spots_in_yeasts
+    from spots_in_yeasts import spotsInYeasts as pipeline
+
+    records = []
+    for size in args.sizes:
+        print(f"Field {size}x{size}:")
+        for n_spots in args.spots:
+            records.append(bench_density(size, n_spots, args.repeat, args.peak_distance, args.threshold_rel, pipeline))
+
+    now    = datetime.now()
+    report = {
+        'benchmark': "peaks",
+        'version'  : spots_in_yeasts.__version__,
+        'revision' : git_revision(),
+        'date'     : now.isoformat(timespec='seconds'),
+        'machine'  : {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'records'  : records
+    }
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"peaks-{report['version']}-{report['revision']}-{now.strftime('%Y-%m-%d-%H-%M-%S')}.json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to: {path}")
+    return 0 if all(r['identical'] for r in records) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
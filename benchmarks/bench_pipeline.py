@@ -0,0 +1,251 @@
+"""
+Benchmark of every stage of the pipeline on synthetic yeast fields of increasing size.
+For each stage, the wall time, the CPU time and the peak of memory allocated (through `tracemalloc`) are recorded.
+Results are stored as JSON files in `benchmarks/results`, so two versions can be compared.
+
+Usage:
+    python benchmarks/bench_pipeline.py run --sizes 256 512 1024
+    python benchmarks/bench_pipeline.py compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+
+import sys, os, io, time, json, tracemalloc, argparse, platform, tempfile, subprocess, contextlib
+from datetime import datetime
+import numpy as np
+
+_here        = os.path.dirname(os.path.abspath(__file__))
+_results_dir = os.path.join(_here, "results")
+
+
+def measure(function, prepare, repeat=1, memory=True, verbose=False):
+    """
+    Times a stage of the pipeline.
+
+    Args:
+        function: The stage to benchmark.
+        prepare: A function producing the arguments of `function`. It is called (untimed) before each run, so in-place stages always get fresh inputs.
+        repeat: Number of timed runs. The best wall time is kept.
+        memory: If True, an extra run is performed under `tracemalloc` to get the peak of memory.
+        verbose: If False, what the stage prints is discarded.
+
+    Returns:
+        The result of the last run, and a dictionary of measures.
+    """
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        return _measure(function, prepare, repeat, memory)
+
+
+def _measure(function, prepare, repeat, memory):
+    walls, cpus = [], []
+    for _ in range(repeat):
+        args  = prepare()
+        w0    = time.perf_counter()
+        c0    = time.process_time()
+        result = function(*args)
+        walls.append(time.perf_counter() - w0)
+        cpus.append(time.process_time() - c0)
+
+    peak = None
+    if memory:
+        args = prepare()
+        tracemalloc.start()
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    best = int(np.argmin(walls))
+    return result, {'wall': walls[best], 'cpu': cpus[best], 'peak_mb': peak}
+
+
+def bench_size(size, repeat, memory, density, stub, pipeline, formats, verbose=False):
+    """
+    Runs every stage of the pipeline on a synthetic field of `size`x`size` pixels.
+    """
+    from spots_in_yeasts.syntheticData import make_yeasts_field
+    from skimage.segmentation import clear_border
+
+    field   = make_yeasts_field((size, size), density=density, seed=size)
+    stack   = field['hyperstack']
+    f_spots = stack[:, 0]
+    bf      = stack[:, 1]
+    nuclei  = stack[:, 2]
+    records = []
+
+    if stub is not None:
+        stub.masks = field['labeled_cells'].astype(np.int32)
+
+    def record(stage, function, prepare):
+        result, m = measure(function, prepare, repeat, memory, verbose)
+        m.update({'stage': stage, 'size': size})
+        records.append(m)
+        peak = "" if m['peak_mb'] is None else f", peak {m['peak_mb']:.1f} MB"
+        print(f"  {stage:<24} {m['wall']:8.3f}s (cpu {m['cpu']:.3f}s{peak})")
+        return result
+
+    print(f"Field {size}x{size}: {field['labeled_cells'].max()} cells, {len(field['spots'])} spots.")
+
+    record("find_focused_slice", pipeline.find_focused_slice, lambda: (bf, 2))
+    labeled, projection = record("segment_transmission", pipeline.segment_transmission, lambda: (bf, False, 2))
+    flattened, lbl_nuclei = record("nuclei_from_fluo", pipeline.nuclei_from_fluo, lambda: (nuclei,))
+    graph = record("adjacency_graph", pipeline.adjacency_graph, lambda: (labeled,))
+
+    assigned = record(
+        "assign_nucleus",
+        pipeline.assign_nucleus,
+        lambda: (np.copy(labeled), np.copy(lbl_nuclei), 0.75, graph)
+    )
+    labeled_cells, labeled_nuclei, _, cell_to_nuclei, nucleus_to_cells = assigned
+
+    def partition(g, c2n, n2c, cells, nucl):
+        pipeline.YeastsPartitionGraph(g, c2n, n2c, cells, nucl)
+        return cells, nucl
+
+    labeled_cells, labeled_nuclei = record(
+        "YeastsPartitionGraph",
+        partition,
+        lambda: (graph, cell_to_nuclei, nucleus_to_cells, np.copy(labeled_cells), np.copy(labeled_nuclei))
+    )
+    labeled_cells = clear_border(labeled_cells)
+
+    locations, labeled_spots, flat_spots = record(
+        "segment_spots",
+        pipeline.segment_spots,
+        lambda: (f_spots, np.copy(labeled_cells), 65535, 3.0, 5, 0.5)
+    )
+
+    record(
+        "segment_spots_3d",
+        pipeline.segment_spots_3d,
+        lambda: (f_spots, np.copy(labeled_cells), 65535, 3.0, 5, 0.5, 2)
+    )
+
+    record(
+        "segment_spots_multiscale",
+        pipeline.segment_spots_multiscale,
+        lambda: (f_spots, np.copy(labeled_cells), 65535, (1.0, 1.5, 2.0, 3.0, 4.0), 5, 0.5)
+    )
+
+    categories = record(
+        "distance_spot_nuclei",
+        pipeline.distance_spot_nuclei,
+        lambda: (labeled_cells, labeled_nuclei, labeled_spots)
+    )
+
+    record(
+        "spots_distances",
+        pipeline.spots_distances,
+        lambda: (labeled_cells, labeled_nuclei, labeled_spots, locations)
+    )
+
+    ownership, locations, labeled_spots = record(
+        "associate_spots_yeasts",
+        pipeline.associate_spots_yeasts,
+        lambda: (labeled_cells, np.copy(labeled_spots), flat_spots, 15, 90, 0.6, 0.6, categories)
+    )
+
+    record(
+        "refine_ownership",
+        pipeline.refine_ownership,
+        lambda: (ownership, flat_spots, 3)
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        def export(directory):
+            table = formats.format_data_1844(ownership, "synthetic")
+            table.exportTo(os.path.join(directory, "results.csv"))
+            indices = pipeline.write_labels_image(labeled_cells, 0.75)
+            pipeline.create_reference_to(labeled_cells, labeled_spots, locations, "synthetic", directory, "synthetic", projection, flat_spots, indices, labeled_nuclei, flattened, None)
+
+        record("export", export, lambda: (tmp,))
+
+    return records
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=_here, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def run(args):
+    stub = None
+    if not args.real_cellpose:
+        import cellpose_stub
+        cellpose_stub.install()
+        stub = cellpose_stub
+
+    import spots_in_yeasts
+    from spots_in_yeasts import spotsInYeasts as pipeline
+    from spots_in_yeasts import formatData as formats
+    from spots_in_yeasts.threadsScheduler import configure_threads, default_plan
+
+    if args.cores is not None:
+        configure_threads(default_plan(args.cores, 0))
+
+    records = []
+    for size in args.sizes:
+        records += bench_size(size, args.repeat, not args.no_memory, args.density, stub, pipeline, formats, args.verbose)
+
+    now    = datetime.now()
+    report = {
+        'version' : spots_in_yeasts.__version__,
+        'revision': git_revision(),
+        'date'    : now.isoformat(timespec='seconds'),
+        'machine' : {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'cellpose': "real" if args.real_cellpose else "stub",
+        'cores'   : args.cores,
+        'records' : records
+    }
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"{report['version']}-{report['revision']}-{now.strftime('%Y-%m-%d-%H-%M-%S')}.json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to: {path}")
+    return 0
+
+
+def compare(args):
+    with open(args.reference) as f:
+        reference = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    ref = {(r['stage'], r['size']): r for r in reference['records']}
+    print(f"{'stage':<24} {'size':>6} {'ref (s)':>9} {'new (s)':>9} {'speedup':>8} {'mem ratio':>9}")
+    for r in candidate['records']:
+        key = (r['stage'], r['size'])
+        if key not in ref:
+            continue
+        old     = ref[key]
+        speedup = old['wall'] / r['wall'] if r['wall'] > 0 else float('inf')
+        memory  = (r['peak_mb'] / old['peak_mb']) if (r['peak_mb'] and old['peak_mb']) else float('nan')
+        print(f"{r['stage']:<24} {r['size']:>6} {old['wall']:>9.3f} {r['wall']:>9.3f} {speedup:>7.2f}x {memory:>9.2f}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the Spots in yeasts pipeline on synthetic data.")
+    sub    = parser.add_subparsers(dest='command', required=True)
+
+    r = sub.add_parser('run', help="Benchmark every stage of the pipeline.")
+    r.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024], help="Sides (in pixels) of the synthetic fields.")
+    r.add_argument('--repeat', type=int, default=1, help="Number of timed runs per stage (best is kept).")
+    r.add_argument('--density', type=float, default=0.3, help="Fraction of the field covered by cells.")
+    r.add_argument('--no-memory', action='store_true', help="Skip the memory profiling run.")
+    r.add_argument('--real-cellpose', action='store_true', help="Use the installed Cellpose instead of the stub.")
+    r.add_argument('--verbose', action='store_true', help="Show what the stages print.")
+    r.add_argument('--cores', type=int, default=None, help="Limit the threads of the stages to this number of cores (0: all of them). Libraries' defaults are kept if omitted.")
+    r.add_argument('--output', default=_results_dir, help="Folder receiving the JSON report.")
+
+    c = sub.add_parser('compare', help="Compare two JSON reports.")
+    c.add_argument('reference')
+    c.add_argument('candidate')
+
+    args = parser.parse_args(argv)
+    return run(args) if (args.command == 'run') else compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
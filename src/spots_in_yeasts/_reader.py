@@ -1,7 +1,13 @@
 import numpy as np
 import napari
-from tifffile import imread
-import os
+import dask.array as da
+from dask import delayed
+from tifffile import imread, TiffFile
+from spots_in_yeasts.pyramids import needs_pyramid, build_pyramid, write_levels, cached_levels, pyramid_shapes
+import os, json, threading
+
+# Prevents two levels of the same image from building its pyramid at the same time.
+_build_lock = threading.Lock()
 
 def napari_get_reader(path):
     p = path if isinstance(path, str) else path[0]
@@ -13,6 +19,94 @@ def napari_get_reader(path):
     return reader_function
 
 
+def lazy_imread(path, description=None):
+    """
+    Opens a TIFF as a dask array. Pixels are only read (and decompressed) when the array is computed, which napari does when the layer is displayed.
+
+    Args:
+        path: Path of the TIFF file.
+        description: Dictionary with the 'shape' and 'dtype' of the image (from the control's index). If None, they are read from the TIFF's header, without decoding pixels.
+
+    Returns:
+        A dask array with a single chunk.
+    """
+    if description is None:
+        with TiffFile(path) as tif:
+            serie = tif.series[0]
+            description = {'shape': serie.shape, 'dtype': str(serie.dtype)}
+    
+    return da.from_delayed(
+        delayed(imread)(path),
+        shape=tuple(description['shape']),
+        dtype=np.dtype(description['dtype'])
+    )
+
+
+def read_level(path, level, labels=False):
+    """
+    Reads a level of the pyramid of an image from the cache of its control folder.
+    If the cache is missing, every level is built and cached by the first read.
+    """
+    with _build_lock:
+        paths = cached_levels(path)
+        if len(paths) < level:
+            print(f"Building the pyramid of `{os.path.basename(path)}`...")
+            levels = build_pyramid(imread(path), labels)
+            try:
+                write_levels(path, levels)
+            except OSError: # Read-only control folder: levels are rebuilt when read.
+                return levels[level]
+            paths = cached_levels(path)
+    return imread(paths[level-1])
+
+
+def lazy_pyramid(path, description=None, labels=False):
+    """
+    Opens a TIFF as a list of dask arrays (one per level of its pyramid) if it is large, as a single dask array otherwise.
+    Levels are read from the cache of the control folder (whatever the threshold used by the batch that wrote them).
+    If they are missing (controls from older versions), nothing is read when the control is opened: they are built and cached the first time one of them is displayed, so hidden layers are never read.
+
+    Args:
+        path: Path of the TIFF file.
+        description: Description of the image from the control's index (see `lazy_imread`).
+        labels: Whether the image contains labels.
+    """
+    full = lazy_imread(path, description)
+    if len(cached_levels(path)) == 0:
+        if not needs_pyramid(full.shape):
+            return full
+        return [full] + [
+            da.from_delayed(delayed(read_level)(path, i, labels), shape=shape, dtype=full.dtype)
+            for i, shape in enumerate(pyramid_shapes(full.shape)[1:], 1)
+        ]
+
+    shapes = description.get('levels') if (description is not None) else None
+    levels = [full]
+    for i, p in enumerate(cached_levels(path), 1):
+        level_desc = {'shape': shapes[i], 'dtype': description['dtype']} if (shapes is not None) and (i < len(shapes)) else None
+        levels.append(lazy_imread(p, level_desc))
+    return levels
+
+
+def layer_data(path, description, args, labels=False):
+    """
+    Data of a layer read from a control folder, and its arguments completed with the `multiscale` flag.
+    """
+    data = lazy_pyramid(path, description, labels)
+    args['multiscale'] = isinstance(data, list)
+    return data, args
+
+
+def image_layer_args(args, description):
+    """
+    Adds the contrast limits to an image layer's arguments if they are known. Otherwise, napari would read the whole image to compute them.
+    """
+    if (description is not None) and ('range' in description):
+        low, high = description['range']
+        args['contrast_limits'] = [low, high if (high > low) else low + 1]
+    return args
+
+
 def reader_function(paths):
     # Check that we have the path of a folder.    
     path = paths if isinstance(paths, str) else paths[0]
@@ -44,6 +138,11 @@ def reader_function(paths):
     print(f"Loaded control for:       {properties['name']}")
     print(f"Original images location: {properties['sources']}")
     print(f"Process performed on:     {properties['time']}")
+    if 'diameter' in properties:
+        print(f"Cells diameter (pxl):     {properties['diameter']}")
+
+    # Shape, dtype and range of each image (absent from controls produced by older versions).
+    layers = json.loads(properties['layers']) if ('layers' in properties) else {}
 
     control_paths = {
         'spots_list'      : os.path.join(path, properties['name']+".csv"),
@@ -73,74 +172,62 @@ def reader_function(paths):
     # ======================= PROJECTED CELLS =======================
     projected_cells = control_paths.get('projected_cells')
     if projected_cells is not None:
-        components.append((
-            imread(projected_cells), 
-            {
-                'name': "projected-cells"
-            },
-            "image"
-        ))
+        description = layers.get(os.path.basename(projected_cells))
+        data, args = layer_data(projected_cells, description, image_layer_args({
+            'name': "projected-cells"
+        }, description))
+        components.append((data, args, "image"))
 
     # ======================= PROJECTED NUCLEI =======================
     projected_nuclei = control_paths.get('projected_nuclei')
     if projected_nuclei is not None:
-        components.append((
-            imread(projected_nuclei), 
-            {
-                'name': "fluo-nuclei",
-                'blending': 'opaque',
-                'colormap': 'cyan'
-            }, 
-            'image'
-        ))
+        description = layers.get(os.path.basename(projected_nuclei))
+        data, args = layer_data(projected_nuclei, description, image_layer_args({
+            'name': "fluo-nuclei",
+            'blending': 'opaque',
+            'colormap': 'cyan'
+        }, description))
+        components.append((data, args, 'image'))
 
     # ======================= PROJECTED SPOTS =======================
     projected_spots = control_paths.get('projected_spots')
     if projected_spots is not None:
-        components.append((
-            imread(projected_spots), 
-            {
-                'name': "fluo-spots",
-                'blending': 'opaque',
-                'colormap': 'yellow'
-            }, 
-            'image'
-        ))
+        description = layers.get(os.path.basename(projected_spots))
+        data, args = layer_data(projected_spots, description, image_layer_args({
+            'name': "fluo-spots",
+            'blending': 'opaque',
+            'colormap': 'yellow'
+        }, description))
+        components.append((data, args, 'image'))
     
     # ======================= LABELED SPOTS =======================
     labeled_spots = control_paths.get('labeled_spots')
     if labeled_spots is not None:
-        components.append((
-            imread(labeled_spots), 
-            {
-                'name'   : "labeled-spots",
-                'visible': False,
-                'opacity': 1.0
-            }, 
-            "labels"
-        ))
+        description = layers.get(os.path.basename(labeled_spots))
+        data, args = layer_data(labeled_spots, description, {
+            'name'   : "labeled-spots",
+            'visible': False,
+            'opacity': 1.0
+        }, True)
+        components.append((data, args, "labels"))
     
     # ======================= LABELED CELLS =======================
     labeled_cells = control_paths.get('labeled_cells')
     if labeled_cells is not None:
-        components.append((
-            imread(labeled_cells), 
-            {
-                'name': "labeled-cells"
-            }, 
-            "labels"
-        ))
+        description = layers.get(os.path.basename(labeled_cells))
+        data, args = layer_data(labeled_cells, description, {
+            'name': "labeled-cells"
+        }, True)
+        components.append((data, args, "labels"))
     
     # ======================= LABELED NUCLEI =======================
     labeled_nuclei = control_paths.get('labeled_nuclei')
     if labeled_nuclei is not None:
-        components.append((
-            imread(labeled_nuclei), 
-            {
-                'name'   : "labeled-nuclei"
-            }, 
-            "labels"
-        ))
+        description = layers.get(os.path.basename(labeled_nuclei))
+        data, args = layer_data(labeled_nuclei, description, {
+            'name'   : "labeled-nuclei"
+        }, True)
+        components.append((data, args, "labels"))
 
     # ======================= SPOTS COLORS ==========================
     spots_colors = control_paths.get('spots_colors')
@@ -165,17 +252,15 @@ def reader_function(paths):
             "points"
         ))
     
-    # ======================= PROJECTED SPOTS =======================
+    # ======================= CELLS INDICES =======================
     cells_indices = control_paths.get('cells_indices')
     if cells_indices is not None:
-        components.append((
-            imread(cells_indices), 
-            {
-                'name': "cells-indices",
-                'blending': 'additive',
-                'visible': False
-            }, 
-            'image'
-        ))
+        description = layers.get(os.path.basename(cells_indices))
+        data, args = layer_data(cells_indices, description, image_layer_args({
+            'name': "cells-indices",
+            'blending': 'additive',
+            'visible': False
+        }, description if (description is not None) else {'range': [0, 255]}))
+        components.append((data, args, 'image'))
 
     return components
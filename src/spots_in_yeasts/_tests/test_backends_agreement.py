@@ -0,0 +1,40 @@
+import pytest
+import numpy as np
+from spots_in_yeasts.syntheticData import make_yeasts_field
+from spots_in_yeasts.spotsInYeasts import segment_transmission
+from spots_in_yeasts.backendsAgreement import label_agreement
+
+"""
+This file contains tests of the classical cells segmenter and of the metrics used to compare it to Cellpose.
+"""
+
+def test_agreement_identical():
+    field  = make_yeasts_field((128, 128), seed=5)
+    scores = label_agreement(field['labeled_cells'], field['labeled_cells'])
+    assert scores['f1'] == 1.0
+    assert scores['mean_iou'] == 1.0
+    assert scores['jaccard'] == 1.0
+
+def test_agreement_relabeled():
+    labels = make_yeasts_field((128, 128), seed=5)['labeled_cells']
+    permuted = np.zeros(labels.max() + 1, dtype=labels.dtype)
+    permuted[1:] = np.random.default_rng(0).permutation(np.arange(1, labels.max() + 1))
+    scores = label_agreement(labels, permuted[labels])
+    assert scores['matched'] == scores['reference_count']
+
+def test_agreement_empty():
+    labels = make_yeasts_field((128, 128), seed=5)['labeled_cells']
+    scores = label_agreement(labels, np.zeros_like(labels))
+    assert scores['candidate_count'] == 0
+    assert scores['recall'] == 0.0
+
+def test_classical_backend():
+    field = make_yeasts_field((512, 512), seed=1)
+    labeled, _ = segment_transmission(field['hyperstack'][:, 1], False, 2, 'classical')
+    assert labeled.dtype == np.int32
+    assert label_agreement(field['labeled_cells'], labeled)['f1'] > 0.85
+
+def test_unknown_backend():
+    field = make_yeasts_field((64, 64), n_slices=1, nuclei=False)
+    with pytest.raises(ValueError):
+        segment_transmission(field['hyperstack'][1], False, 2, 'unknown')
@@ -0,0 +1,42 @@
+import pytest
+import numpy as np
+from spots_in_yeasts.cancellation import get_token, check_cancelled, Cancelled
+from spots_in_yeasts.spotsInYeasts import adjacency_graph, segment_nuclei, associate_spots_yeasts
+from spots_in_yeasts.syntheticData import make_yeasts_field
+
+@pytest.fixture
+def cancelled():
+    token = get_token()
+    token.cancel()
+    yield token
+    token.reset()
+
+def test_token():
+    token = get_token()
+    check_cancelled()
+    token.cancel()
+    assert token.cancelled
+    with pytest.raises(Cancelled):
+        check_cancelled()
+    token.reset()
+    check_cancelled()
+
+@pytest.mark.parametrize("stage", ["graph", "nuclei", "spots"])
+def test_stages_cancelled(cancelled, stage):
+    field = make_yeasts_field((128, 128), n_slices=1, seed=6)
+    cells = field['labeled_cells'].astype(np.int32)
+    with pytest.raises(Cancelled):
+        if stage == "graph":
+            adjacency_graph(cells)
+        elif stage == "nuclei":
+            segment_nuclei(cells, field['hyperstack'][2], 0.75)
+        else:
+            associate_spots_yeasts(cells, cells, field['hyperstack'][0], 0, 1000, 0.0, 0.0)
+
+def test_graph_after_reset():
+    cells = np.zeros((32, 32), dtype=np.int32)
+    cells[2:12, 2:12]  = 1
+    cells[2:12, 12:22] = 2
+    get_token().cancel()
+    get_token().reset()
+    assert 2 in adjacency_graph(cells)[1]['neighbors']
@@ -0,0 +1,78 @@
+import numpy as np
+from spots_in_yeasts import spotsInYeasts
+from spots_in_yeasts.spotsInYeasts import DiameterPolicy, segment_yeasts_cells, upscale_labels
+
+"""
+This file contains tests of the policy deciding which cells diameter is given to Cellpose.
+Cellpose is replaced by a fake model recording the diameters it receives.
+"""
+
+class FakeCellpose(object):
+    received  = []
+    estimates = iter([])
+
+    def __init__(self, gpu=False, model_type='cyto'):
+        pass
+
+    def eval(self, image, diameter=None, channels=None):
+        FakeCellpose.received.append(diameter)
+        used = next(FakeCellpose.estimates) if diameter is None else diameter
+        return np.zeros(image.shape, dtype=np.int32), None, None, used
+
+def run_batch(monkeypatch, policy, estimates, n_images):
+    monkeypatch.setattr(spotsInYeasts.models, 'Cellpose', FakeCellpose)
+    FakeCellpose.received  = []
+    FakeCellpose.estimates = iter(estimates)
+    for _ in range(n_images):
+        segment_yeasts_cells(np.zeros((16, 16)), False, policy)
+    return FakeCellpose.received
+
+def test_estimated_once(monkeypatch):
+    policy = DiameterPolicy()
+    assert run_batch(monkeypatch, policy, [31.0], 4) == [None, 31.0, 31.0, 31.0]
+    assert policy.source() == 'estimated'
+
+def test_median_of_estimates(monkeypatch):
+    policy = DiameterPolicy(n_estimates=3)
+    assert run_batch(monkeypatch, policy, [30.0, 40.0, 32.0], 5) == [None, None, None, 32.0, 32.0]
+    assert policy.last == 32.0
+    assert policy.source() == 'median'
+
+def test_source_of_each_image(monkeypatch):
+    policy  = DiameterPolicy(n_estimates=3)
+    sources = []
+    monkeypatch.setattr(spotsInYeasts.models, 'Cellpose', FakeCellpose)
+    FakeCellpose.received  = []
+    FakeCellpose.estimates = iter([30.0, 32.0, 45.0])
+    for _ in range(4):
+        segment_yeasts_cells(np.zeros((16, 16)), False, policy)
+        sources.append((policy.last, policy.source()))
+    # The 3rd image ran with its own estimate, not with the median (32.0) used from the 4th one.
+    assert sources == [(30.0, 'estimated'), (32.0, 'estimated'), (45.0, 'estimated'), (32.0, 'median')]
+
+def test_fixed_diameter(monkeypatch):
+    policy = DiameterPolicy(fixed=25.0, n_estimates=3)
+    assert run_batch(monkeypatch, policy, [], 2) == [25.0, 25.0]
+    assert policy.source() == 'fixed'
+
+def test_no_policy(monkeypatch):
+    assert run_batch(monkeypatch, None, [30.0, 31.0], 2) == [None, None]
+
+def test_downscaled_inference(monkeypatch):
+    policy = DiameterPolicy(fixed=30.0)
+    monkeypatch.setattr(spotsInYeasts.models, 'Cellpose', FakeCellpose)
+    FakeCellpose.received = []
+    masks = segment_yeasts_cells(np.zeros((64, 48)), False, policy, 0.5)
+    assert masks.shape == (64, 48)
+    assert FakeCellpose.received == [15.0]
+    assert policy.last == 30.0
+
+def test_upscale_labels():
+    small = np.zeros((32, 32), dtype=np.int32)
+    small[4:14, 4:14]   = 1
+    small[14:28, 10:30] = 2
+    large = upscale_labels(small, (128, 128))
+    assert large.shape == (128, 128)
+    assert set(np.unique(large)) == {0, 1, 2}
+    assert large[36, 36] == 1 and large[80, 80] == 2
+    assert np.array_equal(upscale_labels(small, (32, 32)), small)
@@ -0,0 +1,86 @@
+import os
+import pytest
+import numpy as np
+import tifffile
+from spots_in_yeasts.imageReaders import list_items, read_item, item_name, item_exists, parse_channels_order, channel_views
+
+def _stack(shape, offset=0):
+    return (np.arange(int(np.prod(shape))) + offset).astype(np.uint16).reshape(shape)
+
+@pytest.fixture
+def folder(tmp_path):
+    tifffile.imwrite(str(tmp_path / "plain.tif"), _stack((3, 2, 16, 16)), imagej=True, metadata={'axes': 'ZCYX'})
+    tifffile.imwrite(str(tmp_path / "lapse.ome.tif"), _stack((2, 3, 16, 16)), metadata={'axes': 'TCYX'})
+    for c in range(3):
+        for z in range(2):
+            tifffile.imwrite(str(tmp_path / f"series_c{c}_z{z}.tif"), np.full((16, 16), 10 * c + z, dtype=np.uint16))
+    tifffile.imwrite(str(tmp_path / "alone_c0.tif"), _stack((2, 16, 16)))
+    (tmp_path / "notes.txt").write_text("not an image")
+    return tmp_path
+
+def test_list_items(folder):
+    paths = [str(folder / f) for f in sorted(os.listdir(folder))]
+    items = list_items(paths)
+    names = sorted(item_name(*item) for item in items)
+    assert names == ['alone_c0', 'lapse-p0-t0', 'lapse-p0-t1', 'plain', 'series']
+    assert all(item_exists(r, s) for (r, s, _, _) in items)
+
+def test_read_series(folder):
+    items = list_items([str(folder / f) for f in os.listdir(folder)])
+    (reader, source, p, t), = [i for i in items if i[0] == 'tiff-series']
+    data = read_item(reader, source, p, t)
+    assert data.shape == (2, 3, 16, 16)
+    assert data[1, 2, 0, 0] == 21
+
+def test_read_time_lapse_frame(folder):
+    items = list_items([str(folder / "lapse.ome.tif")])
+    data  = read_item(*items[1])
+    assert np.array_equal(data, _stack((2, 3, 16, 16))[1])
+
+def test_series_frames(tmp_path):
+    for t in range(3):
+        for c in range(2):
+            tifffile.imwrite(str(tmp_path / f"cells_t{t}_c{c}.tif"), np.full((8, 8), 10 * t + c, dtype=np.uint16))
+    items = list_items([str(tmp_path / f) for f in os.listdir(tmp_path)])
+    assert [(p, t) for (_, _, p, t) in items] == [(0, 0), (0, 1), (0, 2)]
+    assert read_item(*items[2])[1, 0, 0] == 21
+
+def test_series_of_images(tmp_path):
+    # Files already holding several channels are complete images, not parts of a series.
+    for c in (1, 2):
+        tifffile.imwrite(str(tmp_path / f"strain_c{c}.tif"), _stack((2, 64, 64), c), imagej=True, metadata={'axes': 'CYX'})
+        tifffile.imwrite(str(tmp_path / f"plain_c{c}.tif"), _stack((2, 64, 64), c))
+    items = list_items([str(tmp_path / f) for f in sorted(os.listdir(tmp_path))])
+    assert [r for (r, _, _, _) in items] == ['tiff'] * 4
+    assert all(read_item(*item).shape == (2, 64, 64) for item in items)
+
+def test_series_of_stacks(tmp_path):
+    for c in range(2):
+        tifffile.imwrite(str(tmp_path / f"cells_c{c}.tif"), _stack((3, 8, 8), 100 * c), imagej=True, metadata={'axes': 'ZYX'})
+    (reader, source, p, t), = list_items([str(tmp_path / f) for f in os.listdir(tmp_path)])
+    data = read_item(reader, source, p, t)
+    assert (reader, data.shape) == ('tiff-series', (3, 2, 8, 8))
+    assert data[2, 1, 0, 0] == 100 + 2 * 64
+
+def test_channels_order():
+    assert parse_channels_order("brightfield, -, spots") == ['Brightfield', '-', 'Spots']
+    with pytest.raises(ValueError):
+        parse_channels_order("Spots, Nuclei")
+    with pytest.raises(ValueError):
+        parse_channels_order("Spots, Brightfield, Cytoplasm")
+
+def test_channel_views():
+    stack = _stack((4, 3, 16, 16))
+    views = channel_views(stack, parse_channels_order("Nuclei, Spots, Brightfield"))
+    assert np.array_equal(views['Spots'], stack[:, 1])
+    assert all(np.shares_memory(v, stack) for v in views.values())
+    two = channel_views(_stack((2, 16, 16)), parse_channels_order("Brightfield, Spots, Nuclei"))
+    assert two['Nuclei'] is None
+    with pytest.raises(ValueError):
+        channel_views(_stack((2, 16, 16)), parse_channels_order("Spots, -, Brightfield"))
+    with pytest.raises(ValueError): # Single-channel Z-stack.
+        channel_views(_stack((24, 16, 16)), parse_channels_order("Spots, Brightfield, Nuclei"))
+    with pytest.raises(ValueError): # Extra channel, not named by the order.
+        channel_views(_stack((5, 4, 16, 16)), parse_channels_order("Spots, Brightfield, Nuclei"))
+    with pytest.raises(ValueError):
+        channel_views(_stack((3, 16, 16)), parse_channels_order("Spots, Brightfield"))
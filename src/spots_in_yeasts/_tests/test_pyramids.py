@@ -0,0 +1,64 @@
+import os
+import numpy as np
+import tifffile
+from spots_in_yeasts.pyramids import needs_pyramid, downscale, build_pyramid, cached_levels, level_path, pyramid_shapes
+from spots_in_yeasts.controlWriter import ControlWriter
+from spots_in_yeasts._reader import lazy_pyramid
+
+def test_needs_pyramid():
+    assert needs_pyramid((5000, 100), 4096)
+    assert not needs_pyramid((4096, 4096), 4096)
+    assert not needs_pyramid((5000, 5000), 0)
+    assert not needs_pyramid((3, 5000, 5000), 4096)
+
+def test_downscale_intensities():
+    image = np.arange(5 * 7, dtype=np.uint16).reshape(5, 7)
+    small = downscale(image)
+    assert small.shape == (3, 4)
+    assert small.dtype == np.uint16
+    assert small[0, 0] == round(np.mean(image[:2, :2]))
+    assert small[2, 3] == image[4, 6] # Repeated last row and column.
+
+def test_downscale_labels():
+    labels = np.random.default_rng(0).integers(0, 6, (65, 33)).astype(np.int32)
+    small  = downscale(labels, True)
+    assert small.shape == (33, 17)
+    assert set(np.unique(small)) <= set(np.unique(labels))
+
+def test_build_pyramid():
+    levels = build_pyramid(np.zeros((2100, 1000), np.float32), min_side=512)
+    assert [l.shape for l in levels] == [(2100, 1000), (1050, 500), (525, 250), (263, 125)]
+    assert pyramid_shapes((2100, 1000), 512) == [l.shape for l in levels]
+    assert pyramid_shapes((5001, 77)) == [l.shape for l in build_pyramid(np.zeros((5001, 77), np.uint8), True)]
+
+def test_cached_levels(tmp_path):
+    image  = np.random.default_rng(1).integers(0, 1000, (1200, 900)).astype(np.uint16)
+    folder = str(tmp_path)
+    path   = os.path.join(folder, "field_bf.tif")
+
+    writer = ControlWriter(n_workers=0, pyramid_threshold=1000)
+    writer.write_image(folder, path, image)
+    writer.write_image(folder, os.path.join(folder, "small.tif"), image[:500])
+    assert writer.manifests[folder]["field_bf.tif"]['levels'] == [[1200, 900], [600, 450], [300, 225]]
+    assert 'levels' not in writer.manifests[folder]["small.tif"]
+    assert cached_levels(path) == [level_path(path, 1), level_path(path, 2)]
+
+    levels = lazy_pyramid(path, writer.manifests[folder]["field_bf.tif"])
+    assert np.array_equal(levels[2].compute(), downscale(downscale(image)))
+
+    # Levels older than the image are not used anymore.
+    os.utime(level_path(path, 1), (0, 0))
+    assert cached_levels(path) == []
+
+def test_reader_builds_cache(tmp_path):
+    path  = str(tmp_path / "field_segmented_cells.tif")
+    image = np.repeat(np.arange(5000, dtype=np.uint16)[None, :] // 100, 8, axis=0)
+    tifffile.imwrite(path, image)
+    levels = lazy_pyramid(path, labels=True)
+    expected = build_pyramid(image, True)
+    assert isinstance(levels, list) and ([l.shape for l in levels] == [l.shape for l in expected])
+    # Nothing is read nor built until a level is displayed.
+    assert cached_levels(path) == []
+    assert np.array_equal(levels[2].compute(), expected[2])
+    assert len(cached_levels(path)) == len(levels) - 1
+    assert np.array_equal(levels[1].compute(), expected[1])
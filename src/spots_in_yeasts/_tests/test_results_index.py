@@ -0,0 +1,99 @@
+import pytest
+import os
+from datetime import datetime
+from spots_in_yeasts.resultsIndex import ResultsIndex, settings_hash, read_control_index
+
+"""
+This file contains tests for the SQLite index of results.
+"""
+
+def make_spot(label, category):
+    return {
+        'label'         : label,
+        'location'      : (10, 12),
+        'intensity_mean': 1.0,
+        'intensity_min' : 0.5,
+        'intensity_max' : 2.0,
+        'area'          : 20.0,
+        'perimeter'     : 15.0,
+        'solidity'      : 0.9,
+        'extent'        : 0.8,
+        'intensity_sum' : 20,
+        'category'      : category
+    }
+
+def make_ownership():
+    return {
+        1: [make_spot(1, 'NUCLEAR'), make_spot(2, 'NUCLEAR'), make_spot(3, 'NUCLEAR')],
+        2: [make_spot(4, 'CYTOPLASMIC')],
+        3: []
+    }
+
+def test_add_and_query(tmp_path):
+    """
+    Inserts an image and checks the per-cell counts.
+    """
+    index = ResultsIndex(os.path.join(tmp_path, "index.sqlite"))
+    index.add_image("img", "/src", "/out/img.ysc", make_ownership(), "abc")
+
+    assert len(index.query_images()) == 1
+    assert len(index.query_spots()) == 4
+    assert len(index.query_spots(category='nuclear')) == 3
+
+    cells = index.query_cells(min_nuclear=3)
+    assert [c['cell_label'] for c in cells] == [1]
+    assert len(index.query_cells(s_hash="other")) == 0
+    index.close()
+
+def test_reindex_replaces(tmp_path):
+    """
+    Indexing the same control folder twice must not duplicate rows.
+    """
+    index = ResultsIndex(os.path.join(tmp_path, "index.sqlite"))
+    index.add_image("img", "/src", "/out/img.ysc", make_ownership())
+    index.add_image("img", "/src", "/out/img.ysc", make_ownership())
+    assert len(index.query_images()) == 1
+    assert len(index.query_cells()) == 3
+    index.close()
+
+def test_reindex_relative_path(tmp_path, monkeypatch):
+    """
+    A control folder given by a relative path (rebuild) is the same as its absolute path (batch export).
+    """
+    monkeypatch.chdir(tmp_path)
+    index = ResultsIndex(os.path.join(tmp_path, "index.sqlite"))
+    index.add_image("img", "/src", os.path.join(tmp_path, "img.ysc"), make_ownership())
+    index.add_image("img", "/src", os.path.join(".", "img.ysc"), make_ownership())
+    assert len(index.query_images()) == 1
+    assert len(index.query_cells()) == 3
+    index.close()
+
+def test_query_dates(tmp_path):
+    """
+    A bare `until` date includes the images processed during that day.
+    """
+    index = ResultsIndex(os.path.join(tmp_path, "index.sqlite"))
+    index.add_image("a", "/src", "/out/a.ysc", make_ownership(), processed_at=datetime(2023, 5, 30, 23, 0))
+    index.add_image("b", "/src", "/out/b.ysc", make_ownership(), processed_at=datetime(2023, 5, 31, 14, 30))
+    index.add_image("c", "/src", "/out/c.ysc", make_ownership(), processed_at=datetime(2023, 6, 1, 0, 0))
+    assert [r['name'] for r in index.query_images(until="2023-05-31")] == ["a", "b"]
+    assert [r['name'] for r in index.query_images(until="2023-05-31T12:00:00")] == ["a"]
+    assert [r['name'] for r in index.query_images(since="2023-05-31", until="2023-05-31")] == ["b"]
+    assert len(index.query_cells(until="2023-05-31")) == 6
+    index.close()
+
+def test_settings_hash():
+    """
+    The hash must only depend on the results-related settings.
+    """
+    a = {'gaussian_radius': 3.0, 'writer_threads': 2}
+    b = {'gaussian_radius': 3.0, 'writer_threads': 8}
+    assert settings_hash(a, {'writer_threads'}) == settings_hash(b, {'writer_threads'})
+    assert settings_hash(a) != settings_hash(b)
+
+def test_read_control_index(tmp_path):
+    with open(os.path.join(tmp_path, "index.txt"), 'w') as f:
+        f.write("name\nimg\nsources\n/src\ntime\n01/May/2023 (10:00:00)\n")
+    ppts = read_control_index(str(tmp_path))
+    assert ppts['name'] == "img"
+    assert ppts['sources'] == "/src"
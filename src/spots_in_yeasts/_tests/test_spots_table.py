@@ -0,0 +1,80 @@
+import numpy as np
+from spots_in_yeasts.spotsTable import SpotsTable, as_spots_table, categories
+from spots_in_yeasts.spotsInYeasts import associate_spots_yeasts, refine_ownership
+from spots_in_yeasts.formatData import format_data_1844, format_data_1895, get_header_1844
+
+def make_field():
+    cells = np.zeros((60, 90), dtype=np.int32)
+    cells[5:55, 5:40]  = 3
+    cells[5:55, 50:85] = 1
+    cells[58:, :]      = 7 # Cell without spots.
+    spots = np.zeros_like(cells)
+    for i, (r, c) in enumerate([(20, 20), (40, 30), (30, 60), (10, 10)], 1):
+        spots[r-1:r+2, c-1:c+2] = i
+    spots[2, 2] = 5 # In the background.
+    fluo = np.random.default_rng(0).uniform(0, 100, cells.shape)
+    return cells, spots, fluo
+
+def test_associate_builds_table():
+    cells, spots, fluo = make_field()
+    classes = {1: 'NUCLEAR', 2: 'CYTOPLASMIC', 3: 'PERIPHERAL', 4: 'NUCLEAR', 5: 'NUCLEAR'}
+    table, locations, labeled = associate_spots_yeasts(cells, spots, fluo, 0, 100, 0.0, 0.0, classes, {'z': {1: 2.0, 3: 1.0}})
+    assert table.cells.tolist() == [1, 3, 7]
+    assert table.counts().tolist() == [1, 3, 0]
+    assert table.records['label'].tolist() == [3, 1, 2, 4]
+    assert np.array_equal(locations, table.locations())
+    assert 5 not in labeled
+    assert [categories[c] for c in table.records['category']] == ['PERIPHERAL', 'NUCLEAR', 'CYTOPLASMIC', 'NUCLEAR']
+    # Dictionary view.
+    assert list(table.keys()) == [1, 3, 7]
+    assert [s['label'] for s in table[3]] == [1, 2, 4]
+    assert (table[3][0]['z'], table[3][1]['z']) == (2.0, None)
+    assert table[7] == []
+    assert SpotsTable.from_dict(table.as_dict()).as_dict() == table.as_dict()
+
+def test_refine_table():
+    cells, spots, fluo = make_field()
+    table, _, _ = associate_spots_yeasts(cells, spots, fluo, 0, 100, 0.0, 0.0)
+    as_dict = table.as_dict()
+    refine_ownership(table, fluo)
+    refine_ownership(as_dict, fluo)
+    assert table.refined
+    assert table.as_dict() == as_dict
+
+def test_format_1844_layout():
+    cells, spots, fluo = make_field()
+    table, _, _ = associate_spots_yeasts(cells, spots, fluo, 0, 100, 0.0, 0.0)
+    csv = format_data_1844(table, "img")
+    column = {t: i for i, t in enumerate(csv.getTitles())}
+    # Row per spot, a row for the cell without spots, and a closing row.
+    assert len(csv.lines) == 4 + 1 + 1
+    assert [l[column['cell-index']] for l in csv.lines] == ["1", "3", "", "", "7", ""]
+    assert [l[column['# spots']] for l in csv.lines] == ["1", "3", "", "", "0", ""]
+    assert [l[column['spot-index']] for l in csv.lines] == ["3", "1", "2", "4", "", ""]
+    assert [l[column['source']] for l in csv.lines] == ["img", "", "", "", "", ""]
+    assert csv.lines[1][column['y']] == "20"
+    assert all(v == "" for v in csv.lines[-1])
+    # Tables from the dictionary view are identical.
+    assert format_data_1844(table.as_dict(), "img").lines == csv.lines
+
+def test_header_1844_layout():
+    # New columns come after the original ones, optional ones only if their mode is enabled.
+    base = get_header_1844()
+    assert base.index('# spots') == 11
+    assert base[-2:] == ['y', 'x']
+    assert get_header_1844(['membrane_distance', 'z'], True)[len(base):] == ['z', 'fit-sigma', 'fit-r2', 'membrane-distance']
+    cells, spots, fluo = make_field()
+    table, _, _ = associate_spots_yeasts(cells, spots, fluo, 0, 100, 0.0, 0.0, None, {'z': {1: 2.0}})
+    assert format_data_1844(table, "img").getTitles() == get_header_1844(['z'])
+
+def test_format_1895_counts():
+    ownership = {
+        2: [{'label': 1, 'category': 'NUCLEAR'}, {'label': 2, 'category': 'PERIPHERAL'}, {'label': 3, 'category': None}],
+        5: []
+    }
+    csv = format_data_1895(as_spots_table(ownership), "img")
+    assert csv.lines == [
+        ["img", "2", "1", "1", "1"],
+        ["", "5", "0", "0", "0"],
+        ["", "", "", "", ""]
+    ]
@@ -0,0 +1,52 @@
+import csv
+import numpy as np
+from spots_in_yeasts.summaries import BatchSummary, image_totals, count_labels
+
+def _spot(label, intensity, area, category=None):
+    return {'label': label, 'intensity_mean': intensity, 'area': area, 'category': category}
+
+def _read(path):
+    with open(path) as f:
+        return list(csv.DictReader(f, delimiter=';'))
+
+def test_count_labels():
+    labels = np.zeros((10, 10), dtype=np.uint16)
+    labels[1, 1], labels[2, 2], labels[3, 3] = 4, 9, 4
+    assert count_labels(labels) == 2
+    assert count_labels(np.zeros((0, 0), dtype=np.int32)) == 0
+
+def test_image_totals():
+    ownership = {
+        1: [],
+        2: [_spot(1, 10.0, 20, 'NUCLEAR'), _spot(2, 30.0, 40, 'PERIPHERAL')],
+        3: [_spot(i, 5.0, 10, 'CYTOPLASMIC') for i in range(3, 10)]
+    }
+    totals = image_totals(ownership, {'cells-segmented': 5, 'cells-border': 1})
+    assert (totals['cells'], totals['cells-with-spots'], totals['spots']) == (3, 2, 9)
+    assert totals['histogram'].tolist() == [1, 0, 1, 0, 0, 1]
+    assert (totals['spots-nuclear'], totals['spots-cytoplasmic'], totals['spots-peripheral']) == (1, 7, 1)
+    assert totals['intensity-sum'] == 75.0
+    assert totals['cells-dead-nuclei'] is None
+
+def test_batch_summary(tmp_path):
+    images = str(tmp_path / "images.csv")
+    batch  = str(tmp_path / "batch.csv")
+    summary = BatchSummary(images, batch)
+    counts  = {'cells-segmented': 4, 'cells-dead-nuclei': 1, 'cells-border': 1, 'cells-dead-intensity': 0}
+    summary.add({1: [_spot(1, 10.0, 20)], 2: []}, "first", counts)
+    summary.add({1: [_spot(1, 20.0, 10), _spot(2, 30.0, 30)]}, "second", counts)
+
+    rows = _read(images)
+    assert [r['source'] for r in rows] == ["first", "second"]
+    assert rows[0]['spots-per-cell'] == "0.5"
+
+    total, = _read(batch)
+    assert total['images'] == "2"
+    assert (total['cells'], total['spots'], total['cells-segmented']) == ("3", "3", "8")
+    assert total['spots-intensity-mean'] == "20.0"
+    assert total['cells-1-spots'] == "1" and total['cells-2-spots'] == "1"
+
+    summary.add({}, "third") # Counts unknown: totals of the batch can't be given anymore.
+    total, = _read(batch)
+    assert total['cells-segmented'] == ""
+    assert total['images'] == "3"
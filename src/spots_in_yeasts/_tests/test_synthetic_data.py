@@ -0,0 +1,253 @@
+import pytest
+import numpy as np
+from spots_in_yeasts.syntheticData import make_yeasts_field
+from spots_in_yeasts.spotsInYeasts import find_focused_slice, segment_spots_3d, segment_spots_multiscale, associate_spots_yeasts, refine_spots, find_peaks, spots_distances, segment_nuclei, write_labels_image, label_centroids, own_channel, segment_transmission, segment_spots, nuclei_from_fluo
+from spots_in_yeasts.stagesProfiler import reset_peak_rss, peak_rss
+from scipy.ndimage import gaussian_filter, distance_transform_cdt
+from skimage.feature import peak_local_max
+from skimage.measure import regionprops
+from skimage.segmentation import clear_border
+import cv2
+
+"""
+This file contains tests running on synthetic yeast fields, so they don't depend on external data.
+"""
+
+def test_field_shape():
+    field = make_yeasts_field((128, 128), n_slices=5, seed=3)
+    assert field['hyperstack'].shape == (5, 3, 128, 128)
+    assert field['hyperstack'].dtype == np.uint16
+    assert field['labeled_cells'].shape == (128, 128)
+
+def test_field_single_slice():
+    field = make_yeasts_field((128, 128), n_slices=1, nuclei=False)
+    assert field['hyperstack'].shape == (2, 128, 128)
+
+def test_field_reproducible():
+    a = make_yeasts_field((128, 128), seed=7)
+    b = make_yeasts_field((128, 128), seed=7)
+    assert np.array_equal(a['hyperstack'], b['hyperstack'])
+
+def test_nuclei_inside_cells():
+    field = make_yeasts_field((256, 256), seed=1)
+    assert not np.any((field['labeled_nuclei'] > 0) & (field['labeled_cells'] == 0))
+
+def test_spots_inside_cells():
+    field = make_yeasts_field((256, 256), seed=2)
+    ys = field['spots'][:, 1].astype(int)
+    xs = field['spots'][:, 2].astype(int)
+    assert np.all(field['labeled_cells'][ys, xs] > 0)
+
+@pytest.mark.parametrize("focus", [2, 4, 6])
+def test_focus_finder_synthetic(focus):
+    field = make_yeasts_field((256, 256), n_slices=9, focus=focus, seed=focus)
+    found = find_focused_slice(field['hyperstack'][:, 1], 2)
+    assert found == (focus-2, focus+2)
+
+def test_spots_3d_chunks():
+    field = make_yeasts_field((256, 256), n_slices=9, focus=4, seed=2)
+    cells = field['labeled_cells'].astype(np.int32)
+    whole = segment_spots_3d(field['hyperstack'][:, 0], np.copy(cells), 65535, 3.0, 5, 0.5, 2, chunk_rows=1024)
+    split = segment_spots_3d(field['hyperstack'][:, 0], np.copy(cells), 65535, 3.0, 5, 0.5, 2, chunk_rows=40)
+    assert np.array_equal(whole[0], split[0])
+    assert np.array_equal(whole[1], split[1])
+    assert whole[3] == split[3]
+
+def test_spots_3d_depth():
+    field = make_yeasts_field((256, 256), n_slices=9, focus=4, seed=2)
+    cells = field['labeled_cells'].astype(np.int32)
+    locations, labeled_spots, flat, depths = segment_spots_3d(field['hyperstack'][:, 0], cells, 65535, 3.0, 5, 0.5, 2)
+    assert len(locations) > 0
+    truth = field['spots']
+    for (z, r, c) in locations:
+        closest = np.argmin(np.sum((truth[:, 1:] - (r, c))**2, axis=1))
+        assert abs(depths[int(labeled_spots[z, r, c])] - truth[closest, 0]) < 1.5
+    ownership, _, _ = associate_spots_yeasts(cells, labeled_spots, flat, 0, 1000, 0.0, 0.0, None, {'z': depths})
+    spots = [s for l in ownership.values() for s in l]
+    assert len(spots) > 0 and all(s['z'] is not None for s in spots)
+
+@pytest.mark.parametrize("dx", [0, 3])
+def test_spots_3d_stacked(dx):
+    # Two spots at (almost) the same position in the plane, 6 slices apart, are kept apart.
+    stack = np.full((11, 64, 64), 100, dtype=np.float32)
+    stack[2, 32, 30] = stack[8, 32, 30+dx] = 60000
+    stack = gaussian_filter(stack, (1.0, 1.5, 1.5)).astype(np.uint16)
+    cells = np.zeros((64, 64), dtype=np.int32)
+    cells[10:54, 10:54] = 1
+    locations, labeled_spots, flat, depths = segment_spots_3d(stack, cells, 65535, 1.5, 5, 0.5, 10)
+    assert labeled_spots.shape == stack.shape
+    assert sorted(depths.values()) == [2, 8]
+    assert sorted(map(tuple, locations[:, 1:].tolist())) == [(32, 30), (32, 30+dx)]
+    ownership, _, labeled = associate_spots_yeasts(cells, labeled_spots, flat, 0, 1000, 0.0, 0.0, None, {'z': depths})
+    assert sorted(s['z'] for s in ownership[1]) == [2, 8]
+    assert len({s['label'] for s in ownership[1]}) == 2
+    measures = spots_distances(cells, None, labeled, locations)
+    assert sorted(measures['membrane_distance'].keys()) == [1, 2]
+
+def test_spots_3d_threshold_samples():
+    # The threshold computed on a subsample of the LoG response finds the same spots.
+    field = make_yeasts_field((256, 256), n_slices=9, focus=4, seed=2)
+    cells = field['labeled_cells'].astype(np.int32)
+    whole   = segment_spots_3d(field['hyperstack'][:, 0], np.copy(cells), 65535, 3.0, 5, 0.5, 2)
+    sampled = segment_spots_3d(field['hyperstack'][:, 0], np.copy(cells), 65535, 3.0, 5, 0.5, 2, chunk_rows=40, n_samples=20000)
+    assert abs(len(whole[0]) - len(sampled[0])) <= 1
+
+@pytest.mark.parametrize("sigma", [1.0, 2.0, 3.0])
+def test_multiscale_best_sigma(sigma):
+    rng = np.random.default_rng(0)
+    points = np.zeros((256, 256))
+    coords = rng.integers(16, 240, (40, 2))
+    points[coords[:, 0], coords[:, 1]] = 1.0
+    image = gaussian_filter(points, sigma) * 2 * np.pi * sigma**2 * 20000 + 1000 + rng.normal(0, 50, points.shape)
+    cells = np.ones(points.shape, dtype=np.int32)
+    locations, labeled_spots, flat, scales = segment_spots_multiscale(image.astype(np.uint16), cells, 65535, (1.0, 1.5, 2.0, 3.0, 4.0), 5, 0.3)
+    assert len(locations) > 30
+    assert np.median(list(scales.values())) == sigma
+
+def test_multiscale_equal_bounds():
+    field = make_yeasts_field((256, 256), n_slices=3, seed=4)
+    cells = field['labeled_cells'].astype(np.int32)
+    image = field['hyperstack'][:, 0]
+    # Same as `np.geomspace(2.0, 2.0, 4)` from the settings: a single scale is searched.
+    locations, _, _, scales = segment_spots_multiscale(image, np.copy(cells), 65535, np.geomspace(2.0, 2.0, 4), 5, 0.3)
+    single = segment_spots_multiscale(image, np.copy(cells), 65535, (2.0,), 5, 0.3)
+    assert len(locations) > 0
+    assert np.array_equal(locations, single[0])
+    assert set(scales.values()) == {2.0}
+
+def test_subpixel_refinement():
+    rng  = np.random.default_rng(1)
+    true = rng.uniform(10, 246, (60, 2))
+    yy, xx = np.mgrid[0:256, 0:256]
+    image  = np.full((256, 256), 1000.0)
+    for (r, c) in true:
+        image += 3000 * np.exp(-((yy - r)**2 + (xx - c)**2) / (2 * 1.5**2))
+    image += rng.normal(0, 20, image.shape)
+    fits  = refine_spots(image, np.round(true).astype(int), 3)
+    error = np.hypot(fits['rows'] - true[:, 0], fits['cols'] - true[:, 1])
+    assert np.median(error) < 0.05
+    assert np.nanmedian(fits['r2']) > 0.95
+    assert abs(np.nanmedian(fits['sigma']) - 1.5) < 0.2
+
+def test_subpixel_empty():
+    fits = refine_spots(np.zeros((32, 32)), np.zeros((0, 2), dtype=int))
+    assert len(fits['rows']) == 0
+
+@pytest.mark.parametrize("min_distance, threshold_rel", [(1, 0.5), (5, 0.5), (5, 0.0), (3, None)])
+def test_find_peaks_as_peak_local_max(min_distance, threshold_rel):
+    field   = make_yeasts_field((512, 512), density=0.6, spots_per_cell=(5, 15), seed=3)
+    image   = np.max(field['hyperstack'][:, 0], axis=0).astype(np.float64)
+    chamfer = distance_transform_cdt((gaussian_filter(image, 2) > np.percentile(image, 80)).astype(np.float64))
+    for candidate in (chamfer, gaussian_filter(image, 1.5)):
+        expected = peak_local_max(candidate, min_distance=min_distance, threshold_rel=threshold_rel)
+        assert np.array_equal(find_peaks(candidate, min_distance, threshold_rel, tile=24), expected)
+
+def test_find_peaks_flat():
+    assert find_peaks(np.zeros((64, 64)), 5, 0.5).shape == (0, 2)
+
+def test_spots_distances():
+    cells  = np.zeros((64, 128), dtype=np.int32)
+    cells[2:62, 2:62]   = 1
+    cells[2:62, 62:126] = 2 # Touching the first cell.
+    nuclei = np.zeros_like(cells)
+    yy, xx = np.mgrid[0:64, 0:128]
+    nuclei[(yy - 32)**2 + (xx - 32)**2 <= 10**2] = 1
+    locations = np.array([(32, 32), (32, 50), (32, 60), (32, 64)])
+    spots     = np.zeros_like(cells)
+    spots[locations[:, 0], locations[:, 1]] = np.arange(1, 5)
+
+    d = spots_distances(cells, nuclei, spots, locations)
+    assert d['nucleus_distance'][1] == pytest.approx(-10.5, abs=0.6)
+    assert d['nucleus_distance'][2] == pytest.approx(8.0, abs=0.6)
+    assert d['nucleus_distance'][4] is None # The closest nucleus is in the neighbouring cell.
+    assert d['membrane_distance'][3] == 1.0 # Boundary shared with the neighbouring cell.
+    assert d['membrane_distance'][1] == 29.0 # Closest to the boundary shared with the neighbouring cell.
+    assert spots_distances(cells, None, spots, locations)['nucleus_distance'][2] is None
+
+def test_segment_nuclei_in_place():
+    field  = make_yeasts_field((256, 256), n_slices=3, seed=5)
+    cells  = field['labeled_cells'].astype(np.int32)
+    copied = segment_nuclei(cells, field['hyperstack'][:, 2], 0.75)
+    owned  = np.copy(cells)
+    placed = segment_nuclei(owned, field['hyperstack'][:, 2], 0.75, copy=False)
+    assert placed[1] is owned
+    assert np.array_equal(placed[1], copied[1])
+    assert np.array_equal(placed[2], copied[2])
+
+def test_peak_rss():
+    reset_peak_rss()
+    before = peak_rss()
+    if before is None:
+        pytest.skip("RSS not available on this platform.")
+    block = np.ones(64 * 2**20, dtype=np.uint8) # 64 MB touched.
+    assert peak_rss() >= before
+    assert peak_rss() >= block.nbytes
+
+def test_own_channel_results():
+    # Steps give the same results on the copies as on the views on the hyperstack.
+    field = make_yeasts_field((256, 256), n_slices=9, focus=2, seed=4)
+    spots, bf, nuclei = (field['hyperstack'][:, c] for c in range(3))
+    cells = field['labeled_cells'].astype(np.int32)
+    owned, first = own_channel(bf, 2)
+    assert (owned.shape[0], owned.base, first) == (5, None, 0)
+    for a, b in zip(segment_transmission(bf, False, 2, 'classical'), segment_transmission(owned, False, 2, 'classical')):
+        assert np.array_equal(a, b)
+    for a, b in zip(segment_spots(spots, cells, 65535, 2.0, 5, 0.5), segment_spots(own_channel(spots)[0], cells, 65535, 2.0, 5, 0.5)):
+        assert np.array_equal(a, b)
+    slab, first = own_channel(spots, 2)
+    a, b = segment_spots_3d(spots, cells, 65535, 2.0, 5, 0.5, 2), segment_spots_3d(slab, cells, 65535, 2.0, 5, 0.5, 2)
+    assert all(np.array_equal(x, y) for x, y in zip(a[:3], b[:3]))
+    assert a[3] == {l: z + first for l, z in b[3].items()}
+    for a, b in zip(nuclei_from_fluo(nuclei), nuclei_from_fluo(own_channel(nuclei)[0])):
+        assert np.array_equal(a, b)
+
+def _current_rss():
+    # The peak right after a reset is the current resident memory.
+    reset_peak_rss()
+    return peak_rss()
+
+def test_own_channel_peak_rss():
+    if not reset_peak_rss():
+        pytest.skip("The peak RSS can't be reset on this platform.")
+    field      = make_yeasts_field((256, 256), n_slices=16, seed=5)
+    hyperstack = np.tile(field['hyperstack'], (1, 1, 4, 4)) # (16, 3, 1024, 1024): 96 MB.
+    size       = hyperstack.nbytes
+    views      = [hyperstack[:, c] for c in range(3)]
+
+    # Channels copied out while the hyperstack is still referenced (before the memory-budget fix).
+    base     = _current_rss()
+    copies   = [np.array(views[0]), np.array(views[2])]
+    detached = peak_rss() - base
+    del copies
+
+    # Channels owned right after splitting, the hyperstack being freed.
+    base  = _current_rss()
+    owned = [own_channel(views[0])[0], own_channel(views[1], 2)[0], own_channel(views[2])[0]]
+    del views, hyperstack
+    peak  = peak_rss() - base
+    assert peak < 0.25 * size
+    assert peak < detached / 2
+    assert _current_rss() < base - 0.8 * size
+    assert sum(o.nbytes for o in owned) < 0.2 * size
+
+def test_label_centroids():
+    cells = make_yeasts_field((256, 256), n_slices=1, seed=6)['labeled_cells'].astype(np.int32)
+    labels, centroids = label_centroids(cells)
+    regions = regionprops(cells)
+    assert labels.tolist() == [r.label for r in regions]
+    assert np.allclose(centroids, [r.centroid for r in regions])
+
+def test_write_labels_image():
+    cells = make_yeasts_field((256, 256), n_slices=1, seed=6)['labeled_cells'].astype(np.int32)
+    cells[cells > 0] += 995 # Numbers of 3 and 4 digits.
+    expected = np.zeros(cells.shape, dtype=np.uint8)
+    for region in regionprops(cells):
+        y, x = region.centroid
+        size, _ = cv2.getTextSize(str(region.label), cv2.FONT_HERSHEY_SIMPLEX, 0.75, 2)
+        cv2.putText(expected, str(region.label), (int(x-size[0]/2), int(y+size[1]/2)), cv2.FONT_HERSHEY_SIMPLEX, 0.75, 255, 2)
+    written = write_labels_image(cells, 0.75)
+    assert np.array_equal(written > 0, expected > 0)
+    # Centroids of the cells before the border was cleared.
+    cleared = clear_border(cells)
+    assert np.array_equal(write_labels_image(cleared, 0.75, label_centroids(cells)), write_labels_image(cleared, 0.75))
+    assert not np.any(write_labels_image(np.zeros((32, 32), dtype=np.int32), 0.75))
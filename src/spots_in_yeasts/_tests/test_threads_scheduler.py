@@ -0,0 +1,33 @@
+import os
+import cv2
+from spots_in_yeasts.threadsScheduler import default_plan, candidate_plans, configure_threads, threads_for, scheduled
+
+"""
+This file contains tests of the distribution of the CPU cores between the stages.
+"""
+
+def test_default_plan():
+    assert default_plan(8, 2) == {'cores': 8, 'cellpose': 6, 'filters': 6, 'writer': 2}
+    assert default_plan(1, 2) == {'cores': 1, 'cellpose': 1, 'filters': 1, 'writer': 0}
+
+def test_candidate_plans():
+    for plan in candidate_plans(6):
+        assert plan['cellpose'] + plan['writer'] <= 6
+        assert plan['cellpose'] >= 1
+
+def test_limits_restored(monkeypatch):
+    monkeypatch.setenv('OMP_NUM_THREADS', "3")
+    monkeypatch.delenv('MKL_NUM_THREADS', raising=False)
+    before = cv2.getNumThreads()
+    configure_threads(default_plan(2, 1))
+    try:
+        with threads_for('filters'):
+            assert cv2.getNumThreads() == 1
+        assert scheduled('filters')(cv2.getNumThreads)() == 1
+    finally:
+        configure_threads(None)
+    assert cv2.getNumThreads() == before
+    assert os.environ['OMP_NUM_THREADS'] == "3"
+    assert 'MKL_NUM_THREADS' not in os.environ
+    with threads_for('filters'):
+        assert cv2.getNumThreads() == before
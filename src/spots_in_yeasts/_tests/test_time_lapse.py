@@ -0,0 +1,134 @@
+import pytest
+import numpy as np
+import tifffile
+from spots_in_yeasts.timeLapse import frames_layout, list_frames, read_frame, frame_name, link_labels, follow_labels, IncrementalCells, frame_change
+from spots_in_yeasts.syntheticData import make_yeasts_field
+from spots_in_yeasts import spotsInYeasts
+from spots_in_yeasts.formatData import CSVtable
+
+def _stack(shape):
+    return np.arange(int(np.prod(shape)), dtype=np.uint16).reshape(shape)
+
+def test_plain_hyperstack(tmp_path):
+    path = str(tmp_path / "plain.tif")
+    tifffile.imwrite(path, _stack((4, 2, 16, 16)), imagej=True, metadata={'axes': 'ZCYX'})
+    assert frames_layout(path) is None
+    assert list_frames(path) == [(path, None, None)]
+    assert frame_name(path, None, None) == "plain"
+
+def test_imagej_time_lapse(tmp_path):
+    path = str(tmp_path / "tl.tif")
+    data = _stack((3, 4, 2, 16, 16))
+    tifffile.imwrite(path, data, imagej=True, metadata={'axes': 'TZCYX'})
+    assert frames_layout(path)['frames'] == 3
+    assert list_frames(path) == [(path, 0, t) for t in range(3)]
+    for t in range(3):
+        assert np.array_equal(read_frame(path, 0, t), data[t])
+
+def test_positions_axis(tmp_path):
+    path = str(tmp_path / "mp.tif")
+    data = _stack((2, 3, 2, 4, 16, 16))
+    tifffile.imwrite(path, data, photometric='minisblack', metadata={'axes': 'RTCZYX'})
+    layout = frames_layout(path)
+    assert (layout['positions'], layout['frames']) == (2, 3)
+    # Channels stored before slices are given back as (Z, C, Y, X).
+    assert np.array_equal(read_frame(path, 1, 2), np.swapaxes(data[1, 2], 0, 1))
+
+def test_ome_series_positions(tmp_path):
+    path = str(tmp_path / "mp.ome.tif")
+    data = _stack((2, 2, 16, 16))
+    with tifffile.TiffWriter(path, ome=True) as writer:
+        for p in range(3):
+            writer.write(data + p, metadata={'axes': 'TCYX'})
+    layout = frames_layout(path)
+    assert (layout['positions'], layout['frames']) == (3, 2)
+    assert np.array_equal(read_frame(path, 2, 1), data[1] + 2)
+
+def test_link_labels():
+    first = np.zeros((40, 40), dtype=np.int32)
+    first[2:12, 2:12]   = 7
+    first[20:30, 20:30] = 3
+    linked, next_label = link_labels(None, first, 1)
+    assert set(np.unique(linked)) == {0, 1, 2}
+    assert next_label == 3
+
+    second = np.zeros_like(first)
+    second[4:14, 3:13]   = 1  # Moved a bit.
+    second[30:38, 2:10]  = 2  # New cell.
+    relinked, next_label = link_labels(linked, second, next_label)
+    assert relinked[8, 8] == linked[8, 8]
+    assert relinked[34, 5] == 3
+    assert next_label == 4
+
+def test_link_after_nuclei():
+    # The nuclei step renumbers cells from 1: they are linked on its output, and nuclei follow their cell.
+    field  = make_yeasts_field((256, 256), n_slices=1, seed=3)
+    truth  = field['labeled_cells'].astype(np.int32)
+    nuclei = field['hyperstack'][2]
+    shuffle = np.zeros(truth.max() + 1, dtype=np.int32)
+    shuffle[1:] = np.random.default_rng(0).permutation(truth.max()) + 700
+    frames = [np.where(truth > 0, truth + 500, 0), shuffle[truth]]
+
+    tracks, next_label = None, 1
+    for cells in frames:
+        _, labeled_yeasts, labeled_nuclei = spotsInYeasts.segment_nuclei(cells, nuclei, 0.75)
+        linked, next_label = link_labels(tracks, labeled_yeasts, next_label)
+        followed = follow_labels(labeled_yeasts, linked, labeled_nuclei)
+        if tracks is None:
+            first = (linked, followed)
+        tracks = linked
+
+    assert first[0].max() < 500
+    assert np.array_equal(linked, first[0])
+    assert np.array_equal(followed, first[1])
+    assert set(np.unique(followed)) <= set(np.unique(linked))
+
+def test_csv_append(tmp_path):
+    path  = str(tmp_path / "results.csv")
+    table = CSVtable(['a', 'b'], "")
+    for i in range(3):
+        table.newRow().setValue('a', i)
+        table.appendTo(path)
+        assert len(table.lines) == 0
+    with open(path) as f:
+        assert f.read().split() == ['a;b', '0;', '1;', '2;']
+
+def _brightfield(seed, shift=(0, 0), noise=0.05):
+    field = make_yeasts_field((512, 512), n_slices=1, nuclei=False, seed=seed)
+    bf    = np.roll(field['hyperstack'][1].astype(np.float32), shift, axis=(0, 1))
+    bf   += np.random.default_rng(seed).normal(0, noise * bf.std(), bf.shape)
+    return bf, np.roll(field['labeled_cells'], shift, axis=(0, 1))
+
+@pytest.mark.parametrize("shift", [(0, 0), (3, -2), (-9, 5)])
+def test_frame_change(shift):
+    previous, _ = _brightfield(0)
+    current, _  = _brightfield(0, shift)
+    found, residual = frame_change(previous, current)
+    assert found == shift
+    assert residual < 0.1
+
+def test_incremental_cells(monkeypatch):
+    calls = []
+    def backend(image, gpu, policy, scale):
+        calls.append(image)
+        return np.zeros(image.shape, dtype=np.int32)
+    monkeypatch.setitem(spotsInYeasts._cells_backends, 'counting', backend)
+
+    first, labels = _brightfield(1)
+    moved, truth  = _brightfield(1, (4, 6))
+    other, _      = _brightfield(2)
+    incremental   = IncrementalCells(0.2)
+    incremental.start(0)
+    incremental.update(first, labels)
+
+    reused, _ = spotsInYeasts.segment_transmission(moved, False, 2, 'counting', None, 1.0, incremental)
+    assert len(calls) == 0
+    assert np.array_equal(reused[8:-8, 8:-8], truth[8:-8, 8:-8])
+
+    spotsInYeasts.segment_transmission(other, False, 2, 'counting', None, 1.0, incremental)
+    assert len(calls) == 1
+    assert (incremental.reused, incremental.segmented) == (1, 2)
+
+    incremental.start(1) # Labels are never reused across positions.
+    spotsInYeasts.segment_transmission(other, False, 2, 'counting', None, 1.0, incremental)
+    assert len(calls) == 2
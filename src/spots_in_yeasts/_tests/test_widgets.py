@@ -1,6 +1,7 @@
 import pytest
 import napari
-from spots_in_yeasts._widget import SpotsInYeastsDock
+from spots_in_yeasts._widget import SpotsInYeastsDock, BackendsList, _global_settings
+from spots_in_yeasts.syntheticData import make_yeasts_field
 import numpy as np
 from tifffile import imread
 import os
@@ -16,7 +17,7 @@ def test_split_channels_shape(make_napari_viewer, capsys):
     """
     Tries to split images according to their shape.
     Compatible images have 2 channels, and optionaly some slices.
-    Hence their shape must have 3 or 4 elements (depending on the presence of slices)
+    Hence their shape must have 3 or 4 elements (depending on the presence of slices), or 5 for time-lapses (the displayed frame is processed).
     """
     viewer    = make_napari_viewer()
     my_widget = SpotsInYeastsDock(viewer)
@@ -25,7 +26,7 @@ def test_split_channels_shape(make_napari_viewer, capsys):
         ("hw_c1_s1_f1.tif" , False),
         ("hw_c1_s24_f1.tif", False),
         ("hw_c2_s12_f1.tif", True),
-        ("hw_c2_s6_f2.tif" , False)]
+        ("hw_c2_s6_f2.tif" , True)]
     
     for imp, expected in images:
         my_widget.clear_layers_gui()
@@ -90,4 +91,41 @@ def test_clear_layers_0(make_napari_viewer, capsys):
     my_widget = SpotsInYeastsDock(viewer)
     assert len(viewer.layers) == 0
     my_widget.clear_layers_gui()
-    assert len(viewer.layers) == 0
\ No newline at end of file
+    assert len(viewer.layers) == 0
+
+def _split_synthetic(viewer, widget):
+    field = make_yeasts_field((256, 256), n_slices=3, nuclei=False, seed=4)
+    viewer.add_image(field['hyperstack'], name="synthetic")
+    assert widget.split_channels_gui()
+
+
+def test_segment_cells_worker(make_napari_viewer, qtbot, monkeypatch):
+    """
+    The cells segmentation runs in a worker, and its layers are added once it is done.
+    """
+    monkeypatch.setitem(_global_settings, 'cells_backend', BackendsList.classical)
+    viewer    = make_napari_viewer()
+    my_widget = SpotsInYeastsDock(viewer)
+    _split_synthetic(viewer, my_widget)
+    assert my_widget.segment_brightfield_gui()
+    assert not my_widget.split_channels_gui() # Refused while the step is running.
+    qtbot.waitUntil(lambda: my_widget.worker is None, timeout=60000)
+    assert "labeled-cells" in viewer.layers
+    assert my_widget.last == 2
+
+
+def test_segment_cells_cancelled(make_napari_viewer, qtbot, monkeypatch):
+    """
+    A cancelled step leaves the layers and the state machine as they were before it started.
+    """
+    monkeypatch.setitem(_global_settings, 'cells_backend', BackendsList.classical)
+    viewer    = make_napari_viewer()
+    my_widget = SpotsInYeastsDock(viewer)
+    _split_synthetic(viewer, my_widget)
+    brightfield = my_widget.images["brightfield"]
+    assert my_widget.segment_brightfield_gui()
+    assert my_widget.cancel_step_gui()
+    qtbot.waitUntil(lambda: my_widget.worker is None, timeout=60000)
+    assert "labeled-cells" not in viewer.layers
+    assert my_widget.last == 1
+    assert my_widget.images["brightfield"] is brightfield
@@ -1,5 +1,4 @@
 import napari
-from tifffile import imread
 from datetime import datetime
 import numpy as np
 from skimage.segmentation import clear_border
@@ -7,12 +6,22 @@ from magicgui import magicgui, widgets
 from magicclass import magicclass
 from pathlib import Path
 from termcolor import colored
-import os, json, tempfile, time, subprocess, platform, sys
+import os, json, tempfile, time, subprocess, platform, sys, shutil
 from qtpy.QtWidgets import QToolBar, QWidget, QVBoxLayout
 from napari.qt.threading import thread_worker, create_worker
 from napari.utils import progress
-from spots_in_yeasts.spotsInYeasts import segment_transmission, segment_spots, distance_spot_nuclei, associate_spots_yeasts, create_reference_to, prepare_directory, write_labels_image, segment_nuclei
+from spots_in_yeasts.spotsInYeasts import segment_transmission, segment_spots, distance_spot_nuclei, spots_distances, associate_spots_yeasts, create_reference_to, prepare_directory, write_labels_image, label_centroids, segment_nuclei, DiameterPolicy, own_channel, segment_spots_3d, segment_spots_multiscale, refine_ownership
 from spots_in_yeasts.formatData import format_data_1844, format_data_1895
+from spots_in_yeasts.controlWriter import ControlWriter
+from spots_in_yeasts.resultsIndex import ResultsIndex, settings_hash, default_index_path
+from spots_in_yeasts.stagesProfiler import get_profiler, profiled, write_summary, reset_peak_rss, peak_rss
+from spots_in_yeasts.threadsScheduler import configure_threads, default_plan, load_plan
+from spots_in_yeasts.timeLapse import link_labels, follow_labels, IncrementalCells
+from spots_in_yeasts.pyramids import needs_pyramid, build_pyramid
+from spots_in_yeasts.cancellation import get_token, Cancelled
+from spots_in_yeasts.summaries import BatchSummary, count_labels
+from spots_in_yeasts.spotsTable import categories as spots_categories
+from spots_in_yeasts.imageReaders import list_items, read_item, item_name, item_exists, parse_channels_order, channel_views
 from enum import Enum, auto
 from typing import Annotated, Literal
 
@@ -29,6 +38,9 @@ _seg_ori = "raw-segmentation"
 _seg_nuc = "nuclei-refined"
 _seg_spt = "spots-refined"
 
+# Color of the spots in the viewer, indexed by the code of their category (see `spotsTable.categories`).
+_category_colors = np.array([{'NUCLEAR': '#eb4034', 'PERIPHERAL': '#fcba03'}.get(c, '#4287f5') for c in spots_categories])
+
 class FormatsList(Enum):
     format_1844 = auto()
     format_1895 = auto()
@@ -36,6 +48,13 @@ class FormatsList(Enum):
 def default_export():
     return FormatsList.format_1844
 
+class BackendsList(Enum):
+    cellpose  = auto()
+    classical = auto()
+
+def default_backend():
+    return BackendsList.cellpose
+
 _global_settings = {
     'gaussian_radius'    : 3.0,                    # Radius of the Gaussian filter applied to the spots layer before detection.
     'neighbour_slices'   : 2,                      # Number of slices taken around the focus slice (in the case of a stack).
@@ -46,10 +65,39 @@ _global_settings = {
     'death_threshold'    : int(65535/2),           # Intensity threshold above which a cell is considered dead.
     'cover_threshold'    : 0.75,                   # The percentage of a cell that must be covered by a nucleus for it to be considered dead.
     'threshold_rel'      : 0.5,                    # Intensity shift required (relative to the max intensity in the image) to consider that a fluctuation is actually a spot.
+    'spots_3d'           : False,                  # Detect spots in 3D on the slices around the focus (instead of the max projection), and measure their depth.
+    'scales_count'       : 1,                      # Number of sigmas tried by the multi-scale detection (1: single sigma, the `gaussian_radius`). Ignored in 3D.
+    'sigma_min'          : 1.0,                    # Smallest sigma of the multi-scale detection.
+    'sigma_max'          : 4.0,                    # Largest sigma of the multi-scale detection.
+    'subpixel'           : False,                  # Refine the location of spots by fitting a Gaussian on each of them.
+    'fit_radius'         : 3,                      # Half-size (in pixels) of the patch on which the Gaussian of a spot is fitted.
+    'spots_distances'    : False,                  # Measure the distance from each spot to its nucleus and to its cell's membrane.
     'area_threshold_down': 15,
-    'export_mode'        : FormatsList.format_1844 # Format used to create the exported CSV file.
+    'export_mode'        : FormatsList.format_1844, # Format used to create the exported CSV file.
+    'channels_order'     : "Spots, Brightfield, Nuclei", # Names of the channels of the images, in order ('-' for a channel to ignore).
+    'cells_backend'      : BackendsList.cellpose,   # Method segmenting cells from the brightfield ('classical' is much faster on CPU, see `backendsAgreement`).
+    'cells_diameter'     : 0.0,                     # Diameter of cells (in pixels) given to Cellpose. If 0, it is estimated.
+    'diameter_estimates' : 3,                       # In batch mode, number of images on which the diameter is estimated before their median is reused.
+    'cellpose_scale'     : 1.0,                     # Factor by which the brightfield is downscaled before Cellpose's inference (1.0: full resolution).
+    'reuse_threshold'    : 0.0,                     # In time-lapses, maximal change of the brightfield (registered RMS difference, in std) for the previous cells to be reused (0: always segment).
+    'control_compression': 'zlib',                  # Lossless compression of the control TIFFs ('zlib', 'zstd' or None).
+    'writer_threads'     : 2,                       # Number of background threads writing control folders in batch mode.
+    'cpu_cores'          : 0,                       # Number of cores shared between the stages in batch mode (0: all of them). See `threadsScheduler`.
+    'writer_queue'       : 16,                      # Maximum number of control files waiting to be written.
+    'results_index'      : True,                    # Fill the SQLite results index of the export folder in batch mode.
+    'profiling'          : False,                   # Record the time and memory used by each step in batch mode.
+    'profile_memory'     : True,                    # Measure the peak of memory of each step (slows down pure-Python steps).
+    'memory_budget'      : False,                   # In batch mode, release intermediate images as soon as they are not needed anymore, and print the peak RSS of each image.
+    'pyramid_threshold'  : 4096,                    # Longest side (in pixels) above which layers are shown as multiscale pyramids, whose levels are cached in control folders (0: never).
+    'batch_summary'      : True                     # Write per-image and per-batch summary tables next to the batch results.
 }
 
+# Settings that don't change the results, and are left out of the settings hash.
+_io_settings = {'control_compression', 'writer_threads', 'cpu_cores', 'writer_queue', 'results_index', 'profiling', 'profile_memory', 'memory_budget', 'pyramid_threshold', 'batch_summary'}
+
+def _settings_hash():
+    return settings_hash(_global_settings, _io_settings)
+
 @magicclass
 class SpotsInYeastsDock:
 
@@ -79,12 +127,40 @@ class SpotsInYeastsDock:
         self.csvtable   = None
         # Export path, only for batch mode
         self.csvexport  = ""
-        # Dictionary containing for each cell's label, the list of spots it owns
+        # Table of the spots, giving for each cell's label the spots it owns (see `SpotsTable`)
         self.ownership  = {}
         # Dictionary containing the different versions of segmented cells, as they refined along operations.
         self.cells      = {_seg_ori: None, _seg_nuc: None, _seg_spt: None}
+        # Centroids of the cells found by the cells segmentation (see `label_centroids`), reused to write their indices.
+        self.centroids  = None
+        # Index, in the original stack, of the first slice kept in the spots channel (only the slices around the focus are kept in the memory-budget mode).
+        self.z_offset   = 0
         # Index of the last operation performed successfully.
         self.last       = 0
+        # Background writer of control folders, only in batch mode.
+        self.writer     = None
+        # SQLite index receiving the results, only in batch mode.
+        self.index      = None
+        # Policy providing the cells diameter to Cellpose (shared by all the images of a batch).
+        self.diameters  = None
+        # (position, frame) of the current item if it comes from a time-lapse or multi-position file, None otherwise.
+        self.frame      = None
+        # Name of the reader opening the current item (see `imageReaders`).
+        self.reader     = None
+        # Last labeled cells and next free label of the position being processed, to link cells across frames.
+        self.tracks     = {}
+        # Reuse of the cells segmentation across the frames of a time-lapse, only in batch mode.
+        self.reuse      = None
+        # Worker running the current interactive step (None if no step is running).
+        self.worker     = None
+        # Viewer updates queued by the step running in a worker, applied once it is done (None if no step is running).
+        self.pending    = None
+        # Whether the user cancelled the running interactive step.
+        self.cancelled  = False
+        # Number of cells found or removed by each stage on the current item (see `summaries`).
+        self.counts     = {}
+        # Per-image and per-batch summaries, only in batch mode.
+        self.summary    = None
 
     def _clear_state(self):
         self.viewer.layers.clear()
@@ -101,7 +177,16 @@ class SpotsInYeastsDock:
         self.csvexport  = ""
         self.ownership  = {}
         self.cells      = {_seg_ori: None, _seg_nuc: None, _seg_spt: None}
+        self.centroids  = None
+        self.z_offset   = 0
         self.last       = 0
+        self.diameters  = None
+        self.frame      = None
+        self.reader     = None
+        self.tracks     = {}
+        self.reuse      = None
+        self.counts     = {}
+        self.summary    = None
     
     def _clear_data(self):
         self.viewer.layers.clear()
@@ -112,7 +197,10 @@ class SpotsInYeastsDock:
         self.name       = ""
         self.ownership  = {}
         self.cells      = {_seg_ori: None, _seg_nuc: None, _seg_spt: None}
+        self.centroids  = None
+        self.z_offset   = 0
         self.last       = 0
+        self.counts     = {}
         
     def _is_batch(self):
         return self.batch
@@ -121,6 +209,20 @@ class SpotsInYeastsDock:
         print(f"Batch mode: {('ON' if val else 'OFF')}")
         self.batch = val
 
+    def _budget(self):
+        # In the memory-budget mode, the widget owns the images of the current item: they are modified in place and released as soon as possible.
+        return self._is_batch() and _global_settings['memory_budget']
+
+    def _release_item(self):
+        # Drops everything computed on the current item (the control writer keeps what it still has to write).
+        self.images     = {}
+        self.spots_data = None
+        self.spots_clr  = None
+        self.ownership  = {}
+        self.cells      = {_seg_ori: None, _seg_nuc: None, _seg_spt: None}
+        self.centroids  = None
+        self.z_offset   = 0
+
     def _set_ownership(self, ownership):
         self.ownership = ownership
 
@@ -134,10 +236,18 @@ class SpotsInYeastsDock:
         if self.batch:
             return
 
+        if self.pending is not None: # Layers can only be modified from the main thread.
+            self.pending.append(lambda: self._show_spots(spots, colors))
+            return
+
+        self._show_spots(spots, colors)
+
+    def _show_spots(self, spots, colors=None):
+
         if _spots in self._current_viewer().layers:
             self._current_viewer().layers[_spots].data = spots
         else:
-            self._current_viewer().add_points(self.spots_data, name=_spots)
+            self._current_viewer().add_points(spots, name=_spots)
         
         if colors:
             self._current_viewer().layers[_spots].face_color = '#00000000'
@@ -152,9 +262,25 @@ class SpotsInYeastsDock:
         
         if self._is_batch():
             return 
-        
-        if key in self._current_viewer().layers:
-            self._current_viewer().layers[key].data = data
+
+        if self.pending is not None: # Layers can only be modified from the main thread.
+            self.pending.append(lambda: self._show_image(key, data, args, aslabels, ctr))
+            return
+
+        self._show_image(key, data, args, aslabels, ctr)
+
+    def _show_image(self, key, data, args={}, aslabels=False, ctr=0):
+        # Large images are displayed as pyramids, only the full resolution is kept in `self.images`.
+        if needs_pyramid(np.shape(data), _global_settings['pyramid_threshold']):
+            data = build_pyramid(data, aslabels)
+            args = dict(args, multiscale=True)
+
+        layers = self._current_viewer().layers
+        if (key in layers) and (layers[key].multiscale != isinstance(data, list)):
+            layers.remove(key)
+
+        if key in layers:
+            layers[key].data = data
         else:
             if aslabels:
                 self._current_viewer().add_labels(
@@ -211,10 +337,13 @@ class SpotsInYeastsDock:
             return False
         
         while len(self.queue) > 0:
-            item = self.queue.pop(0)
-            if os.path.isfile(item):
-                self.current = item
-                self._set_current_name(item.split(os.sep)[-1].split('.')[0])
+            reader, source, position, frame = self.queue.pop(0)
+            if item_exists(reader, source):
+                self.current = source
+                self.reader  = reader
+                self.frame   = None if (frame is None) else (position, frame)
+                self.counts  = {}
+                self._set_current_name(item_name(reader, source, position, frame))
                 prepare_directory(self._get_export_path())
                 return True
         
@@ -223,7 +352,9 @@ class SpotsInYeastsDock:
     # Loads the image stored in "self.current" in Napari.
     # A safety check ensures that several images can't be loaded simulteanously
     def _load(self):
-        hyperstack = np.array(imread(str(self.current)))
+        # Only the current frame is read from time-lapses.
+        position, frame = (None, None) if (self.frame is None) else self.frame
+        hyperstack = read_item(self.reader, str(self.current), position, frame)
 
         if hyperstack is None:
             print(colored(f"Failed to open: `{str(self.current)}`.", 'red'))
@@ -242,13 +373,97 @@ class SpotsInYeastsDock:
         self._init_queue_()
 
     def _init_queue_(self):
+        files = []
         if os.path.isdir(self.path):
-            self.queue = [os.path.join(self.path, i) for i in os.listdir(self.path) if i.lower().endswith('.tif')]
+            files = [os.path.join(self.path, i) for i in sorted(os.listdir(self.path))]
         
         if os.path.isfile(self.path):
-            self.queue = [self.path] if self.path.lower().endswith('.tif') else []
+            files = [self.path]
+
+        # Series are grouped, and time-lapses or multi-position files are split in one item per (position, frame).
+        self.queue = list_items(files)
+        print(f"{len(self.queue)} images found.")
 
-        print(f"{len(self.queue)} files found.")
+    def _busy(self):
+        if self.worker is None:
+            return False
+        print(colored("A step is still running. Wait for it to end, or cancel it.", 'red'))
+        return True
+
+    def _snapshot(self):
+        # State that an interactive step may modify, restored if the step is cancelled or fails.
+        return {
+            'images'    : dict(self.images),
+            'cells'     : dict(self.cells),
+            'centroids' : self.centroids,
+            'spots_data': self.spots_data,
+            'spots_clr' : self.spots_clr,
+            'ownership' : self.ownership,
+            'diameters' : self.diameters,
+            'counts'    : dict(self.counts),
+            'last'      : self.last
+        }
+
+    def _restore(self, snapshot):
+        self.images     = snapshot['images']
+        self.cells      = snapshot['cells']
+        self.centroids  = snapshot['centroids']
+        self.spots_data = snapshot['spots_data']
+        self.spots_clr  = snapshot['spots_clr']
+        self.ownership  = snapshot['ownership']
+        self.diameters  = snapshot['diameters']
+        self.counts     = snapshot['counts']
+        self.last       = snapshot['last']
+
+    def _launch(self, step, descr):
+        """
+        Runs an interactive step in a worker thread, so the viewer stays responsive.
+        The step's changes to the layers are queued and applied when it ends, unless it was cancelled or failed, in which case the state of the widget is restored.
+        """
+        if self._is_batch():
+            print(colored("A batch is running.", 'red'))
+            return False
+        if self._busy():
+            return False
+
+        snapshot       = self._snapshot()
+        self.pending   = []
+        self.cancelled = False
+        get_token().reset()
+        outcome        = {'success': False}
+        self.worker    = create_worker(step, _progress={'desc': descr})
+        # `returned` is not emitted by a worker asked to quit, but `finished` always is.
+        self.worker.returned.connect(lambda success: outcome.update(success=success))
+        self.worker.finished.connect(lambda: self._step_done(descr, outcome['success'], snapshot))
+        self.worker.start()
+        return True
+
+    def _step_done(self, descr, success, snapshot):
+        # Called in the main thread once the worker of a step ended.
+        pending, self.pending = self.pending, None
+        self.worker = None
+
+        if self.cancelled or not success:
+            self._restore(snapshot)
+            if self.cancelled:
+                print(colored(f"`{descr}` cancelled.", 'yellow'))
+            return
+
+        for update in pending:
+            update()
+
+    def _link_cells(self, labeled, nuclei=None):
+        # Positions are processed one after the other, so only the last frame of the current position is kept.
+        # Must be called on the final labels of the cells (the nuclei step renumbers them). Nuclei have the label of their cell: they follow it.
+        key = (str(self.current), self.frame[0])
+        if key not in self.tracks:
+            self.tracks = {}
+        previous, next_label = self.tracks.get(key, (None, 1))
+        linked, next_label   = link_labels(previous, labeled, next_label)
+        self.tracks[key] = (np.copy(linked), next_label)
+        if nuclei is None:
+            return linked
+        return linked, follow_labels(labeled, linked, nuclei)
 
 
     @magicgui(
@@ -262,8 +477,21 @@ class SpotsInYeastsDock:
         area_threshold_down = {'label': "Spot area min (pxl)"},
         area_threshold_up   = {'label': "Spot area max (pxl)"},
         export_mode         = {'label': "Export format"},
+        channels_order      = {'label': "Channels order"},
+        cells_backend       = {'label': "Cells segmentation"},
+        cells_diameter      = {'label': "Cells diameter (0: auto)", 'min': 0.0},
+        diameter_estimates  = {'label': "Diameter estimations", 'min': 1},
+        cellpose_scale      = {'label': "Cellpose scale", 'min': 0.1, 'max': 1.0, 'step': 0.05},
+        reuse_threshold     = {'label': "Frames reuse threshold", 'min': 0.0, 'max': 2.0, 'step': 0.01},
         neighbour_slices    = {'label': "Slices around focus", 'min': 0},
-        peak_distance       = {'label': "Min spots distance (pxl)", 'min': 0})
+        peak_distance       = {'label': "Min spots distance (pxl)", 'min': 0},
+        spots_3d            = {'label': "3D spots detection"},
+        scales_count        = {'label': "Spots scales", 'min': 1, 'max': 16},
+        sigma_min           = {'label': "Min spots sigma (pxl)", 'min': 0.5},
+        sigma_max           = {'label': "Max spots sigma (pxl)", 'min': 0.5},
+        subpixel            = {'label': "Sub-pixel locations"},
+        fit_radius          = {'label': "Fit radius (pxl)", 'min': 1},
+        spots_distances     = {'label': "Spots distances"})
     def apply_settings_gui(
         self, 
         neighbour_slices: int=_global_settings['neighbour_slices'],
@@ -278,7 +506,20 @@ class SpotsInYeastsDock:
         extent_threshold   : float=_global_settings['extent_threshold'], 
         solidity_threshold : float=_global_settings['solidity_threshold'], 
         threshold_rel      : float=_global_settings['threshold_rel'],
-        export_mode        : FormatsList=default_export()):
+        spots_3d           : bool=_global_settings['spots_3d'],
+        scales_count       : int=_global_settings['scales_count'],
+        sigma_min          : float=_global_settings['sigma_min'],
+        sigma_max          : float=_global_settings['sigma_max'],
+        subpixel           : bool=_global_settings['subpixel'],
+        fit_radius         : int=_global_settings['fit_radius'],
+        spots_distances    : bool=_global_settings['spots_distances'],
+        export_mode        : FormatsList=default_export(),
+        channels_order     : str=_global_settings['channels_order'],
+        cells_backend      : BackendsList=default_backend(),
+        cells_diameter     : float=_global_settings['cells_diameter'],
+        diameter_estimates : int=_global_settings['diameter_estimates'],
+        cellpose_scale     : float=_global_settings['cellpose_scale'],
+        reuse_threshold    : float=_global_settings['reuse_threshold']):
         
         global _global_settings
 
@@ -289,16 +530,31 @@ class SpotsInYeastsDock:
         _global_settings['extent_threshold']    = extent_threshold
         _global_settings['solidity_threshold']  = solidity_threshold
         _global_settings['export_mode']         = export_mode
+        _global_settings['channels_order']      = channels_order
         _global_settings['death_threshold']     = death_threshold
         _global_settings['cover_threshold']     = cover_threshold
         _global_settings['threshold_rel']       = threshold_rel
         _global_settings['area_threshold_down'] = area_threshold_down
+        _global_settings['spots_3d']            = spots_3d
+        _global_settings['scales_count']        = scales_count
+        _global_settings['sigma_min']           = sigma_min
+        _global_settings['sigma_max']           = sigma_max
+        _global_settings['subpixel']            = subpixel
+        _global_settings['fit_radius']          = fit_radius
+        _global_settings['spots_distances']     = spots_distances
+        _global_settings['cells_backend']       = cells_backend
+        _global_settings['cells_diameter']      = cells_diameter
+        _global_settings['diameter_estimates']  = diameter_estimates
+        _global_settings['cellpose_scale']      = cellpose_scale
+        _global_settings['reuse_threshold']     = reuse_threshold
 
     @magicgui(call_button="Clear layers")
     def clear_layers_gui(self):
         """
         Removes all the layers currently present in the Napari's viewer, and resets the state machine used by the scipt.
         """
+        if self._busy():
+            return False
         self._clear_state()
         self.last = 0
         return True
@@ -306,6 +562,9 @@ class SpotsInYeastsDock:
 
     @magicgui(call_button="Split channels")
     def split_channels_gui(self):
+
+        if self._busy():
+            return False
         
         nImages = len(self._current_viewer().layers) # We want a unique layer to work with.
 
@@ -321,28 +580,40 @@ class SpotsInYeastsDock:
         imIn = self._get_image(self._get_current_name()) if self._is_batch() else self._current_viewer().layers[0].data
         imSp = imIn.shape
 
+        # (5, 9, 2, 2048, 2048) -> frames, slices, channels, height, width
+        # Only the frame displayed is processed, the batch mode streams every frame.
+        t_index = None
+        if (len(imSp) == 5) and not self._is_batch():
+            t_index = self._current_viewer().dims.current_step[0]
+            imIn    = np.asarray(imIn[t_index])
+            imSp    = imIn.shape
+
         # (2, 2048, 2048) -> channels, height, width
         # (9, 2, 2048, 2048) -> slices, channels, height, width
         if len(imSp) not in [3, 4]:
-            print(colored(f"Images must have 3 or 4 dimensions. {len(imSp)} found.", 'red'))
+            print(colored(f"Images must have 3, 4 or 5 dimensions. {len(imSp)} found.", 'red'))
             return False
 
-        axis      = 0 if (len(imSp) == 3) else 1 # If we have slices or not
-        nChannels = imSp[axis]
-
-        if nChannels not in {2, 3}:
-            print(colored(f"Either 2 or 3 channels are expected. {nChannels} found.", 'red'))
+        # Views on the channels, according to the order given by the user.
+        try:
+            channels = channel_views(imIn, parse_channels_order(_global_settings['channels_order']))
+        except ValueError as e:
+            print(colored(str(e), 'red'))
             return False
         
         if not self._is_batch():
-            self._set_current_name(self._current_viewer().layers[0].name)
+            self._set_current_name(self._current_viewer().layers[0].name + ("" if (t_index is None) else f"-t{t_index}"))
             self._current_viewer().layers.clear()
 
-        if nChannels == 2:
-            s, t = np.split(imIn, indices_or_sections=2, axis=axis)
-            n = None
-        else:
-            s, t, n = np.split(imIn, indices_or_sections=3, axis=axis)
+        s, t, n = channels['Spots'], channels['Brightfield'], channels['Nuclei']
+        self.z_offset = 0
+        if self._budget(): # Only what the next steps read is copied out of the raw hyperstack, which is freed right away.
+            del self.images[self._get_current_name()]
+            around           = _global_settings['neighbour_slices']
+            s, self.z_offset = own_channel(s, around if _global_settings['spots_3d'] else None)
+            t, _             = own_channel(t, around)
+            n, _             = (None, 0) if (n is None) else own_channel(n)
+            del imIn, channels
         
         if n is not None:
             self._set_image(_nuclei, np.squeeze(n), {
@@ -368,6 +639,9 @@ class SpotsInYeastsDock:
 
     @magicgui(call_button="Segment cells")
     def segment_brightfield_gui(self):
+        return self._launch(self._segment_brightfield, "Segment cells")
+
+    def _segment_brightfield(self):
         
         if self.last not in {1, 2}:
             print(colored("You should split your channels first.", 'red'))
@@ -379,8 +653,28 @@ class SpotsInYeastsDock:
             return False
 
         start = time.time()
-        labeled, projection = segment_transmission(self._get_image(_bf), True, _global_settings['neighbour_slices'])
-        indices = write_labels_image(labeled, 0.75)
+        if (not self._is_batch()) or (self.diameters is None):
+            self.diameters = DiameterPolicy(_global_settings['cells_diameter'])
+        self.diameters.last = None
+        incremental = None
+        if (self.reuse is not None) and (self.frame is not None):
+            incremental = self.reuse
+            incremental.start((str(self.current), self.frame[0]))
+        labeled, projection = segment_transmission(
+            self._get_image(_bf), 
+            True, 
+            _global_settings['neighbour_slices'], 
+            _global_settings['cells_backend'].name, 
+            self.diameters,
+            _global_settings['cellpose_scale'],
+            incremental
+        )
+        if (incremental is not None) and (incremental.last is not None):
+            (dy, dx), residual = incremental.last
+            reused = residual <= incremental.threshold
+            print(f"Frame change: shift ({dy}, {dx}), residual {round(residual, 3)}" + (", cells reused." if reused else "."))
+        if (self.frame is not None) and not self._required_key(_nuclei): # Cells keep their label across the frames of a time-lapse (linked after the nuclei step otherwise).
+            labeled = self._link_cells(labeled)
         
         self._set_image(_bf, projection) # Replacing stack by projection.
         
@@ -391,11 +685,14 @@ class SpotsInYeastsDock:
         4)
 
         self.cells[_seg_ori] = labeled # Image with every single cell that could possibly be detected.
+        self.counts = {'cells-segmented': count_labels(labeled)}
 
-        self._set_image(_n_cells, indices, {
-            'visible': False,
-            'blending': "additive"
-        })
+        if not self._is_batch(): # In batch mode, the indices are only written for the control (see `_create_control`).
+            self.centroids = label_centroids(labeled)
+            self._set_image(_n_cells, write_labels_image(labeled, 0.75, self.centroids), {
+                'visible': False,
+                'blending': "additive"
+            })
         
         print(colored(f"Segmented cells from `{self._get_current_name()}` in {round(time.time()-start, 1)}s.", 'green'))
         self.last = 2
@@ -404,6 +701,9 @@ class SpotsInYeastsDock:
 
     @magicgui(call_button="Segment nuclei")
     def segment_nuclei_gui(self):
+        return self._launch(self._segment_nuclei, "Segment nuclei")
+
+    def _segment_nuclei(self):
 
         if self.last not in {2, 3}:
             print(colored("The previous operation realized should be the cells segmentation.", 'red'))
@@ -426,14 +726,22 @@ class SpotsInYeastsDock:
         flattened_nuclei, labeled_yeasts, labeled_nuclei = segment_nuclei(
             self.cells[_seg_ori], 
             self._get_image(_nuclei), 
-            _global_settings['cover_threshold']
+            _global_settings['cover_threshold'],
+            not self._budget()
         )
 
         # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+        if self.frame is not None: # Cells keep their label across the frames of a time-lapse.
+            labeled_yeasts, labeled_nuclei = self._link_cells(labeled_yeasts, labeled_nuclei)
         
         self._set_image(_nuclei, flattened_nuclei)
 
         self.cells[_seg_nuc] = labeled_yeasts
+        if 'cells-segmented' in self.counts:
+            self.counts['cells-dead-nuclei'] = self.counts['cells-segmented'] - count_labels(labeled_yeasts)
+        if self._budget(): # Modified in place by the nuclei segmentation.
+            self.cells[_seg_ori] = None
 
         self._set_image(_lbl_c, labeled_yeasts, {
             'blending': "additive"
@@ -453,6 +761,9 @@ class SpotsInYeastsDock:
 
     @magicgui(call_button="Segment spots")
     def segment_spots_gui(self):
+        return self._launch(self._segment_spots, "Segment spots")
+
+    def _segment_spots(self):
 
         if self.last not in {2, 3, 4}:
             print(colored("The previous operation realized should be the cells or nuclei segmentation.", 'red'))
@@ -471,16 +782,46 @@ class SpotsInYeastsDock:
         start = time.time()
         
         labeled_cells = self.cells[_seg_ori] if (self.cells[_seg_nuc] is None) else self.cells[_seg_nuc]
-        labeled_cells = clear_border(labeled_cells)
-
-        spots_locations, labeled_spots, f_spots = segment_spots(
-            self._get_image(_f_spots), 
-            labeled_cells,
-            _global_settings['death_threshold'],
-            _global_settings['gaussian_radius'], 
-            _global_settings['peak_distance'],
-            _global_settings['threshold_rel']
-            )
+        # Without the nuclei step, cells were only removed since the cells segmentation: their centroids are still valid.
+        centroids     = self.centroids if (self.cells[_seg_nuc] is None) else None
+        n_cells = count_labels(labeled_cells)
+        if self._budget(): # The border is cleared in place, nothing uses the previous versions anymore.
+            labeled_cells = clear_border(labeled_cells, out=labeled_cells)
+            self.cells    = {_seg_ori: None, _seg_nuc: None, _seg_spt: None}
+        else:
+            labeled_cells = clear_border(labeled_cells)
+        n_border = count_labels(labeled_cells)
+
+        measures = {}
+        if _global_settings['spots_3d']:
+            spots_locations, labeled_spots, f_spots, measures['z'] = segment_spots_3d(
+                self._get_image(_f_spots), 
+                labeled_cells,
+                _global_settings['death_threshold'],
+                _global_settings['gaussian_radius'], 
+                _global_settings['peak_distance'],
+                _global_settings['threshold_rel'],
+                _global_settings['neighbour_slices']
+                )
+            measures['z'] = {l: z + self.z_offset for l, z in measures['z'].items()} # Depths in the original stack.
+        elif _global_settings['scales_count'] > 1:
+            spots_locations, labeled_spots, f_spots, measures['sigma'] = segment_spots_multiscale(
+                self._get_image(_f_spots), 
+                labeled_cells,
+                _global_settings['death_threshold'],
+                np.geomspace(_global_settings['sigma_min'], _global_settings['sigma_max'], _global_settings['scales_count']),
+                _global_settings['peak_distance'],
+                _global_settings['threshold_rel']
+                )
+        else:
+            spots_locations, labeled_spots, f_spots = segment_spots(
+                self._get_image(_f_spots), 
+                labeled_cells,
+                _global_settings['death_threshold'],
+                _global_settings['gaussian_radius'], 
+                _global_settings['peak_distance'],
+                _global_settings['threshold_rel']
+                )
         
         self._set_image(_lbl_c, labeled_cells, {
             'blending': "additive"
@@ -495,19 +836,22 @@ class SpotsInYeastsDock:
         else:
             categories = None
 
-        # `ow` gives for each cell a list of spots properties.
-        ow, spots_locations, labeled_spots = associate_spots_yeasts(labeled_cells, labeled_spots, f_spots, _global_settings['area_threshold_down'], _global_settings['area_threshold_up'], _global_settings['solidity_threshold'], _global_settings['extent_threshold'], categories)
+        if _global_settings['spots_distances']:
+            nuclei = self._get_image(_lbl_n) if self._required_key(_lbl_n) else None
+            measures.update(spots_distances(labeled_cells, nuclei, labeled_spots, spots_locations))
+
+        # `ow` is the table of the spots, sorted by owning cell (see `SpotsTable`).
+        n_alive = count_labels(labeled_cells) # Dead cells were removed by the detection.
+        self.counts['cells-border']         = n_cells - n_border
+        self.counts['cells-dead-intensity'] = n_border - n_alive
+        self.counts.setdefault('cells-dead-nuclei', 0) # No nuclei channel.
+        ow, spots_locations, labeled_spots = associate_spots_yeasts(labeled_cells, labeled_spots, f_spots, _global_settings['area_threshold_down'], _global_settings['area_threshold_up'], _global_settings['solidity_threshold'], _global_settings['extent_threshold'], categories, measures)
+        if _global_settings['subpixel']:
+            refine_ownership(ow, f_spots, _global_settings['fit_radius'])
         self._set_ownership(ow)
 
         if self._required_key(_lbl_n): # If we have nuclei, we can classify spots.
-            colors = []
-            for l, c in spots_locations:
-                if categories[labeled_spots[l, c]] == 'NUCLEAR':
-                    colors.append('#eb4034')
-                elif categories[labeled_spots[l, c]] == 'PERIPHERAL':
-                    colors.append('#fcba03')
-                else:
-                    colors.append('#4287f5')
+            colors = _category_colors[ow.records['category']].tolist()
         else:
             colors = None
 
@@ -517,20 +861,37 @@ class SpotsInYeastsDock:
         },
         True)
 
-        indices = write_labels_image(labeled_cells, 0.75)
-
-        self._set_image(_n_cells, indices, {
-            'visible': False,
-            'blending': "additive"
-        })
+        if not self._is_batch():
+            self._set_image(_n_cells, write_labels_image(labeled_cells, 0.75, centroids), {
+                'visible': False,
+                'blending': "additive"
+            })
         
         print(colored(f"Segmented spots from `{self._get_current_name()}` in {round(time.time()-start, 1)}s.", 'green'))
         return True
 
 
+    @magicgui(call_button="Cancel step")
+    def cancel_step_gui(self):
+        """
+        Cancels the running interactive step. Its results are dropped, and the layers are left as they were before it started.
+        """
+        if self.worker is None:
+            print(colored("No step is running.", 'yellow'))
+            return False
+        self.cancelled = True
+        get_token().cancel() # The step stops at its next check (see `cancellation`).
+        self.worker.quit()
+        print(colored("Cancelling... The layers will be restored as soon as the current operation ends.", 'yellow'))
+        return True
+
+
     @magicgui(call_button="Extract stats")
     def extract_stats_gui(self):
 
+        if self._busy():
+            return False
+
         if not self._required_key(_lbl_c):
             print(colored("Cells segmentation not available yet.", 'yellow'))
             return False
@@ -554,7 +915,10 @@ class SpotsInYeastsDock:
             self.csvtable = format_data_1895(ow, self._get_current_name(), self.csvtable)
 
         try:
-            self.csvtable.exportTo(measures_path)
+            if self._is_batch(): # Rows are written image after image, and not kept in memory.
+                self.csvtable.appendTo(measures_path)
+            else:
+                self.csvtable.exportTo(measures_path)
         except:
             print(colored("Failed to export measures to: ", 'red'), end="")
             print(colored(measures_path,'red', attrs=['underline']))
@@ -563,6 +927,18 @@ class SpotsInYeastsDock:
             print(colored("Spots exported to: ", 'green'), end="")
             print(colored(measures_path,'green', attrs=['underline']))
 
+            if self.summary is not None:
+                self.summary.add(ow, self._get_current_name(), self.counts)
+
+            if self.index is not None:
+                self.index.add_image(
+                    self._get_current_name(), 
+                    str(self._current_image()), 
+                    self._get_export_path(), 
+                    ow, 
+                    _settings_hash()
+                )
+
             if not self._is_batch():
                 if platform.system() == 'Windows':
                     os.startfile(measures_path)
@@ -586,47 +962,150 @@ class SpotsInYeastsDock:
             self._get_path(),          # source_path
             self._get_image(_bf),      # projection_cells
             self._get_image(_f_spots), # projection_spots
-            self._get_image(_n_cells), # indices
+            self._cells_indices(),     # indices
             self._get_image(_lbl_n),   # labeled_nuclei
             self._get_image(_nuclei),  # nuclei_fluo
-            self.spots_clr             # spots_colors
+            self.spots_clr,            # spots_colors
+            self.writer,               # writer
+            _settings_hash(),
+            self._get_diameter()
         )
         return True
 
+    def _cells_indices(self):
+        # In batch mode, the indices are only written here, when the control needs them.
+        if self._is_batch():
+            return write_labels_image(self._get_image(_lbl_c), 0.75)
+        return self._get_image(_n_cells)
+
+    def _get_diameter(self):
+        if (self.diameters is None) or (self.diameters.last is None):
+            return None
+        return (self.diameters.last, self.diameters.source())
+
+    def _close_writer(self):
+        if self.writer is None:
+            return
+        print("Waiting for control folders to be written...")
+        failures = self.writer.close()
+        self.writer = None
+        if len(failures) > 0:
+            print(colored(f"{len(failures)} control files failed to be written.", 'red'))
+
+    def _close_index(self):
+        if self.index is None:
+            return
+        self.index.close()
+        self.index = None
+
+    def _abort_item(self):
+        # The control folder of a cancelled item is removed: nothing was exported for it yet.
+        shutil.rmtree(self._get_export_path(), ignore_errors=True)
+        self._release_item()
+        print(colored(f"Stopped while processing `{self._get_current_name()}`, nothing was exported for it.", 'yellow'))
+
     def _batch_folder_worker(self, input_folder, output_folder, nElements):
         exec_start = time.time()
         iteration = 0
         procedure = [
             (self._load, "Loading image"),
             (self.split_channels_gui, "Splitting channels"),
-            (self.segment_brightfield_gui, "Segment cells"),
-            (self.segment_nuclei_gui, "Segment nuclei"),
-            (self.segment_spots_gui, "Segment spots"),
+            (self._segment_brightfield, "Segment cells"),
+            (self._segment_nuclei, "Segment nuclei"),
+            (self._segment_spots, "Segment spots"),
             (self.extract_stats_gui, "Statistics extraction"),
             (self._create_control, "Control creation")
         ]
         now = datetime.now()
         date_time_string = now.strftime("%Y-%m-%d-%H-%M-%S")
         self.csvexport   = os.path.join(self.e_path, f"batch-results-{date_time_string}.csv")
+        if _global_settings['batch_summary']:
+            self.summary = BatchSummary(
+                os.path.join(self.e_path, f"batch-images-{date_time_string}.csv"),
+                os.path.join(self.e_path, f"batch-summary-{date_time_string}.csv")
+            )
+        plan = load_plan(n_cores=_global_settings['cpu_cores']) or default_plan(_global_settings['cpu_cores'], _global_settings['writer_threads'])
+        configure_threads(plan)
+        self.writer      = ControlWriter(
+            plan['writer'], 
+            _global_settings['writer_queue'], 
+            _global_settings['control_compression'],
+            _global_settings['pyramid_threshold']
+        )
+        if _global_settings['results_index']:
+            self.index = ResultsIndex(default_index_path(self.e_path))
+        self.diameters = DiameterPolicy(_global_settings['cells_diameter'], _global_settings['diameter_estimates'])
+        if _global_settings['reuse_threshold'] > 0:
+            self.reuse = IncrementalCells(_global_settings['reuse_threshold'])
+        profiler = get_profiler()
+        if _global_settings['profiling']:
+            profiler.start(os.path.join(self.e_path, f"batch-profile-{date_time_string}.jsonl"), _global_settings['profile_memory'])
+
+        budget = _global_settings['memory_budget']
+
+        token   = get_token()
+        stopped = False
+        token.reset()
 
         while self._next_item():
-            for i, (step, descr) in enumerate(procedure):
-                print(f"Executing step `{descr}` ({i})")
-                if not step():
-                    print(colored(f"Failed step: `{descr}` ", 'red'), end="")
-                    print(colored(f"({self._get_current_name()})", 'red', attrs=['underline']), end="")
-                    print(colored(".", 'red'))
+            profiler.set_context(image=self._get_current_name())
+            if budget:
+                reset_peak_rss()
+            try:
+                for i, (step, descr) in enumerate(procedure):
+                    # Once the measures are exported, the control is created too, so they always go together.
+                    if step != self._create_control:
+                        token.check()
+                    print(f"Executing step `{descr}` ({i})")
+                    with profiled(descr):
+                        success = step()
+                    if not success:
+                        print(colored(f"Failed step: `{descr}` ", 'red'), end="")
+                        print(colored(f"({self._get_current_name()})", 'red', attrs=['underline']), end="")
+                        print(colored(".", 'red'))
+            except Cancelled:
+                profiler.pop_records()
+                self._abort_item()
+                stopped = True
+                break
             
+            if profiler.enabled:
+                write_summary(profiler.pop_records(), os.path.join(self._get_export_path(), self._get_current_name()+"_profile.json"))
+
+            if budget:
+                self._release_item()
+                peak = peak_rss()
+                if peak is not None:
+                    print(f"Peak RSS of `{self._get_current_name()}`: {round(peak / 2**20, 1)} MB")
+
             yield iteration
             iteration += 1
             print(colored(f"{self._get_current_name()} processed. ({iteration}/{nElements})", 'green'))
 
             if not self._current_viewer().window._qt_window.isVisible():
+                self._close_writer()
+                self._close_index()
+                profiler.stop()
+                configure_threads(None)
                 print(colored("\n========= INTERRUPTED. =========\n", 'red', attrs=['bold']))
                 return
 
+            if token.cancelled:
+                stopped = True
+                break
+
+        self._close_writer()
+        self._close_index()
+        profiler.stop()
+        configure_threads(None)
         self._set_batch(False)
-        print(colored(f"\n============= DONE. ({round(time.time()-exec_start, 1)}s) =============\n", 'green', attrs=['bold']))
+        if self.reuse is not None:
+            total = self.reuse.reused + self.reuse.segmented
+            print(colored(f"Cells reused on {self.reuse.reused} of {total} time-lapse frames.", 'green'))
+        if stopped:
+            print(colored(f"\n============= STOPPED after {iteration} images. ({round(time.time()-exec_start, 1)}s) =============\n", 'yellow', attrs=['bold']))
+        else:
+            print(colored(f"\n============= DONE. ({round(time.time()-exec_start, 1)}s) =============\n", 'green', attrs=['bold']))
         self._clear_state()
         return True
 
@@ -636,6 +1115,8 @@ class SpotsInYeastsDock:
         call_button  = "Run batch"
     )
     def batch_folder_gui(self, input_folder: Path=Path.home(), output_folder: Path=Path.home()):
+        if self._busy():
+            return False
         self._clear_state()
         self._set_batch(True)
         self._set_export_path(str(output_folder))
@@ -650,3 +1131,16 @@ class SpotsInYeastsDock:
         
         worker = create_worker(self._batch_folder_worker, input_folder, output_folder, nElements, _progress={'total': nElements})
         worker.start()
+
+    @magicgui(call_button="Stop batch")
+    def stop_batch_gui(self):
+        """
+        Stops the running batch at the next check of the cancellation token (usually within a second).
+        The image being processed is dropped, the images already processed keep their measures and controls.
+        """
+        if not self._is_batch():
+            print(colored("No batch is running.", 'yellow'))
+            return False
+        get_token().cancel()
+        print(colored("Stopping the batch...", 'yellow'))
+        return True
@@ -0,0 +1,153 @@
+"""
+Comparison of two cells segmentation backends (ex: the classical segmenter against Cellpose) on a sample of images.
+It helps to decide, plate per plate, whether the cheaper backend is good enough.
+
+Usage:
+    python -m spots_in_yeasts.backendsAgreement /path/to/plate --sample 10 --output agreement.csv
+"""
+
+from termcolor import colored
+import numpy as np
+import os, argparse, sys, time
+
+
+def label_agreement(reference, candidate, iou_threshold=0.5):
+    """
+    Measures how well two labeled images agree, instance per instance.
+    Two labels are matched if their intersection over union (IoU) is above `iou_threshold` (>= 0.5 guarantees a unique matching).
+
+    Args:
+        reference: Labeled image taken as the reference.
+        candidate: Labeled image to evaluate.
+        iou_threshold: Minimal IoU for two labels to be matched.
+
+    Returns:
+        A dictionary containing the number of instances in each image, the number of matches, the precision, recall, F1-score, the mean IoU of matched instances and the Jaccard index of the foregrounds.
+    """
+    ref  = reference.ravel().astype(np.int64)
+    cand = candidate.ravel().astype(np.int64)
+    n_r  = int(ref.max()) + 1
+    n_c  = int(cand.max()) + 1
+
+    area_r = np.bincount(ref, minlength=n_r)
+    area_c = np.bincount(cand, minlength=n_c)
+
+    both  = (ref > 0) & (cand > 0)
+    pairs = ref[both] * n_c + cand[both]
+    keys, inter = np.unique(pairs, return_counts=True)
+    r_lbl = keys // n_c
+    c_lbl = keys % n_c
+    iou   = inter / (area_r[r_lbl] + area_c[c_lbl] - inter)
+    good  = iou > iou_threshold
+
+    count_r = int(np.count_nonzero(area_r[1:]))
+    count_c = int(np.count_nonzero(area_c[1:]))
+    matched = int(np.count_nonzero(good))
+    union   = int(np.count_nonzero((ref > 0) | (cand > 0)))
+
+    precision = matched / count_c if count_c > 0 else 1.0
+    recall    = matched / count_r if count_r > 0 else 1.0
+
+    return {
+        'reference_count': count_r,
+        'candidate_count': count_c,
+        'matched'        : matched,
+        'precision'      : round(precision, 4),
+        'recall'         : round(recall, 4),
+        'f1'             : round(2 * precision * recall / (precision + recall), 4) if (precision + recall) > 0 else 0.0,
+        'mean_iou'       : round(float(np.mean(iou[good])), 4) if matched > 0 else 0.0,
+        'jaccard'        : round(float(np.count_nonzero(both) / union), 4) if union > 0 else 1.0
+    }
+
+
+def get_header_agreement():
+    return [
+        'source',
+        'reference-time',
+        'candidate-time',
+        'reference-count',
+        'candidate-count',
+        'matched',
+        'precision',
+        'recall',
+        'f1',
+        'mean-iou',
+        'jaccard'
+    ]
+
+
+def agreement_report(paths, candidate='classical', reference='cellpose', n_samples=5, bf_channel=1, slices_around=2, gpu=False, seed=0):
+    """
+    Segments a random sample of images with two backends and measures their agreement.
+
+    Args:
+        paths: Paths of the images (hyperstacks organized as (C, Y, X) or (Z, C, Y, X)).
+        candidate: Backend being evaluated.
+        reference: Backend taken as the reference.
+        n_samples: Number of images randomly picked from `paths`.
+        bf_channel: Index of the brightfield channel.
+        slices_around: Number of slices taken around the focus slice.
+        gpu: Whether Cellpose can use the GPU.
+        seed: Seed used to pick the sample.
+
+    Returns:
+        A `CSVtable` with one row per image.
+    """
+    from tifffile import imread
+    from spots_in_yeasts.spotsInYeasts import segment_transmission
+    from spots_in_yeasts.formatData import CSVtable
+
+    rng    = np.random.default_rng(seed)
+    sample = sorted(rng.choice(paths, size=min(n_samples, len(paths)), replace=False)) if len(paths) > 0 else []
+    table  = CSVtable(get_header_agreement(), "")
+
+    for path in sample:
+        image = imread(path)
+        axis  = 0 if (image.ndim == 3) else 1
+        bf    = np.take(image, bf_channel, axis=axis)
+
+        start = time.time()
+        lbl_ref, _ = segment_transmission(bf, gpu, slices_around, reference)
+        t_ref = time.time() - start
+
+        start = time.time()
+        lbl_cdt, _ = segment_transmission(bf, gpu, slices_around, candidate)
+        t_cdt = time.time() - start
+
+        scores = label_agreement(lbl_ref, lbl_cdt)
+        table.newRow()
+        table.setValue('source', os.path.basename(path))
+        table.setValue('reference-time', round(t_ref, 3))
+        table.setValue('candidate-time', round(t_cdt, 3))
+        for key, value in scores.items():
+            table.setValue(key.replace('_', '-'), value)
+
+        print(colored(f"{os.path.basename(path)}: F1={scores['f1']}, mean IoU={scores['mean_iou']} ({round(t_ref, 1)}s -> {round(t_cdt, 1)}s)", 'green'))
+
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Agreement between two cells segmentation backends on a sample of images.")
+    parser.add_argument('folder', help="Folder containing the '.tif' images of a plate.")
+    parser.add_argument('--sample', type=int, default=5, help="Number of images randomly picked in the folder.")
+    parser.add_argument('--candidate', default='classical')
+    parser.add_argument('--reference', default='cellpose')
+    parser.add_argument('--bf-channel', type=int, default=1, help="Index of the brightfield channel.")
+    parser.add_argument('--gpu', action='store_true')
+    parser.add_argument('--cores', type=int, default=0, help="Number of cores to use (0: all the available ones).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="Path of the CSV report (default: <folder>/backends-agreement.csv).")
+    args = parser.parse_args(argv)
+
+    from spots_in_yeasts.threadsScheduler import configure_threads, default_plan, load_plan
+    configure_threads(load_plan(n_cores=args.cores) or default_plan(args.cores, 0))
+
+    paths = [os.path.join(args.folder, f) for f in sorted(os.listdir(args.folder)) if f.lower().endswith('.tif')]
+    table = agreement_report(paths, args.candidate, args.reference, args.sample, args.bf_channel, 2, args.gpu, args.seed)
+    table.exportTo(args.output or os.path.join(args.folder, "backends-agreement.csv"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""
+Cooperative cancellation of the pipeline.
+Long stages call `check_cancelled` between their sub-steps and inside their loops: once the shared token is cancelled, it raises `Cancelled`, which unwinds the stage up to the batch loop (or the worker of an interactive step).
+Like the profiler, the token is shared by the whole pipeline, so stages don't need an extra argument. A check costs an attribute lookup.
+Calls to external libraries (a Cellpose inference, ...) can't be interrupted: the cancellation is noticed when they return.
+"""
+
+import threading
+
+
+class Cancelled(Exception):
+    """
+    Raised by `check_cancelled` when the running work was cancelled.
+    """
+    pass
+
+
+class CancellationToken(object):
+
+    def __init__(self):
+        # Set when the work must stop. Safe to set from any thread (ex: the Qt main thread, while a worker checks it).
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    def reset(self):
+        """
+        Must be called before starting a new work, so the previous cancellation doesn't stop it.
+        """
+        self.event.clear()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise Cancelled()
+
+
+_token = CancellationToken()
+
+
+def get_token():
+    """
+    Returns the token shared by the whole pipeline.
+    """
+    return _token
+
+
+def check_cancelled():
+    """
+    Raises `Cancelled` if the shared token was cancelled.
+    """
+    if _token.event.is_set():
+        raise Cancelled()
@@ -0,0 +1,181 @@
+from concurrent.futures import ThreadPoolExecutor
+from tifffile import imwrite
+from termcolor import colored
+from spots_in_yeasts.pyramids import needs_pyramid, build_pyramid, write_levels
+from spots_in_yeasts.cancellation import get_token
+import threading, json, os
+import numpy as np
+
+try:
+    import imagecodecs
+    _zstd_available = True
+except ImportError:
+    _zstd_available = False
+
+
+def minimal_label_dtype(labels):
+    """
+    Finds the smallest unsigned integer type able to hold every label of an image.
+
+    Args:
+        labels: A labeled image (background == 0).
+
+    Returns:
+        A numpy dtype (uint8, uint16, uint32 or uint64).
+    """
+    top = int(np.max(labels)) if labels.size > 0 else 0
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if top <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def as_minimal_labels(labels):
+    """
+    Casts a labeled image to its minimal dtype. No copy is made if the image already has this type.
+    """
+    return labels.astype(minimal_label_dtype(labels), copy=False)
+
+
+class ControlWriter(object):
+    """
+    Writes the content of control folders (".ysc") on a pool of background threads.
+    TIFFs are compressed losslessly, labels are stored with their minimal dtype.
+    The number of pending files is bounded, so a slow storage can't make the memory explode: when the queue is full, queuing a new file blocks until a slot is released.
+    With `n_workers=0`, everything is written synchronously on the calling thread.
+    Arrays handed to the writer must not be modified in-place afterwards.
+    The pyramid levels of large 2D images are cached in the folder as well (see `pyramids`).
+    """
+    def __init__(self, n_workers=2, max_pending=16, compression='zlib', pyramid_threshold=0):
+        if (compression == 'zstd') and not _zstd_available:
+            print(colored("`imagecodecs` is required for zstd compression. Falling back to zlib.", 'yellow'))
+            compression = 'zlib'
+        # Compression method passed to tifffile ('zlib' == deflate, 'zstd', or None).
+        self.compression = compression
+        # Pool of threads writing files (None in synchronous mode).
+        self.pool        = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="ysc-writer") if (n_workers > 0) else None
+        # Semaphore bounding the number of files waiting to be written.
+        self.slots       = threading.BoundedSemaphore(max(1, max_pending))
+        # Protects the counters and the folders' registry.
+        self.lock        = threading.Lock()
+        # For each folder being written: [number of pending files, final callable (index) or None]
+        self.folders     = {}
+        # Paths of files that failed to be written.
+        self.failures    = []
+        # For each folder, description (shape, dtype, range) of the written images, indexed by file name.
+        self.manifests   = {}
+        # Longest side above which the pyramid of an image is written too (0: never).
+        self.pyramid     = pyramid_threshold
+
+    def _run(self, folder, path, task):
+        try:
+            task()
+        except Exception as e:
+            print(colored(f"Failed to write `{path}`. Reason: {e}", 'red'))
+            with self.lock:
+                self.failures.append(path)
+        finally:
+            self._file_done(folder)
+
+    def _file_done(self, folder):
+        with self.lock:
+            entry = self.folders[folder]
+            entry[0] -= 1
+            finalize = entry[1] if (entry[0] == 0) else None
+            if finalize is not None:
+                self.folders.pop(folder)
+        if finalize is not None:
+            finalize()
+
+    def _submit(self, folder, path, task):
+        with self.lock:
+            self.folders.setdefault(folder, [0, None])[0] += 1
+        if self.pool is None:
+            self._run(folder, path, task)
+            return
+        self.slots.acquire()
+        future = self.pool.submit(self._run, folder, path, task)
+        future.add_done_callback(lambda f: self.slots.release())
+
+    def write_image(self, folder, path, data, labels=False):
+        """
+        Queues a TIFF to be written in a control folder.
+
+        Args:
+            folder: Path of the control folder this file belongs to.
+            path: Full path of the TIFF to create.
+            data: The image to write.
+            labels: If True, the image is stored with its minimal unsigned dtype.
+        """
+        def task():
+            img = as_minimal_labels(data) if labels else data
+            imwrite(path, img, compression=self.compression)
+            description = {
+                'shape': [int(i) for i in img.shape],
+                'dtype': str(img.dtype),
+                'range': [float(np.min(img)), float(np.max(img))] if img.size > 0 else [0.0, 0.0]
+            }
+            # Pyramids are only a cache (rebuilt by the reader if missing): they are skipped when the batch is stopped.
+            if needs_pyramid(img.shape, self.pyramid) and not get_token().cancelled:
+                description['levels'] = write_levels(path, build_pyramid(img, labels), self.compression)
+            with self.lock:
+                self.manifests.setdefault(folder, {})[os.path.basename(path)] = description
+        self._submit(folder, path, task)
+
+    def write_text(self, folder, path, text):
+        """
+        Queues a plain text file to be written in a control folder.
+        """
+        def task():
+            with open(path, 'w') as f:
+                f.write(text)
+        self._submit(folder, path, task)
+
+    def write_table(self, folder, path, data, header, fmt='%.18e'):
+        """
+        Queues a CSV (written with `np.savetxt`) in a control folder.
+        """
+        def task():
+            np.savetxt(path, data, delimiter=',', header=header, fmt=fmt)
+        self._submit(folder, path, task)
+
+    def seal(self, folder, path, text):
+        """
+        Writes the index of a folder once all the other files of this folder are written.
+        This way, a folder is never indexed while its content is still incomplete.
+        The description of every image written in this folder is appended to the index under the `layers` key, so a reader doesn't have to open the TIFFs to know their shape.
+        """
+        def finalize():
+            with self.lock:
+                manifest = self.manifests.pop(folder, {})
+            try:
+                with open(path, 'w') as f:
+                    f.write(text)
+                    f.write("layers\n")
+                    f.write(json.dumps(manifest)+"\n")
+            except Exception as e:
+                print(colored(f"Failed to write `{path}`. Reason: {e}", 'red'))
+                with self.lock:
+                    self.failures.append(path)
+
+        with self.lock:
+            entry = self.folders.get(folder)
+            if (entry is not None) and (entry[0] > 0):
+                entry[1] = finalize
+                finalize = None
+            else:
+                self.folders.pop(folder, None)
+        if finalize is not None:
+            finalize()
+
+    def close(self):
+        """
+        Blocks until every queued file is written and releases the threads.
+
+        Returns:
+            The list of paths that failed to be written.
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        return self.failures
@@ -1,5 +1,7 @@
 import os
 import csv
+import numpy as np
+from spots_in_yeasts.spotsTable import as_spots_table, categories
 
 class CSVtable(object):
 
@@ -33,6 +35,22 @@ class CSVtable(object):
             return self
         self.lines[-1][idx] = str(val)
         return self
+
+    def addRows(self, n, columns):
+        """
+        Appends `n` rows at once, filled column by column instead of cell by cell.
+
+        Args:
+            n: Number of rows to append.
+            columns: Dictionary {title: (rows, values)}, where `rows` are the indices of the rows to fill (relative to the first appended row), and `values` their texts.
+        """
+        block = np.full((n, len(self.titles)), self.default, dtype=object)
+        for title, (rows, values) in columns.items():
+            idx = self._nameToIndex(title)
+            if idx >= 0:
+                block[rows, idx] = values
+        self.lines.extend(block.tolist())
+        return self
     
     def exportTo(self, fullPath):
         with open(fullPath, 'w') as csvfile:
@@ -41,8 +59,53 @@ class CSVtable(object):
             for row in self.lines:
                 writer.writerow(row)
 
+    def appendTo(self, fullPath):
+        """
+        Appends the rows created since the last call to the file (the titles are written if the file is new), and forgets them.
+        It keeps the memory bounded when results are written image after image.
+        """
+        new_file = (not os.path.isfile(fullPath)) or (os.path.getsize(fullPath) == 0)
+        with open(fullPath, 'a') as csvfile:
+            writer = csv.writer(csvfile, delimiter=';')
+            if new_file:
+                writer.writerow(self.titles)
+            for row in self.lines:
+                writer.writerow(row)
+        self.lines = []
+        return self
+
 
-def get_header_1844():
+def _as_text(values):
+    """
+    Converts a column to its texts, a missing value (NaN) giving an empty text.
+    """
+    text = np.asarray(values).astype(str).astype(object)
+    if values.dtype.kind == 'f':
+        text[np.isnan(values)] = ""
+    return text
+
+
+# Optional columns of the 1844 format, and the measure (or sub-pixel fit) they come from.
+_optional_1844 = [
+    ('z'                , 'z'),
+    ('sigma'            , 'sigma'),
+    ('fit-sigma'        , 'fit_sigma'),
+    ('fit-r2'           , 'fit_r2'),
+    ('nucleus-distance' , 'nucleus_distance'),
+    ('membrane-distance', 'membrane_distance')
+]
+
+
+def get_header_1844(measures=(), refined=False):
+    """
+    Titles of the 1844 format. New columns come after the original ones, so scripts reading the table by position keep working.
+    Optional columns are only present if the mode producing them is enabled.
+
+    Args:
+        measures: Names of the per-spot measures available (see `SpotsTable.measures`).
+        refined: Whether the sub-pixel localization was performed.
+    """
+    available = set(measures) | ({'fit_sigma', 'fit_r2'} if refined else set())
     return [
         'source',
         'cell-index',
@@ -55,30 +118,51 @@ def get_header_1844():
         'perimeter',
         'solidity',
         'extent',
-        '# spots'
-    ]
+        '# spots',
+        'y',
+        'x'
+    ] + [title for title, field in _optional_1844 if field in available]
 
 
 def format_data_1844(data, source, table=None):
-    csv_table = CSVtable(get_header_1844(), "") if (table is None) else table
-    csv_table.newRow()
-    csv_table.setValue('source', source)
-    for cell_label, spots_data in data.items():
-        csv_table.setValue('cell-index', cell_label)
-        csv_table.setValue('# spots'   , len(spots_data))
-        for spot_data in spots_data:
-            csv_table.setValue('spot-index'    , spot_data['label'])
-            csv_table.setValue('area'          , spot_data['area'])
-            csv_table.setValue('intensity-mean', spot_data['intensity_mean'])
-            csv_table.setValue('intensity-min' , spot_data['intensity_min'])
-            csv_table.setValue('intensity-max' , spot_data['intensity_max'])
-            csv_table.setValue('intensity-sum' , spot_data['intensity_sum'])
-            csv_table.setValue('perimeter'     , spot_data['perimeter'])
-            csv_table.setValue('solidity'      , spot_data['solidity'])
-            csv_table.setValue('extent'        , spot_data['extent'])
-            csv_table.newRow()
-        if len(spots_data) == 0:
-            csv_table.newRow()
+    """
+    Appends a row per spot to a table. The label of a cell and its number of spots are only written on the row of its first spot.
+    A cell without spots still gets a row. The first row holds the name of the source, and an empty row closes the image.
+
+    Args:
+        data: The spots of an image, as a `SpotsTable` (or an ownership dictionary).
+        source: Name of the image.
+        table: Table to which rows are appended. A new one is created if None.
+    """
+    spots     = as_spots_table(data)
+    csv_table = CSVtable(get_header_1844(spots.measures, spots.refined), "") if (table is None) else table
+    records   = spots.records
+    counts    = spots.counts()
+
+    # Row of the first spot of each cell, and row of each spot.
+    n_rows    = np.maximum(counts, 1)
+    firsts    = np.cumsum(n_rows) - n_rows
+    owners    = np.repeat(np.arange(len(counts)), counts)
+    rows      = firsts[owners] + np.arange(len(records)) - spots.offsets[owners]
+    refined   = spots.refined
+
+    columns = {
+        'source'        : ([0], [str(source)]),
+        'cell-index'    : (firsts, _as_text(spots.cells)),
+        '# spots'       : (firsts, _as_text(counts)),
+        'spot-index'    : (rows, _as_text(records['label'])),
+        'y'             : (rows, _as_text(records['y'] if refined else records['row'])),
+        'x'             : (rows, _as_text(records['x'] if refined else records['col'])),
+        'fit-sigma'     : (rows, _as_text(records['fit_sigma'])),
+        'fit-r2'        : (rows, _as_text(records['fit_r2']))
+    }
+    for title, field in [('area', 'area'), ('intensity-mean', 'intensity_mean'), ('intensity-min', 'intensity_min'), ('intensity-max', 'intensity_max'), ('intensity-sum', 'intensity_sum'), ('perimeter', 'perimeter'), ('solidity', 'solidity'), ('extent', 'extent')]:
+        columns[title] = (rows, _as_text(records[field]))
+    for title, field in _optional_1844:
+        if field in spots.measures:
+            columns[title] = (rows, _as_text(records[field]))
+
+    csv_table.addRows(int(n_rows.sum()) + 1, columns)
     return csv_table
 
 
@@ -96,26 +180,22 @@ def get_header_1895():
 
 
 def format_data_1895(data, source, table=None):
+    """
+    Appends a row per cell to a table, with its number of spots in each category. Unclassified spots are counted as cytoplasmic.
+    The first row holds the name of the source, and an empty row closes the image.
+    """
     csv_table = CSVtable(get_header_1895(), "") if (table is None) else table
-    csv_table.newRow()
-    csv_table.setValue('source', source)
-    
-    for cell_label, spots_data in data.items():
-        csv_table.setValue('cell-index', cell_label)
-        nuclear = 0
-        cyto    = 0
-        peri    = 0
-        for spot_data in spots_data:
-            if spot_data['category'] == 'NUCLEAR':
-                nuclear += 1
-            elif spot_data['category'] == 'PERIPHERAL':
-                peri += 1
-            else:
-                cyto += 1
-            
-        csv_table.setValue('# cytoplasmic-spots', cyto)
-        csv_table.setValue('# nuclear-spots', nuclear)
-        csv_table.setValue('# peripheral-spots', peri)
-        csv_table.newRow()
-
-    return csv_table
\ No newline at end of file
+    spots     = as_spots_table(data)
+    category  = spots.records['category']
+    nuclear   = spots.per_cell(category == categories.index('NUCLEAR'))
+    peri      = spots.per_cell(category == categories.index('PERIPHERAL'))
+    rows      = np.arange(len(spots.cells))
+
+    csv_table.addRows(len(rows) + 1, {
+        'source'             : ([0], [str(source)]),
+        'cell-index'         : (rows, _as_text(spots.cells)),
+        '# cytoplasmic-spots': (rows, _as_text(spots.counts() - nuclear - peri)),
+        '# nuclear-spots'    : (rows, _as_text(nuclear)),
+        '# peripheral-spots' : (rows, _as_text(peri))
+    })
+    return csv_table
@@ -0,0 +1,264 @@
+"""
+Readers opening acquisitions directly, without converting them to aggregated ".tif" files first (see `siy-convert-format.py`).
+Each reader splits its files into items (one per position and frame), and reads an item as a (Z, C, Y, X) or (C, Y, X) hyperstack.
+The channels of a hyperstack are then picked according to the order given by the user (see `channel_views`).
+
+Readers available:
+ - 'tiff': Single files readable by tifffile (TIFF, OME-TIFF, BigTIFF, LSM, STK, ...), including time-lapses and multi-position files (see `timeLapse`).
+ - 'tiff-series': Multi-file series, one file per channel, slice, frame or position. Indices are found in the names (ex: "cells_c1_z03.tif").
+
+Another format can be supported by adding an instance of a class with the same methods as `TiffReader` to `_readers`.
+"""
+
+from tifffile import TiffFile, imread
+from spots_in_yeasts.timeLapse import frames_layout, read_frame, frame_name
+import numpy as np
+import os, re
+
+# Names of the channels, in the order expected by the pipeline.
+channels_names = ['Spots', 'Brightfield', 'Nuclei']
+
+# Indices in files names of a series: channel, slice, frame and position.
+_series_token = re.compile(r"(?i)(?<![a-z0-9])(c|z|t|p)(\d+)(?![a-z])")
+
+
+def _slices_first(data, axes):
+    # The pipeline expects slices before channels.
+    if ('Z' in axes) and ('C' in axes) and (axes.index('Z') > axes.index('C')):
+        return np.swapaxes(data, axes.index('Z'), axes.index('C'))
+    return data
+
+
+class TiffReader(object):
+    """
+    Files readable by tifffile. Time-lapses and multi-position files give an item per (position, frame).
+    """
+    extensions = ('.tif', '.tiff', '.btf', '.tf2', '.tf8', '.lsm', '.stk')
+
+    def sources(self, paths):
+        """
+        Returns:
+            The sources this reader can open among `paths`, and the paths left to other readers.
+        """
+        mine = [p for p in paths if p.lower().endswith(self.extensions)]
+        return mine, [p for p in paths if not p.lower().endswith(self.extensions)]
+
+    def items(self, source):
+        """
+        Returns:
+            A list of (position, frame) pairs, or [(None, None)] if the file contains a single image.
+        """
+        layout = frames_layout(source)
+        if layout is None:
+            return [(None, None)]
+        return [(p, t) for p in range(layout['positions']) for t in range(layout['frames'])]
+
+    def read(self, source, position, frame):
+        if frame is not None:
+            return read_frame(source, position, frame)
+        with TiffFile(source) as tif:
+            axes = tif.series[0].axes
+            data = tif.series[0].asarray()
+        return _slices_first(data, axes[:-2])
+
+    def name(self, source, position, frame):
+        return frame_name(source, position, frame)
+
+    def exists(self, source):
+        return os.path.isfile(source)
+
+
+class TiffSeriesReader(object):
+    """
+    Series of TIFF files, each holding a single image (or a stack of slices) of an acquisition.
+    Files are grouped by their name once their indices are removed: "cells_c0_z1.tif" and "cells_c1_z0.tif" belong to the series "cells".
+    Files must have a channel or a slice index, and hold a single image (or a stack of slices, described as such by their header, if they have no slice index).
+    Other files (ex: complete hyperstacks named "strain_c1.tif") are left to `TiffReader`.
+    A source is the path of a series with its indices replaced by '#' (ex: "/data/cells_c#_z#.tif").
+    """
+    extensions = ('.tif', '.tiff')
+
+    def _parse(self, path):
+        # Returns the source of the series the file belongs to, and its indices ({axis: index}).
+        folder, base = os.path.split(path)
+        indices = {m.group(1).upper(): int(m.group(2)) for m in _series_token.finditer(base)}
+        pattern = _series_token.sub(lambda m: m.group(1) + "#", base)
+        return os.path.join(folder, pattern), indices
+
+    def _is_part(self, path, indices):
+        # Files of a series hold parts of a hyperstack: they have at least a channel or a slice index.
+        # Each one is a single plane, or a stack of slices if it has a channel index but no slice index.
+        # A stack whose axis isn't described as slices by its header may be a complete image: it is not grouped.
+        if ('C' not in indices) and ('Z' not in indices):
+            return False
+        try:
+            with TiffFile(path) as tif:
+                shape = tif.series[0].shape
+                axes  = tif.series[0].axes
+        except Exception:
+            return False
+        if len(shape) == 2:
+            return True
+        stack = ('C' in indices) and ('Z' not in indices)
+        return stack and (len(shape) == 3) and (axes[0] == 'Z')
+
+    def _files(self, source):
+        # Files of a series, with their indices.
+        folder = os.path.dirname(source) or "."
+        found  = []
+        for f in sorted(os.listdir(folder)):
+            path = os.path.join(folder, f)
+            pattern, indices = self._parse(path)
+            if (pattern == source) and self._is_part(path, indices):
+                found.append((path, indices))
+        return found
+
+    def sources(self, paths):
+        groups = {}
+        for p in paths:
+            if not p.lower().endswith(self.extensions):
+                continue
+            pattern, indices = self._parse(p)
+            # Complete images (ex: a hyperstack per channel name) are left to the other readers.
+            if self._is_part(p, indices):
+                groups.setdefault(pattern, []).append(p)
+        # A file alone is not a series.
+        series  = {s: files for s, files in groups.items() if len(files) > 1}
+        claimed = {f for files in series.values() for f in files}
+        return sorted(series.keys()), [p for p in paths if p not in claimed]
+
+    def items(self, source):
+        files     = self._files(source)
+        positions = sorted({i.get('P', 0) for _, i in files})
+        frames    = sorted({i.get('T', 0) for _, i in files})
+        if all(('P' not in i) and ('T' not in i) for _, i in files):
+            return [(None, None)]
+        return [(p, t) for p in range(len(positions)) for t in range(len(frames))]
+
+    def read(self, source, position, frame):
+        files     = self._files(source)
+        positions = sorted({i.get('P', 0) for _, i in files})
+        frames    = sorted({i.get('T', 0) for _, i in files})
+        if frame is not None:
+            files = [(f, i) for f, i in files if (i.get('P', 0) == positions[position]) and (i.get('T', 0) == frames[frame])]
+        if len(files) == 0:
+            raise ValueError(f"No file found for the series `{source}`.")
+
+        slices   = sorted({i.get('Z', 0) for _, i in files})
+        channels = sorted({i.get('C', 0) for _, i in files})
+        first    = imread(files[0][0])
+        data     = np.zeros((len(slices), len(channels)) + first.shape, dtype=first.dtype)
+        for f, i in files:
+            data[slices.index(i.get('Z', 0)), channels.index(i.get('C', 0))] = imread(f)
+
+        if first.ndim == 3: # Each file is a stack of slices.
+            data = np.moveaxis(data[0], 1, 0)
+        elif len(slices) == 1:
+            data = data[0]
+        return data
+
+    def name(self, source, position, frame):
+        base = os.path.basename(source).split('.')[0]
+        base = re.sub(r"(?i)[_\-. ]?(?<![a-z0-9])[czpt]#", "", base) or "series"
+        return frame_name(base, position, frame)
+
+    def exists(self, source):
+        return len(self._files(source)) > 0
+
+
+# Readers tried in this order: series first, so files belonging to a series are not opened one by one.
+_readers = {
+    'tiff-series': TiffSeriesReader(),
+    'tiff'       : TiffReader()
+}
+
+
+def list_items(paths):
+    """
+    Splits files into the items the pipeline will process.
+
+    Args:
+        paths: Paths of the files (typically, the content of the input folder).
+
+    Returns:
+        A list of (reader, source, position, frame) tuples. `position` and `frame` are None for files containing a single image.
+    """
+    items = []
+    left  = list(paths)
+    for r_name, reader in _readers.items():
+        sources, left = reader.sources(left)
+        for source in sources:
+            items += [(r_name, source, p, t) for (p, t) in reader.items(source)]
+    return items
+
+
+def read_item(reader, source, position, frame):
+    """
+    Reads an item produced by `list_items`, as a (Z, C, Y, X) or (C, Y, X) hyperstack.
+    """
+    return _readers[reader].read(source, position, frame)
+
+
+def item_exists(reader, source):
+    """
+    Checks that the files of an item are still there.
+    """
+    return _readers[reader].exists(source)
+
+
+def item_name(reader, source, position, frame):
+    """
+    Name given to the results of an item.
+    """
+    return _readers[reader].name(source, position, frame)
+
+
+def parse_channels_order(text):
+    """
+    Parses the order of the channels in the files, as given by the user.
+
+    Args:
+        text: Names of the channels separated by commas (ex: "Brightfield, Spots, Nuclei"). '-' marks a channel to ignore.
+
+    Returns:
+        The list of names, one per channel of the files.
+    """
+    order = [c.strip().capitalize() if c.strip() != "-" else "-" for c in str(text).split(',')]
+    for c in order:
+        if (c != "-") and (c not in channels_names):
+            raise ValueError(f"Unknown channel: `{c}`. Expected: {channels_names} or '-'.")
+    for c in channels_names[:2]:
+        if order.count(c) != 1:
+            raise ValueError(f"The `{c}` channel must appear exactly once in the channels order.")
+    return order
+
+
+def channel_views(hyperstack, order):
+    """
+    Picks the channels of a hyperstack without copying them.
+    A ValueError is raised if the hyperstack doesn't have 2 or 3 channels, has more channels than `order` names, or lacks a required channel.
+
+    Args:
+        hyperstack: A (C, Y, X) or (Z, C, Y, X) array.
+        order: Names of the channels of the hyperstack (see `parse_channels_order`).
+
+    Returns:
+        A dictionary giving for each name of `channels_names` a view on the channel, or None if the hyperstack doesn't contain it.
+    """
+    axis  = 0 if (hyperstack.ndim == 3) else 1
+    count = hyperstack.shape[axis]
+    if count not in {2, 3}:
+        raise ValueError(f"Either 2 or 3 channels are expected. {count} found.")
+    if count > len(order):
+        raise ValueError(f"The image has {count} channels, but the channels order only names {len(order)} of them.")
+    views = {name: None for name in channels_names}
+    for i, name in enumerate(order):
+        if (name == "-") or (i >= count):
+            continue
+        index = [slice(None)] * hyperstack.ndim
+        index[axis] = i
+        views[name] = hyperstack[tuple(index)]
+    for c in channels_names[:2]:
+        if views[c] is None:
+            raise ValueError(f"The `{c}` channel is not in the image ({count} channels found).")
+    return views
@@ -0,0 +1,114 @@
+"""
+Multiscale versions (pyramids) of large images, so napari only draws the resolution matching the current zoom.
+Each level halves the previous one: intensities are averaged over 2x2 blocks, while labels keep the top-left pixel of each block (nearest), so no label is invented on boundaries.
+
+Levels are cached next to the images of control folders (".ysc"): the levels of "<name>_bf.tif" are "pyramid/<name>_bf-1.tif", "pyramid/<name>_bf-2.tif", ...
+"""
+
+from tifffile import imwrite
+import numpy as np
+import os
+
+# Folder of a control folder receiving the levels of its images.
+_cache_folder = "pyramid"
+
+# Longest side (in pixels) above which images are shown as pyramids if no other threshold is given.
+default_threshold = 4096
+
+# Longest side of the smallest level.
+_min_side = 512
+
+
+def needs_pyramid(shape, threshold=default_threshold):
+    """
+    Checks whether an image is large enough to be shown as a pyramid. Only 2D images are concerned.
+
+    Args:
+        shape: Shape of the image.
+        threshold: Longest side (in pixels) above which a pyramid is used. 0 to never use one.
+    """
+    return (threshold > 0) and (len(shape) == 2) and (max(shape) > threshold)
+
+
+def downscale(image, labels=False):
+    """
+    Halves the size of a 2D image. Odd sizes are rounded up (the last row or column is repeated).
+
+    Args:
+        image: A 2D image.
+        labels: If True, the image contains labels, which are picked instead of averaged.
+
+    Returns:
+        The downscaled image, with the dtype of `image`.
+    """
+    if labels:
+        return np.ascontiguousarray(image[::2, ::2])
+
+    h, w   = image.shape
+    padded = np.pad(image, ((0, h % 2), (0, w % 2)), mode='edge')
+    blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).mean(axis=(1, 3), dtype=np.float32)
+    if np.issubdtype(image.dtype, np.integer):
+        blocks = np.rint(blocks)
+    return blocks.astype(image.dtype)
+
+
+def build_pyramid(image, labels=False, min_side=_min_side):
+    """
+    Builds every level of a pyramid, down to a level whose longest side is at most `min_side`.
+
+    Returns:
+        A list of images, starting with `image` itself (full resolution).
+    """
+    levels = [image]
+    while max(levels[-1].shape) > min_side:
+        levels.append(downscale(levels[-1], labels))
+    return levels
+
+
+def pyramid_shapes(shape, min_side=_min_side):
+    """
+    Shapes of the levels `build_pyramid` would produce for an image of this shape, without building them.
+    """
+    shapes = [tuple(int(s) for s in shape)]
+    while max(shapes[-1]) > min_side:
+        shapes.append(tuple((s + 1) // 2 for s in shapes[-1]))
+    return shapes
+
+
+def level_path(path, level):
+    """
+    Path of the cached level of an image (level 0 is the image itself).
+    """
+    if level == 0:
+        return path
+    folder, base = os.path.split(path)
+    stem, ext    = os.path.splitext(base)
+    return os.path.join(folder, _cache_folder, f"{stem}-{level}{ext}")
+
+
+def write_levels(path, levels, compression='zlib'):
+    """
+    Writes the levels of a pyramid (except the full resolution, already in `path`) in the cache of its folder.
+
+    Returns:
+        The shape of every level, including the full resolution.
+    """
+    os.makedirs(os.path.join(os.path.dirname(path), _cache_folder), exist_ok=True)
+    for i, level in enumerate(levels[1:], 1):
+        imwrite(level_path(path, i), level, compression=compression)
+    return [[int(s) for s in level.shape] for level in levels]
+
+
+def cached_levels(path):
+    """
+    Finds the cached levels of an image.
+
+    Returns:
+        The paths of the levels (without the full resolution), or an empty list if they are missing or older than the image.
+    """
+    paths = []
+    while os.path.isfile(level_path(path, len(paths) + 1)):
+        paths.append(level_path(path, len(paths) + 1))
+    if (len(paths) == 0) or (os.path.getmtime(paths[0]) < os.path.getmtime(path)):
+        return []
+    return paths
@@ -0,0 +1,379 @@
+"""
+Experiment-wide index of the results, stored in a local SQLite database.
+Each processed image produces one row in `images`, one row per cell in `cells` and one row per spot in `spots`.
+The index is filled during the batch export, and can be rebuilt from existing control folders (".ysc").
+"""
+
+import sqlite3, os, json, hashlib, argparse, csv, sys
+from datetime import datetime, date, timedelta
+from enum import Enum
+from termcolor import colored
+from spots_in_yeasts.spotsTable import as_spots_table, categories, category_names
+import numpy as np
+
+_schema = """
+CREATE TABLE IF NOT EXISTS images (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    name          TEXT NOT NULL,
+    source        TEXT,
+    control       TEXT UNIQUE,
+    processed_at  TEXT,
+    settings_hash TEXT,
+    n_cells       INTEGER,
+    n_spots       INTEGER
+);
+CREATE TABLE IF NOT EXISTS cells (
+    image_id      INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    cell_label    INTEGER NOT NULL,
+    n_spots       INTEGER,
+    n_nuclear     INTEGER,
+    n_peripheral  INTEGER,
+    n_cytoplasmic INTEGER,
+    PRIMARY KEY (image_id, cell_label)
+);
+CREATE TABLE IF NOT EXISTS spots (
+    image_id       INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    cell_label     INTEGER NOT NULL,
+    spot_label     INTEGER NOT NULL,
+    row            REAL,
+    col            REAL,
+    area           REAL,
+    intensity_mean REAL,
+    intensity_min  REAL,
+    intensity_max  REAL,
+    intensity_sum  REAL,
+    perimeter      REAL,
+    solidity       REAL,
+    extent         REAL,
+    category       TEXT,
+    z              REAL,
+    sigma          REAL,
+    fit_sigma      REAL,
+    fit_r2         REAL,
+    nucleus_distance  REAL,
+    membrane_distance REAL,
+    PRIMARY KEY (image_id, spot_label)
+);
+CREATE INDEX IF NOT EXISTS idx_images_date     ON images(processed_at);
+CREATE INDEX IF NOT EXISTS idx_images_settings ON images(settings_hash);
+CREATE INDEX IF NOT EXISTS idx_cells_nuclear   ON cells(n_nuclear);
+CREATE INDEX IF NOT EXISTS idx_cells_spots     ON cells(n_spots);
+CREATE INDEX IF NOT EXISTS idx_spots_cell      ON spots(image_id, cell_label);
+"""
+
+_index_name = "results-index.sqlite"
+
+
+def default_index_path(directory):
+    """
+    Path of the results index of an export directory.
+    """
+    return os.path.join(directory, _index_name)
+
+
+def settings_hash(settings, ignored=()):
+    """
+    Creates a short hash identifying a set of settings, so results produced with different settings can be told apart.
+
+    Args:
+        settings: A dictionary of settings (such as `_global_settings`).
+        ignored: Keys that don't affect the results (I/O, threads, ...) and are left out of the hash.
+
+    Returns:
+        A hexadecimal string (16 characters).
+    """
+    normalized = {str(k): (v.name if isinstance(v, Enum) else v) for k, v in settings.items() if (k not in ignored)}
+    textual    = json.dumps(normalized, sort_keys=True, default=str)
+    return hashlib.sha1(textual.encode('utf-8')).hexdigest()[:16]
+
+
+class ResultsIndex(object):
+    """
+    Local SQLite store of the per-image, per-cell and per-spot results.
+    A connection can only be used from the thread that opened it.
+    """
+    def __init__(self, path):
+        # Path of the database file.
+        self.path = str(path)
+        # Connection to the database.
+        self.db   = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(_schema)
+        self._migrate()
+
+    def _migrate(self):
+        # Indices created before spots had a depth, a scale, a sub-pixel fit and distances.
+        columns = [row['name'] for row in self.db.execute("PRAGMA table_info(spots)")]
+        for column in ('z', 'sigma', 'fit_sigma', 'fit_r2', 'nucleus_distance', 'membrane_distance'):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE spots ADD COLUMN {column} REAL")
+
+    def close(self):
+        self.db.close()
+
+    def add_image(self, name, source, control, ownership, s_hash=None, processed_at=None):
+        """
+        Inserts the results of an image in a single transaction.
+        If this control folder was already indexed, its previous rows are replaced.
+
+        Args:
+            name: Name of the image.
+            source: Path of the original image (or folder).
+            control: Path of the control folder (".ysc") of this image.
+            ownership: The `SpotsTable` of the image, as produced by `associate_spots_yeasts` (an ownership dictionary {cell label: list of spots} is accepted too).
+            s_hash: Hash of the settings used to process this image.
+            processed_at: Date of the processing (datetime). Now if None.
+
+        Returns:
+            The id of the image in the index.
+        """
+        processed = (processed_at or datetime.now()).isoformat(timespec='seconds')
+        control   = os.path.abspath(control) # Same key whether the folder was indexed by a batch or a rebuild.
+
+        spots     = as_spots_table(ownership)
+        records   = spots.records
+        category  = records['category']
+        nuclear   = spots.per_cell(category == categories.index('NUCLEAR'))
+        peri      = spots.per_cell(category == categories.index('PERIPHERAL'))
+        cyto      = spots.per_cell(category == categories.index('CYTOPLASMIC'))
+        cells_rws = list(zip(spots.cells.tolist(), spots.counts().tolist(), nuclear.tolist(), peri.tolist(), cyto.tolist()))
+
+        def column(name):
+            # Missing values (NaN, or a measure that wasn't made) are stored as NULL.
+            if name not in records.dtype.names:
+                return [None] * len(records)
+            values = records[name]
+            return np.where(np.isnan(values), None, values).tolist()
+
+        spots_rws = list(zip(
+            records['cell'].tolist(),
+            records['label'].tolist(),
+            records['y'].tolist(),
+            records['x'].tolist(),
+            *[records[f].tolist() for f in ('area', 'intensity_mean', 'intensity_min', 'intensity_max', 'intensity_sum', 'perimeter', 'solidity', 'extent')],
+            category_names(category).tolist(),
+            *[column(f) for f in ('z', 'sigma', 'fit_sigma', 'fit_r2', 'nucleus_distance', 'membrane_distance')]
+        ))
+
+        with self.db:
+            self.db.execute("DELETE FROM images WHERE control = ?", (str(control),))
+            cursor = self.db.execute(
+                "INSERT INTO images (name, source, control, processed_at, settings_hash, n_cells, n_spots) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (name, source, str(control), processed, s_hash, len(cells_rws), len(spots_rws))
+            )
+            image_id  = cursor.lastrowid
+            self.db.executemany(
+                "INSERT INTO cells VALUES (?, ?, ?, ?, ?, ?)",
+                [(image_id,) + row for row in cells_rws]
+            )
+            self.db.executemany(
+                "INSERT INTO spots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(image_id,) + row for row in spots_rws]
+            )
+
+        return image_id
+
+    def _filters(self, since, until, s_hash):
+        clauses = []
+        params  = []
+        if since is not None:
+            clauses.append("images.processed_at >= ?")
+            params.append(since)
+        if until is not None:
+            try: # A bare date includes the whole day: compare to the start of the next one.
+                params.append((date.fromisoformat(until) + timedelta(days=1)).isoformat())
+                clauses.append("images.processed_at < ?")
+            except ValueError:
+                clauses.append("images.processed_at <= ?")
+                params.append(until)
+        if s_hash is not None:
+            clauses.append("images.settings_hash = ?")
+            params.append(s_hash)
+        return clauses, params
+
+    def query_images(self, since=None, until=None, s_hash=None):
+        """
+        Lists the indexed images, optionally filtered by date (ISO strings) and settings hash.
+        """
+        clauses, params = self._filters(since, until, s_hash)
+        where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+        return self.db.execute("SELECT * FROM images" + where + " ORDER BY processed_at", params).fetchall()
+
+    def query_cells(self, min_spots=None, min_nuclear=None, since=None, until=None, s_hash=None):
+        """
+        Lists cells (along with the name of their image) matching some conditions.
+
+        Args:
+            min_spots: Minimal number of spots in the cell.
+            min_nuclear: Minimal number of nuclear spots in the cell.
+            since: Processing date from which images are taken into account (ISO string, ex: '2023-05-01'). Dates are compared as strings.
+            until: Processing date until which images are taken into account (ISO string).
+            s_hash: Only keep images processed with these settings.
+        """
+        clauses, params = self._filters(since, until, s_hash)
+        if min_spots is not None:
+            clauses.append("cells.n_spots >= ?")
+            params.append(int(min_spots))
+        if min_nuclear is not None:
+            clauses.append("cells.n_nuclear >= ?")
+            params.append(int(min_nuclear))
+        where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+        return self.db.execute(
+            "SELECT images.name, images.processed_at, images.settings_hash, cells.* FROM cells JOIN images ON images.id = cells.image_id" + where + " ORDER BY images.processed_at, cells.cell_label",
+            params
+        ).fetchall()
+
+    def query_spots(self, category=None, since=None, until=None, s_hash=None):
+        """
+        Lists spots (along with the name of their image), optionally filtered by category ('NUCLEAR', 'PERIPHERAL', 'CYTOPLASMIC').
+        """
+        clauses, params = self._filters(since, until, s_hash)
+        if category is not None:
+            clauses.append("spots.category = ?")
+            params.append(str(category).upper())
+        where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+        return self.db.execute(
+            "SELECT images.name, images.processed_at, images.settings_hash, spots.* FROM spots JOIN images ON images.id = spots.image_id" + where + " ORDER BY images.processed_at, spots.cell_label, spots.spot_label",
+            params
+        ).fetchall()
+
+
+######################################################################
+
+
+def read_control_index(control_path):
+    """
+    Parses the `index.txt` file of a control folder.
+
+    Returns:
+        A dictionary of properties (name, sources, time, ...), or None if the folder is not a control folder.
+    """
+    ppts_path = os.path.join(control_path, "index.txt")
+    if not os.path.isfile(ppts_path):
+        return None
+
+    with open(ppts_path, 'r') as f:
+        data = [d for d in f.read().split("\n") if (len(d) > 0)]
+
+    return {data[i]: data[i + 1] for i in range(0, len(data) - 1, 2)}
+
+
+def ownership_from_control(control_path, properties):
+    """
+    Recomputes the ownership of spots from the content of a control folder.
+    Spots stored in a control folder were already filtered, so no threshold is applied again.
+    """
+    from tifffile import imread
+    from spots_in_yeasts.spotsInYeasts import associate_spots_yeasts, distance_spot_nuclei, refine_ownership
+
+    name   = properties['name']
+    cells  = os.path.join(control_path, name+"_segmented_cells.tif")
+    spots  = os.path.join(control_path, name+"_segmented_spots.tif")
+    fluo   = os.path.join(control_path, name+"_fluo_spots.tif")
+    nuclei = os.path.join(control_path, name+"_segmented_nuclei.tif")
+
+    if not all(os.path.isfile(p) for p in (cells, spots, fluo)):
+        return None
+
+    labeled_cells = imread(cells)
+    labeled_spots = imread(spots)
+    categories    = distance_spot_nuclei(labeled_cells, imread(nuclei), labeled_spots) if os.path.isfile(nuclei) else None
+    fluo_spots      = imread(fluo)
+    ownership, _, _ = associate_spots_yeasts(labeled_cells, labeled_spots, fluo_spots, 0, float('inf'), 0.0, 0.0, categories)
+    return refine_ownership(ownership, fluo_spots)
+
+
+def rebuild_index(index_path, folder):
+    """
+    Backfills the results index from all the control folders (".ysc") found (recursively) in a folder.
+
+    Args:
+        index_path: Path of the SQLite database (created if it doesn't exist).
+        folder: Folder containing control folders.
+
+    Returns:
+        The number of images indexed.
+    """
+    index = ResultsIndex(index_path)
+    count = 0
+
+    for root, dirs, files in os.walk(folder):
+        for d in sorted(dirs):
+            if not d.lower().endswith(".ysc"):
+                continue
+            control    = os.path.join(root, d)
+            properties = read_control_index(control)
+            if properties is None:
+                print(colored(f"No index found in `{control}`.", 'yellow'))
+                continue
+            ownership = ownership_from_control(control, properties)
+            if ownership is None:
+                print(colored(f"Incomplete control folder: `{control}`.", 'yellow'))
+                continue
+            try:
+                processed = datetime.strptime(properties.get('time', ""), "%d/%B/%Y (%H:%M:%S)")
+            except ValueError:
+                processed = datetime.fromtimestamp(os.path.getmtime(os.path.join(control, "index.txt")))
+            index.add_image(properties['name'], properties.get('sources'), control, ownership, properties.get('settings'), processed)
+            count += 1
+            print(f"Indexed: {properties['name']}")
+
+    index.close()
+    print(colored(f"{count} images indexed in `{index_path}`.", 'green'))
+    return count
+
+
+def main(argv=None):
+    """
+    Command line interface of the results index.
+
+    Examples:
+        siy-results rebuild /path/to/results
+        siy-results cells /path/to/results/results-index.sqlite --min-nuclear 3 --since 2023-05-01
+    """
+    parser = argparse.ArgumentParser(prog="siy-results", description="Index and query the results of Spots in yeasts.")
+    sub    = parser.add_subparsers(dest='command', required=True)
+
+    rebuild = sub.add_parser('rebuild', help="Backfill the index from existing control folders.")
+    rebuild.add_argument('folder', help="Folder containing the control folders (.ysc).")
+    rebuild.add_argument('--index', default=None, help="Path of the database (default: <folder>/"+_index_name+").")
+
+    for cmd in ('images', 'cells', 'spots'):
+        q = sub.add_parser(cmd, help=f"List indexed {cmd} as CSV.")
+        q.add_argument('index', help="Path of the database.")
+        q.add_argument('--since', default=None, help="ISO date (ex: 2023-05-01).")
+        q.add_argument('--until', default=None, help="ISO date (ex: 2023-05-31).")
+        q.add_argument('--settings', default=None, help="Settings hash.")
+        if cmd == 'cells':
+            q.add_argument('--min-spots', type=int, default=None)
+            q.add_argument('--min-nuclear', type=int, default=None)
+        if cmd == 'spots':
+            q.add_argument('--category', default=None)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'rebuild':
+        rebuild_index(args.index or default_index_path(args.folder), args.folder)
+        return 0
+
+    index = ResultsIndex(args.index)
+    if args.command == 'images':
+        rows = index.query_images(args.since, args.until, args.settings)
+    elif args.command == 'cells':
+        rows = index.query_cells(args.min_spots, args.min_nuclear, args.since, args.until, args.settings)
+    else:
+        rows = index.query_spots(args.category, args.since, args.until, args.settings)
+
+    writer = csv.writer(sys.stdout, delimiter=';')
+    if len(rows) > 0:
+        writer.writerow(rows[0].keys())
+    for row in rows:
+        writer.writerow(tuple(row))
+    index.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
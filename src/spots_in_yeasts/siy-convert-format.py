@@ -4,11 +4,15 @@ from java.awt import GridLayout, Dimension, Font, Color, FlowLayout, BorderLayou
 from java.awt.event import ActionListener
 from javax.swing.filechooser import FileNameExtensionFilter
 from javax.swing import JFileChooser
-from java.lang import RuntimeException
-import os
+from java.lang import RuntimeException, System, Runtime
+from java.awt import GraphicsEnvironment
+from java.util.concurrent import Executors, Callable, TimeUnit
+import os, sys, json, time, threading
 from ij import IJ
+from ij.io import FileSaver
 from ij.plugin import ChannelSplitter, Commands, RGBStackMerge
 from ij.macro import Interpreter
+from loci.plugins import BF
 
 # =========== Target output ===========
 #
@@ -16,6 +20,22 @@ from ij.macro import Interpreter
 # File format: Aggregated ".tif"
 #
 # =====================================
+#
+# Headless mode: the settings are read from a JSON file, given either as the first argument of the script,
+# through the `SIY_CONVERT_SETTINGS` environment variable, or through the `siy.settings` Java property:
+#
+#   SIY_CONVERT_SETTINGS=settings.json ImageJ-linux64 --headless --console --run siy-convert-format.py
+#
+# {
+#     "input_dir" : "/path/to/raw",
+#     "output_dir": "/path/to/tif",
+#     "extension" : ".nd",
+#     "order"     : ["Brightfield", "Spots", "Nuclei"],
+#     "threads"   : 8,      (optional, default: number of cores)
+#     "overwrite" : false   (optional, default: outputs more recent than their input are skipped)
+# }
+#
+# In both modes, a `conversion-log.tsv` file is written in the output directory.
 
 _desired_order_ = ['Spots', 'Brightfield', 'Nuclei']
 
@@ -46,8 +66,9 @@ def remap_indices(provided_order):
 
 
 def aggregated_to_tif(order, path, output_dir, name):
-    IJ.run("Bio-Formats Importer", "open=[" + path +"] color_mode=Default rois_import=[ROI manager] view=Hyperstack stack_order=XYCZT")
-    img = IJ.getImage()
+    # The image is opened through the Bio-Formats API (and not the importer's dialog), without any window.
+    # Nothing relies on the "current image", so several files can be converted at once.
+    img = BF.openImagePlus(path)[0]
     channels = ChannelSplitter.split(img)
     img.close()
     zipped = zip(order, channels)
@@ -55,14 +76,139 @@ def aggregated_to_tif(order, path, output_dir, name):
     elements_rearranges = [element for index, element in sorted_pairs]
     new_img = RGBStackMerge.mergeChannels(elements_rearranges, False)
     export_path = os.path.join(output_dir, name)
-    IJ.save(new_img, export_path)
-    new_img.close()
+    # Written under a temporary name and renamed once complete: an interrupted conversion never leaves a truncated file
+    # that would look up to date on the next run.
+    temp_path = os.path.join(output_dir, "." + name + ".part")
+    try:
+        if not FileSaver(new_img).saveAsTiff(temp_path):
+            raise IOError("Failed to write " + temp_path)
+        if os.path.isfile(export_path): # Jython has no `os.replace`, and `os.rename` can't overwrite on Windows.
+            os.remove(export_path)
+        os.rename(temp_path, export_path)
+    finally:
+        new_img.close()
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
 
 
 def convert_name(original, extension):
     return original.lower().replace(extension.lower(), ".tif").replace(" ", "-")
 
 
+def is_up_to_date(source, target):
+    """
+    An output is up to date if it exists and is more recent than its input.
+    """
+    return os.path.isfile(target) and (os.path.getmtime(target) >= os.path.getmtime(source))
+
+
+class ConversionLog(object):
+    """
+    Tab-separated log of the conversions, shared by the threads converting files.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path = path
+        self.counts = {'converted': 0, 'skipped': 0, 'failed': 0}
+        if (not os.path.isfile(self.path)) or (os.path.getsize(self.path) == 0): # Runs append to the same log.
+            with open(self.path, 'a') as f:
+                f.write("date\tfile\tstatus\tseconds\tmessage\n")
+
+    def add(self, name, status, seconds, message=""):
+        line = "\t".join([time.strftime("%Y-%m-%d %H:%M:%S"), name, status, "%.2f" % seconds, message.replace("\n", " ")])
+        with self.lock:
+            self.counts[status] += 1
+            with open(self.path, 'a') as f:
+                f.write(line + "\n")
+            IJ.log(name + ": " + status + ("" if not message else " (" + message + ")"))
+
+
+class ConversionTask(Callable):
+    def __init__(self, order, input_dir, output_dir, name, extension, overwrite, log):
+        self.order      = order
+        self.source     = os.path.join(input_dir, name)
+        self.output_dir = output_dir
+        self.name       = name
+        self.target     = convert_name(name, extension)
+        self.overwrite  = overwrite
+        self.log        = log
+
+    def call(self):
+        start = time.time()
+        if (not self.overwrite) and is_up_to_date(self.source, os.path.join(self.output_dir, self.target)):
+            self.log.add(self.name, 'skipped', 0.0, "up to date")
+            return
+        try:
+            aggregated_to_tif(self.order, self.source, self.output_dir, self.target)
+        except Exception as e:
+            self.log.add(self.name, 'failed', time.time() - start, str(e))
+        else:
+            self.log.add(self.name, 'converted', time.time() - start)
+
+
+def convert_folder(input_dir, output_dir, extension, order, threads=1, overwrite=False):
+    """
+    Converts every file of `input_dir` having the extension, with `threads` files converted at once.
+
+    Returns:
+        The number of files converted, skipped and failed.
+    """
+    e       = extension.lower()
+    queue   = sorted([str(f) for f in os.listdir(input_dir) if f.lower().endswith(e)])
+    remaped = remap_indices(order)
+    if remaped is None:
+        return None
+
+    log  = ConversionLog(os.path.join(output_dir, "conversion-log.tsv"))
+    pool = Executors.newFixedThreadPool(max(1, threads))
+    IJ.log(str(len(queue)) + " files to convert with " + str(max(1, threads)) + " threads.")
+    start = time.time()
+    try:
+        futures = [pool.submit(ConversionTask(remaped, input_dir, output_dir, q, extension, overwrite, log)) for q in queue]
+        for f in futures:
+            f.get()
+    finally:
+        pool.shutdown()
+        pool.awaitTermination(1, TimeUnit.HOURS)
+
+    IJ.log("DONE in %.1fs: %d converted, %d skipped, %d failed." % (time.time() - start, log.counts['converted'], log.counts['skipped'], log.counts['failed']))
+    return log.counts
+
+
+def settings_path():
+    """
+    Path of the settings file for the headless mode, or None to open the dialog.
+    """
+    args = [a for a in sys.argv[1:] if a.lower().endswith(".json")]
+    if len(args) > 0:
+        return args[0]
+    return os.environ.get("SIY_CONVERT_SETTINGS") or System.getProperty("siy.settings")
+
+
+def run_headless(path):
+    with open(path, 'r') as f:
+        settings = json.load(f)
+
+    order = [str(c) for c in settings['order']]
+    order = order + ["-"] * (3 - len(order))
+    for d in (settings['input_dir'], settings['output_dir']):
+        if not os.path.isdir(d):
+            raise RuntimeException("`" + d + "` is not a valid directory.")
+
+    Interpreter.batchMode = True
+    try:
+        return convert_folder(
+            settings['input_dir'],
+            settings['output_dir'],
+            settings['extension'],
+            order,
+            int(settings.get('threads', Runtime.getRuntime().availableProcessors())),
+            bool(settings.get('overwrite', False))
+        )
+    finally:
+        Interpreter.batchMode = False
+
+
 class ImageConverter(ActionListener):
     def __init__(self):
         # Path to the input directory.
@@ -80,6 +226,8 @@ class ImageConverter(ActionListener):
 
         # Text field collecting the extension.
         self.ext = None
+        # Text field collecting the number of files converted at once.
+        self.threads = None
         # Dropdown menus collecting the order of channels.
         self.c1_dropdown = None
         self.c2_dropdown = None
@@ -114,16 +262,12 @@ class ImageConverter(ActionListener):
         Commands.closeAll()
         Interpreter.batchMode = True
 
-        remaped = remap_indices(self.order)
-        for q in self.queue:
-            IJ.log("Processing image: " + q)
-            aggregated_to_tif(
-                remaped,
-                os.path.join(self.input_dir, q),
-                self.output_dir,
-                convert_name(q, self.format)
-            )
-        IJ.log("DONE.")
+        try:
+            n_threads = int(str(self.threads.getText()).strip() or "1")
+        except ValueError:
+            n_threads = 1
+
+        convert_folder(self.input_dir, self.output_dir, self.format, self.order, n_threads)
 
         Interpreter.batchMode = False
 
@@ -244,11 +388,15 @@ class ImageConverter(ActionListener):
         contentPanel.add(titlePanel)
 
         panel = JPanel()
-        panel.setLayout(GridLayout(1, 2))
+        panel.setLayout(GridLayout(2, 2))
 
         panel.add(JLabel("Extension:"))
         self.ext = JTextField(20)
         panel.add(self.ext)
+
+        panel.add(JLabel("Threads:"))
+        self.threads = JTextField("1", 20)
+        panel.add(self.threads)
         
         contentPanel.add(panel)
     
@@ -269,4 +417,9 @@ class ImageConverter(ActionListener):
             self.output_dir = chooser.getSelectedFile().getAbsolutePath()
 
 
-ImageConverter()
+if (settings_path() is not None) or GraphicsEnvironment.isHeadless():
+    if settings_path() is None:
+        raise RuntimeException("Headless mode requires a settings file (see the top of this script).")
+    run_headless(settings_path())
+else:
+    ImageConverter()
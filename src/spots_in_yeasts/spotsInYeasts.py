@@ -1,20 +1,25 @@
-from skimage.io import imsave
-from skimage.filters import threshold_isodata, threshold_otsu
-from skimage.segmentation import watershed, clear_border, find_boundaries
+from skimage.filters import threshold_isodata, threshold_otsu, sobel, gaussian
+from skimage.segmentation import watershed, clear_border, find_boundaries, relabel_sequential
 from skimage.morphology import dilation, disk
 from skimage.measure import regionprops
 from skimage.measure import label as connected_compos_labeling
 from skimage.feature import peak_local_max
 from matplotlib.colors import LinearSegmentedColormap
-from scipy.ndimage import median_filter, gaussian_laplace, distance_transform_cdt, label
+from scipy.ndimage import median_filter, gaussian_laplace, gaussian_filter, distance_transform_cdt, label, maximum_filter
 from termcolor import colored
 import os, cv2, shutil
 import numpy as np
 from cellpose import models, utils, io
 from datetime import datetime
 from skimage import exposure
+from skimage.transform import resize
 from scipy.stats import kstest
-from scipy.ndimage import binary_erosion, binary_dilation
+from scipy.ndimage import binary_erosion, binary_dilation, binary_opening, binary_fill_holes, distance_transform_edt
+from spots_in_yeasts.controlWriter import ControlWriter
+from spots_in_yeasts.stagesProfiler import profiled
+from spots_in_yeasts.cancellation import check_cancelled
+from spots_in_yeasts.threadsScheduler import threads_for, scheduled
+from spots_in_yeasts.spotsTable import SpotsTable, category_codes
 
 _coordinates = {
     (-1, -1),
@@ -38,25 +43,108 @@ def create_random_lut():
     return LinearSegmentedColormap.from_list('random_lut', np.vstack((np.array([(0.0, 0.0, 0.0)]), np.random.uniform(0.01, 1.0, (255, 3)))))
 
 
-def write_labels_image(image, font_scale):
+# Glyphs of the digits, rendered once per (font scale, thickness). See `glyph_atlas`.
+_glyph_atlases = {}
+
+def glyph_atlas(font_scale, thickness=2):
+    """
+    Renders the ten digits once, so labels can be written by copying glyphs instead of drawing text.
+    Digits all have the same advance in the Hershey simplex font, so a number is its digits' glyphs placed side by side.
+
+    Returns:
+        A dictionary with:
+         - 'glyphs': array of shape (10, H, W), the (anti-aliased) rendering of each digit.
+         - 'offset': (row, column) of the glyphs' top-left corner relative to the text's origin (its bottom-left corner).
+         - 'advance': horizontal distance between two consecutive digits.
+         - 'size': function giving the (width, height) of a number of `n` digits, as `cv2.getTextSize` would.
+    """
+    key = (font_scale, thickness)
+    if key in _glyph_atlases:
+        return _glyph_atlases[key]
+
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    (width, height), _ = cv2.getTextSize("0", font, font_scale, thickness)
+    advance = cv2.getTextSize("00", font, font_scale, thickness)[0][0] - width
+    margin  = 2 * thickness + 2
+    canvas  = np.zeros((10, height + 2 * margin, width + 2 * margin), dtype=np.uint8)
+    for digit in range(10):
+        cv2.putText(canvas[digit], str(digit), (margin, margin + height), font, font_scale, 255, thickness)
+
+    # The glyphs are cropped to the box containing every digit.
+    rows = np.flatnonzero(np.any(canvas, axis=(0, 2)))
+    cols = np.flatnonzero(np.any(canvas, axis=(0, 1)))
+    atlas = {
+        'glyphs' : canvas[:, rows[0]:rows[-1]+1, cols[0]:cols[-1]+1],
+        'offset' : (int(rows[0]) - margin - height, int(cols[0]) - margin),
+        'advance': advance,
+        'size'   : lambda n: (advance * n + width - advance, height)
+    }
+    _glyph_atlases[key] = atlas
+    return atlas
+
+
+def label_centroids(image):
+    """
+    Computes the centroid of every label of an image in a single pass (instead of a region at a time).
+
+    Returns:
+        A tuple (labels, centroids): the labels present in the image (background excluded), and their (row, column) centroids as an array of shape (N, 2).
+    """
+    flat   = image.ravel().astype(np.int64, copy=False)
+    counts = np.bincount(flat)
+    height, width = image.shape
+    rows   = np.bincount(flat, weights=np.repeat(np.arange(height, dtype=np.float64), width), minlength=counts.size)
+    cols   = np.bincount(flat, weights=np.tile(np.arange(width, dtype=np.float64), height), minlength=counts.size)
+    labels = np.flatnonzero(counts[1:]) + 1
+    return labels, np.stack([rows[labels], cols[labels]], axis=1) / counts[labels, None]
+
+
+def write_labels_image(image, font_scale, centroids=None):
     """
     Creates an image on which the indices of labels are literally written in the center of each label.
+    Digits are copied from a glyph atlas rendered once (see `glyph_atlas`), all the labels being placed at once.
 
     Args:
         image: A labeled image.
         fonst_scale: Size of the font to write digits.
+        centroids: Centroids of the labels, as produced by `label_centroids`. They can come from a previous version of `image` from which labels were only removed: absent labels are skipped. If None, they are computed.
     
     Returns:
         A binary mask representing the literal index of each label.
     """
-    regions   = regionprops(image)
-    canvas    = np.zeros(image.shape, dtype=np.uint8)
-    thickness = 2
-
-    for region in regions:
-        y, x = region.centroid
-        size, baseline = cv2.getTextSize(str(region.label), cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
-        cv2.putText(canvas, str(region.label), (int(x-size[0]/2), int(y+size[1]/2)), cv2.FONT_HERSHEY_SIMPLEX, font_scale, 255, thickness)
+    canvas = np.zeros(image.shape, dtype=np.uint8)
+    if centroids is None:
+        labels, positions = label_centroids(image)
+    else:
+        labels, positions = centroids
+        present = np.bincount(image.ravel().astype(np.int64, copy=False), minlength=int(np.max(labels, initial=0))+1)[labels] > 0
+        labels, positions = labels[present], positions[present]
+    if len(labels) == 0:
+        return canvas
+
+    atlas  = glyph_atlas(font_scale)
+    glyphs = atlas['glyphs']
+
+    # >>> Origin of each number, centered on its label (as `cv2.putText` would place it).
+    n_digits      = np.floor(np.log10(labels)).astype(np.int64) + 1
+    width, height = atlas['size'](n_digits)
+    origin_x      = np.trunc(positions[:, 1] - width / 2).astype(np.int64)
+    origin_y      = np.trunc(positions[:, 0] + height / 2).astype(np.int64)
+
+    # >>> One glyph per digit: its value and its top-left corner.
+    owner  = np.repeat(np.arange(len(labels)), n_digits)
+    rank   = np.arange(len(owner)) - np.repeat(np.cumsum(n_digits) - n_digits, n_digits)
+    digits = (labels[owner] // 10**(n_digits[owner] - 1 - rank)) % 10
+    top    = origin_y[owner] + atlas['offset'][0]
+    left   = origin_x[owner] + atlas['offset'][1] + rank * atlas['advance']
+
+    # >>> All the glyphs are blitted at once, pixels falling out of the image being dropped. Where glyphs overlap, the brightest pixel is kept.
+    shape  = (len(digits),) + glyphs.shape[1:]
+    values = glyphs[digits]
+    rows   = np.broadcast_to(top[:, None, None] + np.arange(shape[1])[None, :, None], shape)
+    cols   = np.broadcast_to(left[:, None, None] + np.arange(shape[2])[None, None, :], shape)
+    mask   = (values > 0) & (rows >= 0) & (rows < image.shape[0]) & (cols >= 0) & (cols < image.shape[1])
+    np.maximum.at(canvas, (rows[mask], cols[mask]), values[mask])
 
     return canvas
 
@@ -91,24 +179,219 @@ def find_focused_slice(stack, around=2):
     return selected
 
 
-def segment_yeasts_cells(transmission, gpu=True):
+def own_channel(stack, slices_around=None):
+    """
+    Copies out of a hyperstack the part of a channel that the segmentation steps read, so the hyperstack can be freed right after the channels are split.
+    Steps give the same results on this copy as on the whole channel.
+
+    Args:
+        stack: A view on a channel (a single slice or a stack).
+        slices_around: If given, the slices around the focus are kept (see `find_focused_slice`). Otherwise, the maximal projection is kept.
+
+    Returns:
+        A new array, not sharing memory with `stack`, and the index of its first slice in `stack` (0 for a projection).
+    """
+    stack = np.squeeze(stack)
+    if stack.ndim < 3:
+        return np.array(stack), 0
+    if slices_around is None:
+        return np.max(stack, axis=0), 0
+    first, last = find_focused_slice(stack, slices_around)
+    return np.array(stack[first:last+1]), first
+
+
+class DiameterPolicy(object):
+    """
+    Decides which cells diameter is given to Cellpose.
+    Without a diameter, Cellpose runs its size-estimation model on every image, whereas cells have the same size across a plate.
+    The diameter is either fixed, or estimated on the first images and their median is reused for all the following ones.
+    """
+
+    def __init__(self, fixed=None, n_estimates=1):
+        """
+        Args:
+            fixed: Diameter (in pixels) given to Cellpose. If None (or <= 0), it is estimated.
+            n_estimates: Number of images on which the diameter is estimated before being frozen.
+        """
+        # Diameter imposed by the user, None if it must be estimated.
+        self.fixed       = float(fixed) if (fixed is not None) and (fixed > 0) else None
+        # Number of estimations to perform before using their median.
+        self.n_estimates = max(1, int(n_estimates))
+        # Diameters estimated by Cellpose so far.
+        self.estimates   = []
+        # Diameter used for the last image processed.
+        self.last        = None
+        # How `last` was obtained ('fixed', 'estimated' or 'median'), see `source`.
+        self.origin      = None
+
+    def diameter(self):
+        """
+        Returns:
+            The diameter to give to Cellpose for the next image, or None if it must be estimated.
+        """
+        if self.fixed is not None:
+            return self.fixed
+        if len(self.estimates) >= self.n_estimates:
+            return float(np.median(self.estimates))
+        return None
+
+    def update(self, used):
+        """
+        Records the diameter used by Cellpose on the last image (estimated or not).
+        """
+        self.last = float(used)
+        if self.fixed is not None:
+            self.origin = 'fixed'
+            return
+        if len(self.estimates) >= self.n_estimates: # The image received the frozen diameter.
+            self.origin = 'median' if (self.n_estimates > 1) else 'estimated'
+            return
+        # The image ran with its own estimate (even the one completing the set).
+        self.origin = 'estimated'
+        self.estimates.append(self.last)
+        if len(self.estimates) == self.n_estimates:
+            print(colored(f"Cells diameter set to {round(self.diameter(), 2)} pixels for the next images.", 'dark_grey'))
+
+    def source(self):
+        """
+        Returns:
+            How the diameter used for the last image was obtained ('fixed', 'estimated' or 'median'), as recorded by `update`.
+        """
+        return self.origin
+
+
+def upscale_labels(labels, shape, refine=True):
+    """
+    Brings a labeled image back to a higher resolution.
+    Labels are first upscaled with a nearest-neighbour interpolation, producing staircase-shaped boundaries.
+    Then, if `refine` is True, each pixel close to a boundary takes the label having the highest weight among its 4 neighbours in the low resolution image (bilinear weights).
+
+    Args:
+        labels: The labeled image at low resolution.
+        shape: The (height, width) of the output image.
+        refine: Whether the boundaries must be smoothed.
+
+    Returns:
+        A labeled image of the requested shape, with the same labels as the input.
+    """
+    h, w = labels.shape
+    rows = np.minimum(((np.arange(shape[0]) + 0.5) * h / shape[0]).astype(int), h - 1)
+    cols = np.minimum(((np.arange(shape[1]) + 0.5) * w / shape[1]).astype(int), w - 1)
+    upscaled = labels[rows[:, None], cols[None, :]]
+
+    factor = max(shape[0] / h, shape[1] / w)
+    if (not refine) or (factor <= 1.0):
+        return upscaled
+
+    # >>> Pixels close to a boundary, where the nearest neighbour can be wrong.
+    band   = binary_dilation(find_boundaries(upscaled, mode='thick'), iterations=max(1, int(np.ceil(factor)) // 2))
+    ys, xs = np.nonzero(band)
+
+    # >>> Position of these pixels in the low resolution image, and their 4 neighbours.
+    fy = np.clip((ys + 0.5) * h / shape[0] - 0.5, 0, h - 1)
+    fx = np.clip((xs + 0.5) * w / shape[1] - 0.5, 0, w - 1)
+    y0 = np.floor(fy).astype(int)
+    x0 = np.floor(fx).astype(int)
+    y1 = np.minimum(y0 + 1, h - 1)
+    x1 = np.minimum(x0 + 1, w - 1)
+    dy = fy - y0
+    dx = fx - x0
+
+    candidates = np.stack([labels[y0, x0], labels[y0, x1], labels[y1, x0], labels[y1, x1]])
+    weights    = np.stack([(1-dy)*(1-dx), (1-dy)*dx, dy*(1-dx), dy*dx])
+
+    # >>> Each candidate accumulates the weights of the neighbours sharing its label.
+    scores = np.zeros_like(weights)
+    for i in range(4):
+        scores[i] = np.sum(weights * (candidates == candidates[i]), axis=0)
+
+    upscaled[ys, xs] = candidates[np.argmax(scores, axis=0), np.arange(len(ys))]
+    return upscaled
+
+
+def segment_yeasts_cells(transmission, gpu=True, policy=None, scale=1.0):
     """
     Takes the transmission channel (brightfield) of yeast cells and segments it (instances segmentation).
     
     Args:
         transmission (image): Single channeled image, in brightfield, representing yeasts
+        policy: A `DiameterPolicy` providing the cells diameter. If None, Cellpose estimates it.
+        scale: Factor (in ]0, 1]) applied to the image before the inference, to speed it up. Masks are brought back to full resolution with `upscale_labels`.
     
     Returns:
         (image) An image containing labels (one value == one individual).
     """
     model = models.Cellpose(gpu=gpu, model_type='cyto')
     chan = [0, 0]
+    diameter = None if (policy is None) else policy.diameter()
+    shape    = transmission.shape
+
+    if scale < 1.0:
+        small_shape  = tuple(max(1, int(round(s * scale))) for s in shape)
+        transmission = resize(transmission.astype(np.float32), small_shape, order=1, anti_aliasing=True, preserve_range=True)
+        diameter     = None if (diameter is None) else diameter * scale
+
     print("Segmenting cells...")
-    masks, flows, styles, diams = model.eval(transmission, diameter=None, channels=chan)
+    masks, flows, styles, diams = model.eval(transmission, diameter=diameter, channels=chan)
+
+    if scale < 1.0:
+        masks = upscale_labels(masks, shape)
+        diams = diams / scale
+
+    if policy is not None:
+        policy.update(diams)
     print(f"Cells segmentation done. {len(np.unique(masks))-1} cells detected.")
     return masks
 
 
+def segment_yeasts_classical(transmission, sigma=1.0, min_distance=10, min_area=80):
+    """
+    Segments yeast cells from the brightfield without any deep-learning model.
+    Suited for bright and well separated fields, where it is much cheaper than Cellpose on CPU.
+
+    Principle:
+        1. The membranes are enhanced with a Sobel filter on the smoothed image.
+        2. Edges are thresholded (Otsu) and their holes are filled to get the cells' mask.
+        3. Cells are separated with a watershed seeded by the maxima of the distance transform of the mask.
+
+    Args:
+        transmission (image): Single channeled image, in brightfield, representing yeasts
+        sigma: Standard deviation of the Gaussian smoothing applied before the edge detection.
+        min_distance: Minimal distance (in pixels) between the centers of two cells.
+        min_area: Objects smaller than this area (in pixels) are discarded.
+    
+    Returns:
+        (image) An image containing labels (one value == one individual), with the same contract as `segment_yeasts_cells`.
+    """
+    print("Segmenting cells (classical)...")
+    smoothed = gaussian(transmission.astype(np.float64), sigma=sigma)
+    edges    = sobel(smoothed)
+    mask     = edges > threshold_otsu(edges)
+    mask     = binary_fill_holes(mask)
+    mask     = binary_opening(mask, structure=disk(2))
+    compos   = connected_compos_labeling(mask)
+    mask     = (compos > 0) & (np.bincount(compos.ravel())[compos] >= min_area)
+    compos[~mask] = 0
+
+    distance = distance_transform_edt(mask)
+    seeds    = peak_local_max(distance, min_distance=min_distance, labels=compos, exclude_border=False)
+    markers  = place_markers(mask.shape, seeds)
+    labels   = watershed(-distance, markers, mask=mask)
+    labels[np.bincount(labels.ravel())[labels] < min_area] = 0
+    masks, _, _ = relabel_sequential(labels)
+    masks    = masks.astype(np.int32)
+
+    print(f"Cells segmentation done. {len(np.unique(masks))-1} cells detected.")
+    return masks
+
+
+# Functions that can be used to segment cells from the projected brightfield.
+_cells_backends = {
+    'cellpose' : lambda image, gpu, policy, scale: segment_yeasts_cells(image, gpu, policy, scale),
+    'classical': lambda image, gpu, policy, scale: segment_yeasts_classical(image)
+}
+
+
 def place_markers(shp, m_list):
     """
     Places pixels with an incremental intensity (from 1) at each position contained in the list.
@@ -130,12 +413,16 @@ def place_markers(shp, m_list):
 #################################################################################
 
 
-def segment_transmission(stack, gpu=True, slices_around=2):
+def segment_transmission(stack, gpu=True, slices_around=2, backend='cellpose', diameters=None, scale=1.0, incremental=None):
     """
     Takes the path of an image that contains some yeasts in transmission.
 
     Args:
         stack: A numpy array representing the transmission channel
+        backend: Method used to segment cells: 'cellpose' or 'classical' (see `segment_yeasts_classical`).
+        diameters: A `DiameterPolicy` shared by the images of a batch (ignored by the 'classical' backend).
+        scale: Downscaling factor applied to the projection before Cellpose's inference (ignored by the 'classical' backend). Labels are always returned at full resolution.
+        incremental: An `IncrementalCells` for the frames of a time-lapse. If the projection barely changed since the last segmented frame, its labels are reused instead of running the backend.
 
     Returns:
         A uint16 image containing labels. Each label corresponds to an instance of yeast cell.
@@ -149,44 +436,70 @@ def segment_transmission(stack, gpu=True, slices_around=2):
     
     if len(stack_sz) > 2: # We have a stack, not a single image.
         # >>> Finding a range of slices in the focus area:
-        if pick_slices:
-            in_focus = find_focused_slice(stack, slices_around)
-        else:
-            in_focus = (0, stack.shape[0])
+        with profiled("focus"):
+            if pick_slices:
+                in_focus = find_focused_slice(stack, slices_around)
+            else:
+                in_focus = (0, stack.shape[0])
 
         # >>> Max projection of the stack:
-        max_proj = np.max(stack[in_focus[0]:in_focus[1]], axis=0)
+        with profiled("projection"):
+            max_proj = np.max(stack[in_focus[0]:in_focus[1]], axis=0)
         input_bf = max_proj
     else:
         input_bf = np.squeeze(stack)
     
     # >>> Labeling the transmission channel:
-    labeled_transmission = segment_yeasts_cells(input_bf, gpu)
+    if backend not in _cells_backends:
+        raise ValueError(f"Unknown cells segmentation backend: `{backend}`. Available: {list(_cells_backends.keys())}")
+
+    if incremental is not None:
+        with profiled("frame change"):
+            reused = incremental.reuse(input_bf)
+        if reused is not None:
+            return reused, input_bf
+
+    check_cancelled()
+    with profiled(backend), threads_for('cellpose'):
+        labeled_transmission = _cells_backends[backend](input_bf, gpu, diameters, scale)
+
+    if incremental is not None:
+        incremental.update(input_bf, labeled_transmission)
 
     return labeled_transmission, input_bf
 
 
 #################################################################################
 
-def associate_spots_yeasts(labeled_cells, labeled_spots, fluo_spots, area_threshold_down, area_threshold_up, solidity_threshold, extent_threshold, classification=None):
+def _spots_planes(labeled_spots):
+    # Labeled spots from `segment_spots_3d` are a stack in which each spot lies in a single slice: slices are measured one by one.
+    return labeled_spots if (labeled_spots.ndim == 3) else [labeled_spots]
+
+
+def associate_spots_yeasts(labeled_cells, labeled_spots, fluo_spots, area_threshold_down, area_threshold_up, solidity_threshold, extent_threshold, classification=None, measures=None):
     """
     Associates each spot with the label it belongs to.
     A safety check is performed to make sure no spot falls in the background.
 
     Args:
         labeled_cells: A single-channeled image with dtype=uint16 containing the segmented transmission image.
-        labeled_spots: A labelised image representing spots
+        labeled_spots: A labelised image representing spots, or a stack of such images (see `segment_spots_3d`), each spot lying in a single slice.
         fluo_spots: The original fluo image containing spots.
+        measures: Per-spot measures produced by the detection, as a dictionary {name: {spot label: value}} (ex: {'z': depths} with the depths from `segment_spots_3d`). Each spot gets a column per measure.
 
     Returns:
-        A dictionary in which keys are the labels of each cell. Each key points to a list of dictionary. Each element of the list corresponds to a spot.
+        A `SpotsTable` containing a record per spot, sorted by owning cell. It can still be read as a dictionary in which keys are the labels of each cell, each pointing to the list of its spots.
+        The locations of the spots (in the order of the table) are also returned.
         An image representing labels in the fluo channel (a label per spot) is also returned.
     """
     unique_values = np.unique(labeled_cells)
-    ownership     = {int(u): [] for u in unique_values if (u > 0)}
-    spots_props   = regionprops(labeled_spots, intensity_image=fluo_spots)
+    spots_props   = [p for plane in _spots_planes(labeled_spots) for p in regionprops(plane, intensity_image=fluo_spots)]
+    measures      = measures or {}
+    codes         = {} if (classification is None) else dict(zip(classification.keys(), category_codes(classification.values()).tolist()))
+    rows          = []
 
     for spot in spots_props:
+        check_cancelled()
         cds = [int(k) for k in spot.centroid]
         r, c = cds
         lbl = int(labeled_cells[r, c])
@@ -203,27 +516,251 @@ def associate_spots_yeasts(labeled_cells, labeled_spots, fluo_spots, area_thresh
         if float(spot['extent']) < extent_threshold:
             continue
         
-        ownership[lbl].append({
-            'label'         : int(spot['label']),
-            'location'      : (r, c),
-            'intensity_mean': round(float(spot['intensity_mean']), 3),
-            'intensity_min' : round(float(spot['intensity_min']), 3),
-            'intensity_max' : round(float(spot['intensity_max']), 3),
-            'area'          : round(float(spot['area']), 3),
-            'perimeter'     : round(float(spot['perimeter']), 3),
-            'solidity'      : round(float(spot['solidity']), 3),
-            'extent'        : round(float(spot['extent']), 3),
-            'intensity_sum' : int(np.sum(spot.intensity_image)),
-            'category'      : classification[int(spot['label'])] if (classification is not None) else None
-        })
-    
-    compare = np.array([item['label'] for sub_list in ownership.values() for item in sub_list])
-    removed_mask = np.isin(labeled_spots, compare, invert=True)
+        label = int(spot['label'])
+        rows.append((
+            lbl,
+            label,
+            r,
+            c,
+            round(float(spot['intensity_mean']), 3),
+            round(float(spot['intensity_min']), 3),
+            round(float(spot['intensity_max']), 3),
+            round(float(spot['area']), 3),
+            round(float(spot['perimeter']), 3),
+            round(float(spot['solidity']), 3),
+            round(float(spot['extent']), 3),
+            int(np.sum(spot.intensity_image)),
+            codes.get(label, 0),
+            r,
+            c,
+            np.nan,
+            np.nan
+        ) + tuple(np.nan if (values.get(label) is None) else values[label] for values in measures.values()))
+    
+    ownership = SpotsTable.from_rows(rows, unique_values[unique_values > 0], measures.keys())
+    removed_mask = np.isin(labeled_spots, ownership.records['label'], invert=True)
     labeled_spots[removed_mask] = 0
 
-    return ownership, np.array([item['location'] for sub_list in ownership.values() for item in sub_list]), labeled_spots
+    return ownership, ownership.locations(), labeled_spots
 
 
+def extract_patches(image, locations, radius):
+    """
+    Extracts a square patch around each location, all at once (the image is padded by replicating its border).
+
+    Args:
+        image: A 2D image.
+        locations: An array of (row, column) integer coordinates, of shape (N, 2).
+        radius: Half-size of the patches.
+
+    Returns:
+        An array of shape (N, 2*radius+1, 2*radius+1), in float32.
+    """
+    padded = np.pad(image.astype(np.float32, copy=False), radius, mode='edge')
+    offset = np.arange(2 * radius + 1)
+    rows   = locations[:, 0, None, None] + offset[None, :, None]
+    cols   = locations[:, 1, None, None] + offset[None, None, :]
+    return padded[rows, cols]
+
+
+def refine_spots(image, locations, radius=3):
+    """
+    Sub-pixel localization of all the spots of an image at once.
+    The background (median of each patch's border) is subtracted, then a 2D Gaussian (with one sigma per axis) is fitted on each patch.
+    The fit is a weighted least-squares fit of a quadratic on the logarithm of the patch (Guo's method), so all the patches are solved together as a stack of 5x5 systems.
+    Spots for which the fit fails (not a peak, center out of the patch) fall back on the intensity-weighted centroid.
+
+    Args:
+        image: The 2D image in which spots were detected.
+        locations: An array of (row, column) integer coordinates, of shape (N, 2).
+        radius: Half-size of the patches on which the fit is performed.
+
+    Returns:
+        A dictionary of arrays of length N:
+         - 'rows', 'cols': refined coordinates.
+         - 'sigma': mean of the fitted sigmas (NaN if the fit failed).
+         - 'amplitude': height of the fitted Gaussian above the background (NaN if the fit failed).
+         - 'r2': coefficient of determination of the fit (NaN if the fit failed).
+         - 'fitted': whether the Gaussian fit succeeded.
+    """
+    locations = np.asarray(locations, dtype=np.int64).reshape(-1, 2)
+    n         = len(locations)
+    if n == 0:
+        empty = np.zeros(0, dtype=np.float64)
+        return {'rows': empty, 'cols': empty, 'sigma': empty, 'amplitude': empty, 'r2': empty, 'fitted': np.zeros(0, dtype=bool)}
+
+    patches = extract_patches(image, locations, radius).astype(np.float64)
+    border  = np.concatenate([patches[:, 0, :], patches[:, -1, :], patches[:, 1:-1, 0], patches[:, 1:-1, -1]], axis=1)
+    signal  = np.clip(patches - np.median(border, axis=1)[:, None, None], 0.0, None).reshape(n, -1)
+
+    yy, xx = np.mgrid[-radius:radius+1, -radius:radius+1]
+    yy     = yy.ravel().astype(np.float64)
+    xx     = xx.ravel().astype(np.float64)
+
+    # >>> Intensity-weighted centroid (fallback).
+    total = signal.sum(axis=1)
+    safe  = np.where(total > 0, total, 1.0)
+    c_row = np.where(total > 0, (signal * yy).sum(axis=1) / safe, 0.0)
+    c_col = np.where(total > 0, (signal * xx).sum(axis=1) / safe, 0.0)
+
+    # >>> Weighted fit of log(I) = a + b.x + c.y + d.x^2 + e.y^2 on all patches at once.
+    valid   = signal > 1e-3 * signal.max(axis=1, keepdims=True)
+    weights = np.where(valid, signal**2, 0.0)
+    logs    = np.log(np.where(valid, signal, 1.0))
+    design  = np.stack([np.ones_like(xx), xx, yy, xx**2, yy**2], axis=1)
+    normal  = np.einsum('np,pi,pj->nij', weights, design, design)
+    target  = np.einsum('np,pi,np->ni', weights, design, logs)
+
+    solvable = (valid.sum(axis=1) >= 5) & (np.abs(np.linalg.det(normal)) > 1e-12)
+    normal[~solvable] = np.eye(5)
+    target[~solvable] = 0.0
+    a, b, c, d, e = np.linalg.solve(normal, target[:, :, None])[:, :, 0].T
+
+    fitted  = solvable & (d < 0) & (e < 0)
+    d       = np.where(fitted, d, -1.0)
+    e       = np.where(fitted, e, -1.0)
+    f_col   = -b / (2 * d)
+    f_row   = -c / (2 * e)
+    fitted &= (np.abs(f_col) <= radius) & (np.abs(f_row) <= radius)
+
+    s_col     = np.sqrt(-1.0 / (2 * d))
+    s_row     = np.sqrt(-1.0 / (2 * e))
+    amplitude = np.exp(np.clip(a - b**2 / (4 * d) - c**2 / (4 * e), None, 50.0))
+
+    # >>> Quality of the fit.
+    model    = amplitude[:, None] * np.exp(-(xx[None, :] - f_col[:, None])**2 / (2 * s_col[:, None]**2) - (yy[None, :] - f_row[:, None])**2 / (2 * s_row[:, None]**2))
+    residual = np.sum((signal - model)**2, axis=1)
+    spread   = np.sum((signal - signal.mean(axis=1, keepdims=True))**2, axis=1)
+    r2       = 1.0 - residual / np.where(spread > 0, spread, 1.0)
+
+    return {
+        'rows'     : locations[:, 0] + np.where(fitted, f_row, c_row),
+        'cols'     : locations[:, 1] + np.where(fitted, f_col, c_col),
+        'sigma'    : np.where(fitted, (s_row + s_col) / 2, np.nan),
+        'amplitude': np.where(fitted, amplitude, np.nan),
+        'r2'       : np.where(fitted, r2, np.nan),
+        'fitted'   : fitted
+    }
+
+
+def refine_ownership(ownership, image, radius=3):
+    """
+    Adds the sub-pixel coordinates ('y', 'x') and the quality of the fit ('fit_sigma', 'fit_r2') to every spot of an ownership (see `refine_spots`).
+    All the spots of the image are refined at once. The modification is made in-place.
+
+    Args:
+        ownership: A `SpotsTable`, or an ownership dictionary {cell label: list of spots' dictionaries}.
+    """
+    if not isinstance(ownership, SpotsTable):
+        spots = [spot for spots_list in ownership.values() for spot in spots_list]
+        if len(spots) == 0:
+            return ownership
+        fits = refine_spots(image, np.array([spot['location'] for spot in spots]), radius)
+        for i, spot in enumerate(spots):
+            spot['y']         = round(float(fits['rows'][i]), 3)
+            spot['x']         = round(float(fits['cols'][i]), 3)
+            spot['fit_sigma'] = round(float(fits['sigma'][i]), 3) if fits['fitted'][i] else None
+            spot['fit_r2']    = round(float(fits['r2'][i]), 4) if fits['fitted'][i] else None
+        return ownership
+
+    ownership.refined = True
+    if ownership.n_spots == 0:
+        return ownership
+    fits    = refine_spots(image, ownership.locations(), radius)
+    records = ownership.records
+    records['y']         = np.round(fits['rows'], 3)
+    records['x']         = np.round(fits['cols'], 3)
+    records['fit_sigma'] = np.where(fits['fitted'], np.round(fits['sigma'], 3), np.nan)
+    records['fit_r2']    = np.where(fits['fitted'], np.round(fits['r2'], 4), np.nan)
+    return ownership
+
+
+def _ensure_spacing(peaks, min_distance):
+    """
+    Greedy pass keeping a peak only if no stronger kept peak is closer than `min_distance` (Chebyshev distance).
+    Kept peaks are hashed in a grid of `min_distance`-wide buckets, so each peak is only compared to the 9 buckets around it.
+    """
+    buckets = {}
+    kept    = np.zeros(len(peaks), dtype=bool)
+    for i, (l, c) in enumerate(peaks.tolist()):
+        bl, bc  = l // min_distance, c // min_distance
+        blocked = False
+        for dl in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                for (ol, oc) in buckets.get((bl+dl, bc+dc), ()):
+                    if max(abs(ol - l), abs(oc - c)) < min_distance:
+                        blocked = True
+                        break
+                if blocked:
+                    break
+            if blocked:
+                break
+        if not blocked:
+            kept[i] = True
+            buckets.setdefault((bl, bc), []).append((l, c))
+    return peaks[kept]
+
+
+def find_peaks(image, min_distance=1, threshold_rel=None, tile=32):
+    """
+    Drop-in replacement for `peak_local_max(image, min_distance=min_distance, threshold_rel=threshold_rel)` (same peaks, same order).
+    Instead of filtering the whole frame, the non-maximum suppression only runs on the tiles containing pixels above the threshold.
+    On a chamfer map, it means only inside the spots mask, since the background is at 0.
+
+    Args:
+        image: 2D image in which peaks are searched.
+        min_distance: Minimal distance between two peaks, also used as the excluded border.
+        threshold_rel: Minimal intensity of a peak, relative to the maximal intensity of the image.
+        tile: Side of the tiles on which the maximum filter is applied.
+
+    Returns:
+        A (N, 2) array of coordinates, sorted by decreasing intensity.
+    """
+    threshold = image.min()
+    if threshold_rel is not None:
+        threshold = max(threshold, threshold_rel * image.max())
+
+    candidates = image > threshold
+    if min_distance > 0:
+        candidates[:min_distance]  = False
+        candidates[-min_distance:] = False
+        candidates[:, :min_distance]  = False
+        candidates[:, -min_distance:] = False
+
+    height, width = image.shape
+    t_rows   = -(-height // tile)
+    t_cols   = -(-width // tile)
+    occupied = np.zeros((t_rows * tile, t_cols * tile), dtype=bool)
+    occupied[:height, :width] = candidates
+    occupied = occupied.reshape(t_rows, tile, t_cols, tile).any(axis=(1, 3))
+
+    size  = 2 * min_distance + 1
+    rows, cols = [], []
+    for tr, tc in zip(*np.nonzero(occupied)):
+        r0, c0 = tr * tile, tc * tile
+        r1, c1 = min(r0 + tile, height), min(c0 + tile, width)
+        # Halo of `min_distance` pixels, so the filter sees the same neighbourhood as on the whole image.
+        h0, g0 = max(r0 - min_distance, 0), max(c0 - min_distance, 0)
+        h1, g1 = min(r1 + min_distance, height), min(c1 + min_distance, width)
+        local  = maximum_filter(image[h0:h1, g0:g1], size=size, mode='nearest')
+        inner  = local[r0-h0:r1-h0, c0-g0:c1-g0]
+        l, c   = np.nonzero(candidates[r0:r1, c0:c1] & (image[r0:r1, c0:c1] == inner))
+        rows.append(l + r0)
+        cols.append(c + c0)
+
+    if len(rows) == 0:
+        return np.zeros((0, 2), dtype=np.intp)
+    rows   = np.concatenate(rows)
+    cols   = np.concatenate(cols)
+    # Strongest first, ties in raster order (as `peak_local_max` does).
+    order  = np.lexsort((cols, rows, -image[rows, cols]))
+    coords = np.stack((rows[order], cols[order]), axis=1)
+    if min_distance > 1:
+        coords = _ensure_spacing(coords, min_distance)
+    return coords
+
+
+@scheduled('filters')
 def segment_spots(stack, labeled_cells, death_threshold, sigma=3.0, peak_d=5, threshold_rel=0.7):
     """
     Args:
@@ -241,51 +778,275 @@ def segment_spots(stack, labeled_cells, death_threshold, sigma=3.0, peak_d=5, th
     input_fSpots = None
 
     # >>> Max projection of the stack
-    if len(stack_sz) > 2: # We have a stack, not a single image.
-        input_fSpots = np.max(stack, axis=0)
-    else:
-        input_fSpots = np.squeeze(stack)
+    with profiled("projection"):
+        if len(stack_sz) > 2: # We have a stack, not a single image.
+            input_fSpots = np.max(stack, axis=0)
+        else:
+            input_fSpots = np.squeeze(stack)
 
     # >>> Contrast augmentation + noise reduction
     print("Starting spots segmentation...")
-    save_fSpots  = np.copy(input_fSpots)
-    input_fSpots = median_filter(input_fSpots, size=3)
+    with profiled("filtering"):
+        save_fSpots  = np.copy(input_fSpots)
+        input_fSpots = median_filter(input_fSpots, size=3)
 
-    # >>> LoG filter + thresholding
-    asf  = input_fSpots.astype(np.float64)
-    LoG  = gaussian_laplace(asf, sigma=sigma)
-    t    = threshold_isodata(LoG)
-    mask = LoG < t
+        # >>> LoG filter + thresholding
+        asf  = input_fSpots.astype(np.float64)
+        LoG  = gaussian_laplace(asf, sigma=sigma)
+        t    = threshold_isodata(LoG)
+        mask = LoG < t
 
     # >>> Detection of spots location
-    asf     = mask.astype(np.float64)
-    chamfer = distance_transform_cdt(asf)
-    maximas = peak_local_max(chamfer, min_distance=peak_d, threshold_rel=threshold_rel)
+    with profiled("peaks"):
+        asf     = mask.astype(np.float64)
+        chamfer = distance_transform_cdt(asf)
+        maximas = find_peaks(chamfer, peak_d, threshold_rel)
 
     # Removing dead cells
-    dead_cells = set()
-    for props in regionprops(labeled_cells, intensity_image=save_fSpots):
-        if props['intensity_mean'] >= death_threshold:
-            dead_cells.add(props['label'])
-    
-    print(f"{len(dead_cells)} are now considered dead due to an excessive intensity.")
-    remove_labels(labeled_cells, dead_cells)
-    print(f"{len(maximas)} spots found.")
+    with profiled("dead cells"):
+        dead_cells = set()
+        for props in regionprops(labeled_cells, intensity_image=save_fSpots):
+            if props['intensity_mean'] >= death_threshold:
+                dead_cells.add(props['label'])
+        
+        print(f"{len(dead_cells)} are now considered dead due to an excessive intensity.")
+        remove_labels(labeled_cells, dead_cells)
+        print(f"{len(maximas)} spots found.")
 
-    maximas = [m for m in maximas if labeled_cells[m[0], m[1]] > 0]
+        maximas = maximas[labeled_cells[maximas[:, 0], maximas[:, 1]] > 0]
 
     # >>> Isolating instances of spots
-    m_shape   = mask.shape[0:2]
-    markers   = place_markers(m_shape, maximas)
-    lbd_spots = watershed(~mask, markers, mask=mask).astype(np.uint16)
+    with profiled("relabel"):
+        m_shape   = mask.shape[0:2]
+        markers   = place_markers(m_shape, maximas)
+        lbd_spots = watershed(~mask, markers, mask=mask).astype(np.uint16)
 
-    # Sorting coordinates by label index.
-    maximas = np.array([(l, c) for (s, l, c) in sorted([(lbd_spots[l, c], l, c) for (l, c) in maximas])])
+        # Sorting coordinates by label index.
+        maximas = np.array([(l, c) for (s, l, c) in sorted([(lbd_spots[l, c], l, c) for (l, c) in maximas])])
 
     # >>> List of spots coordinates, labeled spots, flattened version of spots' fluo channel.
     return maximas, lbd_spots, save_fSpots
 
 
+def _chunks(height, chunk_rows, halo):
+    """
+    Splits the rows of an image in chunks extended by a halo.
+
+    Returns:
+        A list of (start, end, core_start, core_end): the rows to read, and the rows (relative to `start`) whose results are kept.
+    """
+    chunks = []
+    for c0 in range(0, height, chunk_rows):
+        c1 = min(height, c0 + chunk_rows)
+        r0 = max(0, c0 - halo)
+        r1 = min(height, c1 + halo)
+        chunks.append((r0, r1, c0 - r0, c1 - r0))
+    return chunks
+
+
+def _log_rows(slab, r0, r1, sigma, sigma_z):
+    """
+    LoG response (after a median filter in the plane) of the rows [r0, r1) of a slab, in float32.
+    The filters read a halo of rows around them, so the result doesn't depend on how the slab is split.
+    """
+    halo   = int(np.ceil(4 * max(sigma, sigma_z))) + 2
+    e0, e1 = max(0, r0 - halo), min(slab.shape[1], r1 + halo)
+    chunk  = median_filter(slab[:, e0:e1], size=(1, 3, 3)).astype(np.float32)
+    return gaussian_laplace(chunk, sigma=(sigma_z, sigma, sigma))[:, r0-e0:r1-e0]
+
+
+@scheduled('filters')
+def segment_spots_3d(stack, labeled_cells, death_threshold, sigma=3.0, peak_d=5, threshold_rel=0.7, slices_around=2, sigma_z=1.0, chunk_rows=256, peak_dz=1, n_samples=2**20):
+    """
+    Detects spots in 3D, on a slab of slices around the focus, instead of working on the maximal projection.
+    Spots at different depths don't merge anymore (even at the same position in the plane), and the depth of each spot is measured.
+    Spots are the local maxima of the LoG response (inside the thresholded areas) above `threshold_rel` times the strongest response.
+    Each spot is segmented in the slice of its maximum, so spots at different depths have their own label.
+    The slab is processed by chunks of rows (extended by a halo): the LoG is never allocated for the whole slab.
+    It is computed twice, the first pass only sampling it to find the threshold.
+
+    Args:
+        stack: A numpy array representing the fluo channel (Z, Y, X). A single slice falls back to `segment_spots`.
+        sigma: Standard deviation (in pixels) of the LoG filter in the plane.
+        peak_d: Minimal distance (in pixels) between two spots in the plane.
+        sigma_z: Standard deviation (in slices) of the LoG filter along the Z axis.
+        slices_around: Number of slices taken around the focus slice.
+        chunk_rows: Number of rows processed at once.
+        peak_dz: Minimal distance (in slices) between two spots at the same position in the plane.
+        n_samples: Approximate number of voxels of the LoG response on which the threshold is computed.
+
+    Returns:
+        - The (slice, row, column) coordinates of the spots (slices are indices in the slab), sorted by label.
+        - The labeled spots, as a stack of the size of the slab: each spot lies in the slice of its maximum.
+        - The maximal projection of the slab.
+        - A dictionary giving the index (in `stack`) of the slice of each spot's label.
+    """
+    if stack.ndim < 3:
+        maximas, lbd_spots, flat = segment_spots(stack, labeled_cells, death_threshold, sigma, peak_d, threshold_rel)
+        return maximas, lbd_spots, flat, {int(lbd_spots[l, c]): 0 for (l, c) in maximas}
+
+    with profiled("projection"):
+        first, last = find_focused_slice(stack, slices_around)
+        slab        = stack[first:last+1]
+        save_fSpots = np.max(slab, axis=0)
+
+    print("Starting 3D spots segmentation...")
+    n_slices, height, width = slab.shape
+
+    # >>> Threshold of the LoG response, on a grid of rows and columns (the same whatever the chunks).
+    with profiled("filtering"):
+        step    = max(1, int(np.sqrt(slab.size / n_samples)))
+        samples = []
+        for r0, r1, k0, k1 in _chunks(height, chunk_rows, 0):
+            rows = np.arange(r0 + (-r0 % step), r1, step)
+            if len(rows) > 0:
+                samples.append(_log_rows(slab, r0, r1, sigma, sigma_z)[:, rows - r0, ::step].ravel())
+        t = threshold_isodata(np.concatenate(samples))
+
+    # >>> Local maxima of the LoG response inside the thresholded areas, in 3D (the neighbourhood is narrower along Z).
+    with profiled("peaks"):
+        footprint  = np.ones((2 * peak_dz + 1, 2 * peak_d + 1, 2 * peak_d + 1), dtype=bool)
+        mask_3d    = np.zeros(slab.shape, dtype=bool)
+        candidates = []
+        top        = 0.0
+        for r0, r1, k0, k1 in _chunks(height, chunk_rows, peak_d + 1):
+            response = -_log_rows(slab, r0, r1, sigma, sigma_z)
+            mask     = response > -t
+            peaks    = peak_local_max(response, footprint=footprint, threshold_abs=-t, exclude_border=False, labels=mask.astype(np.uint8))
+            peaks    = peaks[(peaks[:, 1] >= k0) & (peaks[:, 1] < k1)]
+            mask_3d[:, r0+k0:r0+k1] = mask[:, k0:k1]
+            if len(peaks) > 0:
+                values = response[peaks[:, 0], peaks[:, 1], peaks[:, 2]]
+                top    = max(top, float(values.max()))
+                peaks[:, 1] += r0
+                candidates.append((peaks, values))
+
+        if len(candidates) > 0:
+            maximas = np.concatenate([p for p, _ in candidates])
+            values  = np.concatenate([v for _, v in candidates])
+            # Strongest first (as `peak_local_max` does), so labels don't depend on the chunks.
+            order   = np.lexsort((maximas[:, 2], maximas[:, 1], maximas[:, 0], -values))
+            maximas = maximas[order][values[order] >= threshold_rel * top]
+        else:
+            maximas = np.zeros((0, 3), dtype=np.int64)
+        # Same margin as `peak_local_max` on 2D images.
+        inside  = (maximas[:, 1] >= peak_d) & (maximas[:, 1] < height - peak_d) & (maximas[:, 2] >= peak_d) & (maximas[:, 2] < width - peak_d)
+        maximas = maximas[inside]
+
+    # Removing dead cells
+    with profiled("dead cells"):
+        dead_cells = set()
+        for props in regionprops(labeled_cells, intensity_image=save_fSpots):
+            if props['intensity_mean'] >= death_threshold:
+                dead_cells.add(props['label'])
+        
+        print(f"{len(dead_cells)} are now considered dead due to an excessive intensity.")
+        remove_labels(labeled_cells, dead_cells)
+        print(f"{len(maximas)} spots found.")
+
+        maximas = maximas[labeled_cells[maximas[:, 1], maximas[:, 2]] > 0]
+
+    # >>> Isolating instances of spots, each one in the slice of its maximum.
+    with profiled("relabel"):
+        lbd_spots = np.zeros(slab.shape, dtype=np.uint16)
+        for z in np.unique(maximas[:, 0]):
+            in_slice = np.flatnonzero(maximas[:, 0] == z)
+            markers  = np.zeros((height, width), dtype=np.uint16)
+            markers[maximas[in_slice, 1], maximas[in_slice, 2]] = in_slice + 1
+            lbd_spots[z] = watershed(~mask_3d[z], markers, mask=mask_3d[z])
+        print(f"{len(maximas)} seeds placed.")
+
+        depths = {i: int(z) + first for i, z in enumerate(maximas[:, 0].tolist(), start=1)}
+
+    return maximas, lbd_spots, save_fSpots, depths
+
+
+def scale_levels(sigmas):
+    """
+    Blur levels of the scale space used by `segment_spots_multiscale`: the difference between two consecutive levels gives the response at one sigma.
+    Levels are the geometric means of consecutive sigmas (with one extra level at each end), so each sigma lies at the center of its band.
+    Repeated sigmas are merged, as two equal levels would produce an empty band.
+    """
+    sigmas = np.unique(np.asarray(sigmas, dtype=np.float64))
+    if len(sigmas) == 1:
+        return np.array([sigmas[0] / 1.25, sigmas[0] * 1.25])
+    ratios = sigmas[1:] / sigmas[:-1]
+    inner  = np.sqrt(sigmas[1:] * sigmas[:-1])
+    return np.concatenate([[sigmas[0] / np.sqrt(ratios[0])], inner, [sigmas[-1] * np.sqrt(ratios[-1])]])
+
+
+@scheduled('filters')
+def segment_spots_multiscale(stack, labeled_cells, death_threshold, sigmas=(1.5, 2.0, 3.0, 4.0), peak_d=5, threshold_rel=0.7):
+    """
+    Detects spots of various sizes in a single pass, and measures the scale of each spot.
+    A Gaussian scale space is built incrementally (each level is obtained by blurring the previous one with the missing variance, with small kernels).
+    The difference between two consecutive levels, normalized by their ratio, approximates the scale-normalized LoG at an intermediate sigma.
+    A spot is a local maximum of the strongest response across scales, which is also a maximum in the (scale, y, x) space. Its best sigma is the one producing this response.
+
+    Args:
+        stack: A numpy array representing the fluo channel
+        sigmas: Sigmas (in pixels) at which spots are searched. A spot of radius `r` responds the most at `r / sqrt(2)`. Repeated sigmas are searched once (equal bounds fall back on a single scale).
+        peak_d: Minimal distance between two spots.
+        threshold_rel: Minimal response of a spot, relative to the strongest response in the image.
+
+    Returns:
+        The same elements as `segment_spots`, and a dictionary giving the best sigma of each spot's label.
+    """
+    with profiled("projection"):
+        if len(stack.shape) > 2:
+            input_fSpots = np.max(stack, axis=0)
+        else:
+            input_fSpots = np.squeeze(stack)
+
+    sigmas = np.unique(np.asarray(sigmas, dtype=np.float64))
+    print(f"Starting multi-scale spots segmentation ({len(sigmas)} scales)...")
+    levels = scale_levels(sigmas)
+
+    with profiled("filtering"):
+        save_fSpots = np.copy(input_fSpots)
+        current     = gaussian_filter(median_filter(input_fSpots, size=3).astype(np.float32), levels[0])
+        response    = np.full(current.shape, -np.inf, dtype=np.float32)
+        best        = np.zeros(current.shape, dtype=np.uint8)
+        for i in range(len(sigmas)):
+            following = gaussian_filter(current, np.sqrt(levels[i+1]**2 - levels[i]**2))
+            dog       = (current - following) / np.float32(levels[i+1] / levels[i] - 1.0) # Scale-normalized, positive on bright spots.
+            better    = dog > response
+            response[better] = dog[better]
+            best[better]     = i
+            current   = following
+        del current, following, dog
+
+        t    = threshold_isodata(response)
+        mask = response > max(t, 0.0)
+
+    # >>> Maxima of the strongest response, inside the mask.
+    with profiled("peaks"):
+        maximas = peak_local_max(response, min_distance=peak_d, threshold_rel=threshold_rel, labels=mask.astype(np.uint8))
+
+    # Removing dead cells
+    with profiled("dead cells"):
+        dead_cells = set()
+        for props in regionprops(labeled_cells, intensity_image=save_fSpots):
+            if props['intensity_mean'] >= death_threshold:
+                dead_cells.add(props['label'])
+        
+        print(f"{len(dead_cells)} are now considered dead due to an excessive intensity.")
+        remove_labels(labeled_cells, dead_cells)
+        print(f"{len(maximas)} spots found.")
+
+        maximas = maximas[labeled_cells[maximas[:, 0], maximas[:, 1]] > 0]
+
+    # >>> Isolating instances of spots
+    with profiled("relabel"):
+        markers   = place_markers(mask.shape, maximas)
+        lbd_spots = watershed(~mask, markers, mask=mask).astype(np.uint16)
+
+        scales  = {int(lbd_spots[l, c]): float(sigmas[best[l, c]]) for (l, c) in maximas}
+        maximas = np.array([(l, c) for (s, l, c) in sorted([(lbd_spots[l, c], l, c) for (l, c) in maximas])])
+
+    return maximas, lbd_spots, save_fSpots, scales
+
+
 ################################################################
 
 def prepare_directory(path):
@@ -375,9 +1136,11 @@ class YeastsPartitionGraph(object):
                     'dist'       : 0
                 }
         
-        self.launch_hopcroft_karp()
-        self.make_new_labels(labeled_yeasts, labeled_nuclei, cell_to_nuclei)
-        self.remove_borders(labeled_yeasts, labeled_nuclei)
+        with profiled("matching"):
+            self.launch_hopcroft_karp()
+        with profiled("relabel"):
+            self.make_new_labels(labeled_yeasts, labeled_nuclei, cell_to_nuclei)
+            self.remove_borders(labeled_yeasts, labeled_nuclei)
         print(colored("Maximum bipartite matching of the adjacency graph finished.", 'green'))
 
     def remove_borders(self, labeled_yeasts, labeled_nuclei):
@@ -522,7 +1285,9 @@ class YeastsPartitionGraph(object):
             }
 
         while self.bfs():
+            check_cancelled()
             for node in self.graph:
+                check_cancelled()
                 if self.graph[node]['partition'] != 1:
                     continue
                 if self.graph[node]['bound_to'] == None and self.dfs(node):
@@ -592,6 +1357,8 @@ def adjacency_graph(labeled_cells, check_undirected=False):
     print("Building adjacency graph of the cells.")
 
     for (l, c), cell_label in np.ndenumerate(labeled_cells):
+        if c == 0: # Once per row.
+            check_cancelled()
         if cell_label == 0:
             continue
         graph.setdefault(cell_label, set())
@@ -710,6 +1477,7 @@ def assign_nucleus(labeled_cells, labeled_nuclei, covering_threshold, graph=None
     # 3. Building an association table in both ways (nucleus -> cells & cell -> nuclei)
     nuclei_props  = regionprops(labeled_nuclei, intensity_image=labeled_cells)
     for nucleus in nuclei_props: # In this loop, we iterate through nuclei to find by how many cells it's being used.
+        check_cancelled()
         nucleus_lbl = nucleus.label
         l, c        = [int(k) for k in nucleus.centroid]
         cell_lbl    = labeled_cells[l, c]
@@ -807,7 +1575,8 @@ def assign_nucleus(labeled_cells, labeled_nuclei, covering_threshold, graph=None
     return labeled_cells, labeled_nuclei, graph, cell_to_nuclei, nucleus_to_cells
 
 
-def segment_nuclei(labeled_yeasts, stack_fluo_nuclei, threshold_coverage):
+@scheduled('filters')
+def segment_nuclei(labeled_yeasts, stack_fluo_nuclei, threshold_coverage, copy=True):
     """
     Launches the procedure to segment nuclei from the dedicated fluo channel, and merge mother cells with their daughter if the division process is still ongoing.
 
@@ -815,18 +1584,24 @@ def segment_nuclei(labeled_yeasts, stack_fluo_nuclei, threshold_coverage):
         labeled_yeasts: Image containing the labeled yeast cells.
         stack_fluo_nuclei: Image containing the stained nuclei.
         threshold_coverage: Percentage (in [0.0, 1.0]) of a cell that must be covered by a nucleus to be considered dead.
+        copy: If False, `labeled_yeasts` is modified in place instead of being copied (the caller gives up its version).
     
     Returns:
         - The maximal projection of the stained nuclei channel.
         - The labeled yeasts from which we removed the dead cells.
         - The image containing the labeled nuclei.
     """
-    labeled_yeasts = np.copy(labeled_yeasts)
-    flattened_nuclei, labeled_nuclei = nuclei_from_fluo(stack_fluo_nuclei)
-    graph = adjacency_graph(labeled_yeasts)
+    if copy:
+        labeled_yeasts = np.copy(labeled_yeasts)
+    with profiled("projection"):
+        flattened_nuclei, labeled_nuclei = nuclei_from_fluo(stack_fluo_nuclei)
+    check_cancelled()
+    with profiled("graph"):
+        graph = adjacency_graph(labeled_yeasts)
     
     print("Starting nuclei segmentation.")
-    labeled_cells, labeled_nuclei, graph, cell_to_nuclei, nucleus_to_cells = assign_nucleus(labeled_yeasts, labeled_nuclei, threshold_coverage, graph)
+    with profiled("assignment"):
+        labeled_cells, labeled_nuclei, graph, cell_to_nuclei, nucleus_to_cells = assign_nucleus(labeled_yeasts, labeled_nuclei, threshold_coverage, graph)
     ypg = YeastsPartitionGraph(graph, cell_to_nuclei, nucleus_to_cells, labeled_yeasts, labeled_nuclei)
     print(colored("Segmentation of nuclei done.", 'green'))
 
@@ -841,30 +1616,29 @@ def distance_spot_nuclei(labeled_cells, labeled_nuclei, labeled_spots):
     Args:
         labeled_cells: The image containing labeled cells.
         labeled_nuclei: The image containing labeled nuclei.
-        labeled_spots: The image containing labeled spots.
+        labeled_spots: The image containing labeled spots (or a stack of them, see `segment_spots_3d`).
     
     Returns:
         A dictionary giving for each spot label (int), its category (str).
     """
-    total_regions  = regionprops(labeled_cells, intensity_image=labeled_spots)
-    nuclei_regions = regionprops(labeled_nuclei, intensity_image=labeled_spots)
     total_sizes   = {}
-
-    # Extracting total size of every spot.
-    for region in total_regions:
-        vals, counts = np.unique(region.image_intensity, return_counts=True)
-        for spot_label, count in zip(vals, counts):
-            total_sizes[spot_label] = count
-    
-    nuclear_sizes = {k: 0 for k in total_sizes.keys()}
-    for region in nuclei_regions:
-        vals, counts = np.unique(region.image_intensity, return_counts=True)
-        for spot_label, count in zip(vals, counts):
-            nuclear_sizes[spot_label] = count
+    nuclear_sizes = {}
+
+    for plane in _spots_planes(labeled_spots):
+        # Extracting total size of every spot.
+        for region in regionprops(labeled_cells, intensity_image=plane):
+            vals, counts = np.unique(region.image_intensity, return_counts=True)
+            for spot_label, count in zip(vals, counts):
+                total_sizes[spot_label] = count
+        
+        for region in regionprops(labeled_nuclei, intensity_image=plane):
+            vals, counts = np.unique(region.image_intensity, return_counts=True)
+            for spot_label, count in zip(vals, counts):
+                nuclear_sizes[spot_label] = count
     
     classification = {k: 'UNDEFINED' for k in total_sizes.keys()}
     for label, total_count in total_sizes.items():
-        ratio = nuclear_sizes[label] / total_count
+        ratio = nuclear_sizes.get(label, 0) / total_count
         if (ratio > 0.99):
             classification[label] = 'NUCLEAR'
         elif (ratio <= 0.001):
@@ -875,74 +1649,139 @@ def distance_spot_nuclei(labeled_cells, labeled_nuclei, labeled_spots):
     print(colored("Spots classified.", 'green'))
     return classification
 
-def create_reference_to(labeled_cells, labeled_spots, spots_list, name, control_dir_path, source_path, projection_cells, projection_spots, indices, labeled_nuclei, nuclei_fluo, spots_colors):
+def spots_distances(labeled_cells, labeled_nuclei, labeled_spots, locations):
+    """
+    Measures the distance (in pixels) from every spot to the boundary of its cell's nucleus, and to the membrane of its cell.
+    Each distance map is a single Euclidean distance transform of the whole image, sampled at all the spots' locations at once.
+
+    Args:
+        labeled_cells: The image containing labeled cells.
+        labeled_nuclei: The image containing labeled nuclei. If None, only the distance to the membrane is measured.
+        labeled_spots: The image containing labeled spots (or a stack of them, see `segment_spots_3d`).
+        locations: Coordinates of the spots, as produced by the spots segmentation (with their slice for a stack).
+
+    Returns:
+        A dictionary of measures {name: {spot label: distance}}, that can be given to `associate_spots_yeasts`:
+         - 'membrane_distance': Distance to the closest pixel outside of the spot's cell.
+         - 'nucleus_distance': Signed distance to the nucleus boundary (negative inside the nucleus). None if the closest nucleus is not in the spot's cell.
+    """
+    locations = np.asarray(locations, dtype=np.intp).reshape(-1, labeled_spots.ndim)
+    rows, cols = locations[:, -2], locations[:, -1]
+    labels    = labeled_spots[tuple(locations.T)].tolist()
+    owners    = labeled_cells[rows, cols]
+
+    # The boundaries between touching cells are removed, so each cell is measured against its own membrane.
+    interior  = (labeled_cells > 0) & ~find_boundaries(labeled_cells, mode='inner')
+    membrane  = distance_transform_edt(interior)[rows, cols]
+    distances = {
+        'membrane_distance': {l: round(float(d), 3) for l, d in zip(labels, membrane)},
+        'nucleus_distance' : {l: None for l in labels}
+    }
+
+    if (labeled_nuclei is None) or not np.any(labeled_nuclei):
+        return distances
+
+    nuclei = labeled_nuclei > 0
+    outside, (n_rows, n_cols) = distance_transform_edt(~nuclei, return_indices=True)
+    signed = outside[rows, cols] - distance_transform_edt(nuclei)[rows, cols]
+    # The closest nucleus pixel must belong to the spot's own cell.
+    valid  = labeled_cells[n_rows[rows, cols], n_cols[rows, cols]] == owners
+
+    distances['nucleus_distance'] = {l: (round(float(d), 3) if v else None) for l, d, v in zip(labels, signed, valid)}
+    return distances
+
+def create_reference_to(labeled_cells, labeled_spots, spots_list, name, control_dir_path, source_path, projection_cells, projection_spots, indices, labeled_nuclei, nuclei_fluo, spots_colors, writer=None, settings_hash=None, diameter=None):
     """
     Creates a folder containing everything a user needs to see in order to check whether the process ended correctly and produced a correct segmentation.
+    Images are written with a lossless compression, and labels are stored with their minimal dtype.
+
+    Args:
+        writer: A `ControlWriter` in charge of writing files in the background. If None, files are written synchronously before returning.
+        settings_hash: Hash of the settings used to produce this control, recorded in the index.
+        diameter: A (diameter, source) tuple describing the cells diameter given to Cellpose, recorded in the index.
     """
     present = datetime.now()
+    owned   = writer is None
+    writer  = ControlWriter(n_workers=0) if owned else writer
 
     # Projection of brightfield
-    imsave(
+    writer.write_image(
+        control_dir_path,
         os.path.join(control_dir_path, name+"_bf.tif"),
         projection_cells)
 
     # Projection of spots fluo
-    imsave(
+    writer.write_image(
+        control_dir_path,
         os.path.join(control_dir_path, name+"_fluo_spots.tif"),
         projection_spots)
 
     # Projections of nuclei fluo
     if nuclei_fluo is not None:
-        imsave(
+        writer.write_image(
+            control_dir_path,
             os.path.join(control_dir_path, name+"_fluo_nuclei.tif"),
             nuclei_fluo)
 
     # ----
 
     # Cells indices
-    imsave(
+    writer.write_image(
+        control_dir_path,
         os.path.join(control_dir_path, name+"_indices.tif"),
         indices)
 
     # ----
     
     # Labeled cells
-    imsave(
+    writer.write_image(
+        control_dir_path,
         os.path.join(control_dir_path, name+"_segmented_cells.tif"),
-        labeled_cells)
+        labeled_cells,
+        labels=True)
 
     # labeled spots
-    imsave(
+    writer.write_image(
+        control_dir_path,
         os.path.join(control_dir_path, name+"_segmented_spots.tif"),
-        labeled_spots)
+        labeled_spots,
+        labels=True)
 
     # Labeled nuclei
     if labeled_nuclei is not None:
-        imsave(
+        writer.write_image(
+            control_dir_path,
             os.path.join(control_dir_path, name+"_segmented_nuclei.tif"),
-            labeled_nuclei)
+            labeled_nuclei,
+            labels=True)
 
     # Class of the spots
     if spots_colors is not None:
-        with open(os.path.join(control_dir_path, name+"_spots_colors.txt"), 'w') as f:
-            textual = "\n".join(spots_colors)
-            f.write(textual)
+        writer.write_text(
+            control_dir_path,
+            os.path.join(control_dir_path, name+"_spots_colors.txt"),
+            "\n".join(spots_colors))
     
     # ----
 
     # Create the CSV with spots list, save it along segmented spots
-    np.savetxt(
+    writer.write_table(
+        control_dir_path,
         os.path.join(control_dir_path, name+".csv"),
         spots_list,
-        delimiter=',',
-        header="axis-0, axis-1")
-
-    # Saving the index to read the folder
-    f = open(os.path.join(control_dir_path, "index.txt"), 'w')
-    f.write("name\n")
-    f.write(name+"\n")
-    f.write("sources\n")
-    f.write(source_path+"\n")
-    f.write("time\n")
-    f.write(present.strftime("%d/%B/%Y (%H:%M:%S)")+"\n")
-    f.close()
+        "axis-0, axis-1",
+        '%d')
+
+    # Saving the index to read the folder (written last, once the folder is complete)
+    index = f"name\n{name}\nsources\n{source_path}\ntime\n{present.strftime('%d/%B/%Y (%H:%M:%S)')}\n"
+    if settings_hash is not None:
+        index += f"settings\n{settings_hash}\n"
+    if diameter is not None:
+        index += f"diameter\n{round(diameter[0], 3)} ({diameter[1]})\n"
+    writer.seal(
+        control_dir_path,
+        os.path.join(control_dir_path, "index.txt"),
+        index)
+
+    if owned:
+        writer.close()
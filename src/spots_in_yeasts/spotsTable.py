@@ -0,0 +1,190 @@
+"""
+Columnar representation of the ownership of spots: which cell owns which spot, and the measures of each spot.
+All the spots of an image are stored in a single numpy structured array (one record per spot), sorted by owning cell.
+A cell index (the sorted labels of the cells, and the offset of their first spot) gives the spots of a cell as a slice.
+Consumers (tables, colors, summaries, results index) work on whole columns instead of iterating dictionaries.
+
+For backward compatibility, a `SpotsTable` can be read as the former ownership dictionary {cell label: list of spots' dictionaries}.
+"""
+
+from collections.abc import Mapping
+import numpy as np
+
+# Categories of spots (see `distance_spot_nuclei`), indexed by their code. Code 0 means that spots were not classified.
+categories = [None, 'NUCLEAR', 'CYTOPLASMIC', 'PERIPHERAL', 'UNDEFINED']
+
+# Measures produced by the detection of every spot (see `associate_spots_yeasts`).
+_base_fields = [
+    ('cell'          , np.int64),
+    ('label'         , np.int64),
+    ('row'           , np.int64),
+    ('col'           , np.int64),
+    ('intensity_mean', np.float64),
+    ('intensity_min' , np.float64),
+    ('intensity_max' , np.float64),
+    ('area'          , np.float64),
+    ('perimeter'     , np.float64),
+    ('solidity'      , np.float64),
+    ('extent'        , np.float64),
+    ('intensity_sum' , np.int64),
+    ('category'      , np.int8),
+    # Sub-pixel localization (see `refine_ownership`). Equal to the integer location (and NaN for the fit) until refined.
+    ('y'             , np.float64),
+    ('x'             , np.float64),
+    ('fit_sigma'     , np.float64),
+    ('fit_r2'        , np.float64)
+]
+
+# Keys of the spots' dictionaries, in the order they had before the table existed.
+_dict_keys = ['intensity_mean', 'intensity_min', 'intensity_max', 'area', 'perimeter', 'solidity', 'extent', 'intensity_sum']
+
+
+def category_codes(names):
+    """
+    Converts categories' names (or None) to their codes.
+    """
+    lookup = {name: code for code, name in enumerate(categories)}
+    return np.array([lookup.get(n, 0) for n in names], dtype=np.int8)
+
+
+def category_names(codes):
+    """
+    Converts an array of categories' codes to an array of names (None for unclassified spots).
+    """
+    return np.array(categories, dtype=object)[codes]
+
+
+class SpotsTable(Mapping):
+    """
+    Spots of an image, as a structured array sorted by owning cell, with an index of the cells.
+    Measures (a detection's depth, a distance, ...) are stored as float columns, NaN meaning "not measured".
+    Reading it as a mapping gives the former ownership dictionary: {cell label: list of spots' dictionaries}.
+    """
+    def __init__(self, records, cells, measures=(), refined=False):
+        # Structured array with one record per spot, sorted by cell label.
+        self.records  = records
+        # Sorted labels of all the cells (including the cells without spots).
+        self.cells    = np.asarray(cells, dtype=np.int64)
+        # The spots of `cells[i]` are `records[offsets[i]:offsets[i+1]]`.
+        self.offsets  = np.searchsorted(records['cell'], self.cells, side='left')
+        self.offsets  = np.append(self.offsets, len(records)).astype(np.int64)
+        # Names of the per-spot measures columns.
+        self.measures = list(measures)
+        # Whether the sub-pixel localization was performed.
+        self.refined  = refined
+
+    @staticmethod
+    def dtype(measures=()):
+        return np.dtype(_base_fields + [(name, np.float64) for name in measures])
+
+    @classmethod
+    def from_rows(cls, rows, cells, measures=()):
+        """
+        Builds a table from a list of tuples, following the order of `dtype(measures)`. Missing values must be NaN.
+        Rows are sorted by cell label (the order of the spots in a cell is preserved).
+        """
+        records = np.array(rows, dtype=cls.dtype(measures)) if (len(rows) > 0) else np.zeros(0, dtype=cls.dtype(measures))
+        records = records[np.argsort(records['cell'], kind='stable')]
+        return cls(records, np.unique(cells), measures)
+
+    @classmethod
+    def from_dict(cls, ownership):
+        """
+        Builds a table from an ownership dictionary {cell label: list of spots' dictionaries}.
+        Missing values are NaN (0 in integer columns).
+        """
+        spots    = [(int(cell), s) for cell, spots_list in ownership.items() for s in spots_list]
+        refined  = any('y' in s for _, s in spots)
+        measures = []
+        for _, s in spots:
+            for key in s.keys():
+                if (key not in measures) and (key not in _dict_keys) and (key not in ('label', 'location', 'category', 'y', 'x', 'fit_sigma', 'fit_r2')):
+                    measures.append(key)
+
+        def as_float(value):
+            return np.nan if (value is None) else float(value)
+
+        rows = []
+        for cell, s in spots:
+            r, c = s.get('location', (0, 0))
+            rows.append(
+                (cell, s['label'], r, c) +
+                tuple(as_float(s.get(k)) for k in _dict_keys[:-1]) + (s.get('intensity_sum', 0),) +
+                (category_codes([s.get('category')])[0], as_float(s.get('y', r)), as_float(s.get('x', c)), as_float(s.get('fit_sigma')), as_float(s.get('fit_r2'))) +
+                tuple(as_float(s.get(m)) for m in measures)
+            )
+        table = cls.from_rows(rows, list(ownership.keys()), measures)
+        table.refined = refined
+        return table
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __iter__(self):
+        return iter(self.cells.tolist())
+
+    def __getitem__(self, cell):
+        i = np.searchsorted(self.cells, cell)
+        if (i >= len(self.cells)) or (self.cells[i] != cell):
+            raise KeyError(cell)
+        return self._as_dicts(self.records[self.offsets[i]:self.offsets[i+1]])
+
+    def _as_dicts(self, records):
+        columns = {name: records[name].tolist() for name in records.dtype.names}
+        names   = category_names(records['category']).tolist()
+        spots   = []
+        for i in range(len(records)):
+            spot = {
+                'label'   : columns['label'][i],
+                'location': (columns['row'][i], columns['col'][i])
+            }
+            for key in _dict_keys:
+                spot[key] = columns[key][i]
+            spot['category'] = names[i]
+            for name in self.measures:
+                value = columns[name][i]
+                spot[name] = None if np.isnan(value) else value
+            if self.refined:
+                for key in ('y', 'x', 'fit_sigma', 'fit_r2'):
+                    value = columns[key][i]
+                    spot[key] = None if np.isnan(value) else value
+            spots.append(spot)
+        return spots
+
+    def as_dict(self):
+        """
+        Converts the table to an ownership dictionary {cell label: list of spots' dictionaries}.
+        """
+        return {cell: self[cell] for cell in self}
+
+    @property
+    def n_spots(self):
+        return len(self.records)
+
+    def counts(self):
+        """
+        Number of spots owned by each cell (in the order of `cells`).
+        """
+        return np.diff(self.offsets)
+
+    def locations(self):
+        """
+        Integer (row, column) coordinates of the spots, as an array of shape (N, 2).
+        """
+        return np.stack([self.records['row'], self.records['col']], axis=1)
+
+    def per_cell(self, mask):
+        """
+        Counts, for each cell, its spots for which `mask` is True.
+        """
+        owner = np.searchsorted(self.cells, self.records['cell'])
+        return np.bincount(owner[mask], minlength=len(self.cells))
+
+
+def as_spots_table(ownership):
+    """
+    Returns `ownership` as a `SpotsTable`, converting it if it is an ownership dictionary.
+    """
+    if isinstance(ownership, SpotsTable):
+        return ownership
+    return SpotsTable.from_dict(ownership)
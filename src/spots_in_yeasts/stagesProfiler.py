@@ -0,0 +1,212 @@
+"""
+Instrumentation of the pipeline's stages.
+Each instrumented stage records its wall time, CPU time (of the calling thread) and peak of memory allocated (through `tracemalloc`).
+Stages can be nested: a record's `path` contains the names of its parents separated by '/'.
+When the profiler is disabled, `profiled` returns a shared no-op context manager, so the overhead is a function call.
+
+The peak of resident memory of the whole process (RSS, including what tracemalloc doesn't see) is given by `peak_rss`.
+"""
+
+from contextlib import contextmanager, nullcontext
+from termcolor import colored
+import threading, tracemalloc, time, json, sys
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+_noop = nullcontext()
+
+
+class StagesProfiler(object):
+
+    def __init__(self):
+        # Whether stages are currently recorded.
+        self.enabled = False
+        # Whether the memory is traced (tracemalloc slows down pure-Python loops).
+        self.memory  = True
+        # Records of the current image, in the order in which stages ended.
+        self.records = []
+        # Properties added to every record (name of the current image, ...).
+        self.context = {}
+        # JSON-lines file receiving every record (None to keep records in memory only).
+        self.sink    = None
+        # Stack of the stages currently running, per thread.
+        self.local   = threading.local()
+        # Protects `records` and `sink`.
+        self.lock    = threading.Lock()
+        # Whether tracemalloc was started by this profiler.
+        self.tracing = False
+
+    def start(self, path=None, memory=True):
+        """
+        Enables the profiler.
+
+        Args:
+            path: Path of a JSON-lines file receiving every record. Records are only kept in memory if None.
+            memory: Whether the peak of memory must be measured.
+        """
+        self.memory  = memory and hasattr(tracemalloc, 'reset_peak') # Per-stage peaks require Python >= 3.9
+        self.records = []
+        self.sink    = open(path, 'a') if (path is not None) else None
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        self.enabled = True
+
+    def stop(self):
+        """
+        Disables the profiler and closes its output file.
+        """
+        self.enabled = False
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+    def set_context(self, **kwargs):
+        self.context = kwargs
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = []
+            self.local.stack = stack
+        return stack
+
+    @contextmanager
+    def _step(self, name):
+        stack = self._stack()
+        frame = {'name': name, 'peak': 0}
+
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if len(stack) > 0:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['base'] = current
+
+        stack.append(frame)
+        w0 = time.perf_counter()
+        c0 = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - w0
+            cpu  = time.thread_time() - c0
+            stack.pop()
+            record = dict(self.context)
+            record.update({
+                'step': name,
+                'path': "/".join([f['name'] for f in stack] + [name]),
+                'wall': round(wall, 6),
+                'cpu' : round(cpu, 6)
+            })
+            if self.memory:
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                record['peak_mb'] = round((peak - frame['base']) / 2**20, 3)
+                if len(stack) > 0:
+                    stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            self._add(record)
+
+    def _add(self, record):
+        with self.lock:
+            self.records.append(record)
+            if self.sink is not None:
+                self.sink.write(json.dumps(record) + "\n")
+                self.sink.flush()
+
+    def step(self, name):
+        """
+        Context manager measuring the stage executed in its body.
+        """
+        if not self.enabled:
+            return _noop
+        return self._step(name)
+
+    def pop_records(self):
+        """
+        Returns the records accumulated since the last call and forgets them.
+        """
+        with self.lock:
+            records, self.records = self.records, []
+        return records
+
+
+_profiler = StagesProfiler()
+
+
+def get_profiler():
+    """
+    Returns the profiler shared by the whole pipeline.
+    """
+    return _profiler
+
+
+def profiled(name):
+    """
+    Context manager recording a stage in the shared profiler (no-op if it is disabled).
+
+    Example:
+        with profiled("filtering"):
+            LoG = gaussian_laplace(image, sigma)
+    """
+    if not _profiler.enabled:
+        return _noop
+    return _profiler._step(name)
+
+
+def write_summary(records, path):
+    """
+    Writes the records of an image in a JSON file, as well as the total time spent in each top-level stage.
+    """
+    top   = [r for r in records if '/' not in r['path']]
+    total = {
+        'wall': round(sum(r['wall'] for r in top), 6),
+        'cpu' : round(sum(r['cpu'] for r in top), 6)
+    }
+    peaks = [r['peak_mb'] for r in top if 'peak_mb' in r]
+    if len(peaks) > 0:
+        total['peak_mb'] = max(peaks)
+    try:
+        with open(path, 'w') as f:
+            json.dump({'total': total, 'stages': records}, f, indent=2)
+    except OSError as e:
+        print(colored(f"Failed to write the profile `{path}`. Reason: {e}", 'red'))
+
+
+def reset_peak_rss():
+    """
+    Resets the peak of resident memory of the process, so the next call to `peak_rss` only covers what follows.
+    Only possible on Linux: elsewhere, `peak_rss` keeps giving the peak since the start of the process.
+
+    Returns:
+        True if the peak was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss():
+    """
+    Returns:
+        The peak of resident memory of the process (in bytes) since its start or the last `reset_peak_rss`, or None if it can't be measured.
+    """
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if (sys.platform == 'darwin') else peak * 1024 # Bytes on macOS, kilobytes elsewhere.
@@ -0,0 +1,135 @@
+"""
+Per-image and per-batch summaries of the results, updated as each image of a batch finishes.
+The raw table (one row per spot or per cell, see `formatData`) is left untouched: summaries are written next to it, so analyses don't have to re-derive them.
+
+ - Per-image table: one row per image, appended as soon as the image is done.
+ - Per-batch table: a single row with the totals of the batch so far, rewritten after each image (so it is valid even if the batch is stopped).
+"""
+
+from spots_in_yeasts.formatData import CSVtable
+from spots_in_yeasts.spotsTable import as_spots_table, categories
+import numpy as np
+import os
+
+# Cells having this many spots or more are counted in the last bin of the spots-per-cell histogram.
+_max_spots_bin = 5
+
+# Categories of spots counted in the summaries, as given by `distance_spot_nuclei`.
+_categories = ['NUCLEAR', 'CYTOPLASMIC', 'PERIPHERAL']
+
+# Counts of cells provided by the pipeline's stages, summed over the batch.
+_stages_counts = ['cells-segmented', 'cells-dead-nuclei', 'cells-border', 'cells-dead-intensity']
+
+
+def count_labels(labels):
+    """
+    Counts the labels present in a labeled image (background excluded), in a single pass.
+    """
+    if labels.size == 0:
+        return 0
+    return int(np.count_nonzero(np.bincount(labels.ravel().astype(np.int64, copy=False))[1:]))
+
+
+def _histogram_titles():
+    return [f"cells-{i}-spots" for i in range(_max_spots_bin)] + [f"cells-{_max_spots_bin}+-spots"]
+
+
+def summary_titles():
+    return (
+        ['source'] +
+        _stages_counts +
+        ['cells', 'cells-with-spots', 'spots', 'spots-per-cell', 'spots-intensity-mean', 'spots-area-mean'] +
+        [f"spots-{c.lower()}" for c in _categories] +
+        _histogram_titles()
+    )
+
+
+def image_totals(ownership, counts=None):
+    """
+    Reduces the results of an image to a few sums, with vectorized operations over the columns of the spots' table.
+
+    Args:
+        ownership: A `SpotsTable` produced by `associate_spots_yeasts` (or an ownership dictionary {cell label: list of spots}).
+        counts: Counts of cells provided by the stages (see `_stages_counts`). Missing counts are left empty.
+
+    Returns:
+        A dictionary of sums, that can be added from one image to the next.
+    """
+    spots    = as_spots_table(ownership)
+    per_cell = spots.counts()
+    records  = spots.records
+
+    totals = {k: (counts or {}).get(k) for k in _stages_counts}
+    totals.update({
+        'cells'           : int(per_cell.size),
+        'cells-with-spots': int(np.count_nonzero(per_cell)),
+        'spots'           : int(per_cell.sum()),
+        'intensity-sum'   : float(records['intensity_mean'].sum()),
+        'area-sum'        : float(records['area'].sum()),
+        'histogram'       : np.bincount(np.minimum(per_cell, _max_spots_bin), minlength=_max_spots_bin+1)
+    })
+    for c in _categories:
+        totals[f"spots-{c.lower()}"] = int(np.count_nonzero(records['category'] == categories.index(c)))
+    return totals
+
+
+def add_totals(a, b):
+    """
+    Sums two dictionaries produced by `image_totals`. A count missing from one of them is missing from the sum.
+    """
+    total = {}
+    for key, value in a.items():
+        if (value is None) or (b.get(key) is None):
+            total[key] = None
+        else:
+            total[key] = value + b[key]
+    return total
+
+
+def _fill_row(table, source, totals):
+    table.newRow()
+    table.setValue('source', source)
+    for key in _stages_counts + ['cells', 'cells-with-spots', 'spots'] + [f"spots-{c.lower()}" for c in _categories]:
+        table.setValue(key, "" if (totals[key] is None) else totals[key])
+    n_cells, n_spots = totals['cells'], totals['spots']
+    table.setValue('spots-per-cell'      , round(n_spots / n_cells, 3) if (n_cells > 0) else "")
+    table.setValue('spots-intensity-mean', round(totals['intensity-sum'] / n_spots, 3) if (n_spots > 0) else "")
+    table.setValue('spots-area-mean'     , round(totals['area-sum'] / n_spots, 3) if (n_spots > 0) else "")
+    for title, count in zip(_histogram_titles(), totals['histogram'].tolist()):
+        table.setValue(title, count)
+
+
+class BatchSummary(object):
+    """
+    Accumulates the summaries of the images of a batch, and writes them as each image finishes.
+    """
+    def __init__(self, images_path, batch_path):
+        # CSV receiving one row per image.
+        self.images_path = images_path
+        # CSV containing the totals of the batch.
+        self.batch_path  = batch_path
+        # Table of the rows not written yet.
+        self.table       = CSVtable(summary_titles(), "")
+        # Sums over all the images added so far (None before the first one).
+        self.totals      = None
+        # Number of images added so far.
+        self.n_images    = 0
+
+    def add(self, ownership, source, counts=None):
+        """
+        Adds an image to the summaries, and updates both files.
+        """
+        totals = image_totals(ownership, counts)
+        _fill_row(self.table, source, totals)
+        self.table.appendTo(self.images_path)
+
+        self.totals    = totals if (self.totals is None) else add_totals(self.totals, totals)
+        self.n_images += 1
+
+        batch = CSVtable(['images'] + summary_titles()[1:], "")
+        _fill_row(batch, "", self.totals) # No 'source' column in this table.
+        batch.setValue('images', self.n_images)
+        # Written aside and then moved, so the file is never seen half-written.
+        temp_path = self.batch_path + ".tmp"
+        batch.exportTo(temp_path)
+        os.replace(temp_path, self.batch_path)
@@ -0,0 +1,162 @@
+"""
+Generator of synthetic yeast fields, used to test and benchmark the pipeline without real acquisitions.
+A field contains elliptical cells (some of them budding), their nuclei and Gaussian spots, imaged as a z-stack with a known focus slice.
+"""
+
+from scipy.ndimage import gaussian_filter, find_objects
+from skimage.draw import ellipse
+import numpy as np
+
+
+def _draw_cell(canvas, center, axes, angle, label):
+    """
+    Draws a filled ellipse in `canvas` if it doesn't overlap an existing cell.
+
+    Returns:
+        True if the cell was drawn.
+    """
+    rr, cc = ellipse(center[0], center[1], axes[0], axes[1], shape=canvas.shape, rotation=angle)
+    if (len(rr) == 0) or np.any(canvas[rr, cc] > 0):
+        return False
+    canvas[rr, cc] = label
+    return True
+
+
+def make_yeasts_field(
+        shape=(512, 512),
+        density=0.3,
+        cell_radius=18,
+        budding_ratio=0.3,
+        n_slices=9,
+        focus=None,
+        spots_per_cell=(0, 4),
+        spot_sigma=1.5,
+        nuclei=True,
+        seed=0):
+    """
+    Creates a synthetic multi-channel field of yeasts.
+
+    Args:
+        shape: (height, width) of the field.
+        density: Fraction of the field covered by cells (approximate, cells never overlap).
+        cell_radius: Average radius (in pixels) of a mother cell.
+        budding_ratio: Fraction of the cells having a bud attached to them.
+        n_slices: Number of slices of the z-stack (1 produces single slices).
+        focus: Index of the in-focus slice. Random if None.
+        spots_per_cell: (min, max) number of spots drawn in each cell.
+        spot_sigma: Standard deviation (in pixels) of the Gaussian spots.
+        nuclei: Whether a nuclei channel must be produced.
+        seed: Seed of the random generator, to produce reproducible fields.
+
+    Returns:
+        A dictionary containing:
+         - 'hyperstack': The image, with axes (Z, C, Y, X) (or (C, Y, X) for a single slice), channels being ordered as spots, brightfield, nuclei.
+         - 'labeled_cells': Ground-truth labels of cells (buds have their own label).
+         - 'labeled_nuclei': Ground-truth labels of nuclei (each nucleus has the label of the cell containing its center).
+         - 'buds': A list of (mother, bud) labels.
+         - 'spots': An array of (z, y, x) positions of spots.
+         - 'focus': The index of the in-focus slice.
+    """
+    rng    = np.random.default_rng(seed)
+    height, width = shape
+    focus  = int(rng.integers(0, n_slices)) if (focus is None) else int(focus)
+    cells  = np.zeros(shape, dtype=np.uint16)
+    nucl   = np.zeros(shape, dtype=np.uint16)
+    buds   = []
+    label  = 1
+
+    # >>> Placing cells until the requested density is reached.
+    target   = density * height * width
+    attempts = 0
+    while (np.count_nonzero(cells) < target) and (attempts < 50 * (target / (np.pi * cell_radius**2) + 1)):
+        attempts += 1
+        axes   = cell_radius * rng.uniform(0.8, 1.2, 2)
+        angle  = rng.uniform(-np.pi, np.pi)
+        center = (rng.uniform(0, height), rng.uniform(0, width))
+        if not _draw_cell(cells, center, axes, angle, label):
+            continue
+        mother = label
+        label += 1
+
+        # Nucleus of the mother
+        n_axes = 0.4 * axes
+        rr, cc = ellipse(center[0], center[1], n_axes[0], n_axes[1], shape=shape, rotation=angle)
+        nucl[rr, cc] = mother
+
+        # >>> Bud attached at the tip of the first axis of the mother (which points along (cos, sin) in (row, col) after rotation).
+        if rng.uniform() < budding_ratio:
+            b_axes   = axes * rng.uniform(0.45, 0.65)
+            distance = axes[0] + b_axes[0]
+            b_center = (center[0] + distance * np.cos(angle), center[1] + distance * np.sin(angle))
+            if _draw_cell(cells, b_center, b_axes, angle, label):
+                buds.append((mother, label))
+                # Dividing nucleus spanning the neck between the mother and its bud.
+                if rng.uniform() < 0.5:
+                    neck   = (center[0] + axes[0] * np.cos(angle), center[1] + axes[0] * np.sin(angle))
+                    rr, cc = ellipse(neck[0], neck[1], 0.5 * n_axes[0], 0.5 * n_axes[1], shape=shape, rotation=angle)
+                    nucl[rr, cc] = mother
+                label += 1
+
+    # Nuclei can't spread out of cells.
+    nucl[cells == 0] = 0
+
+    # >>> Spots: positions in 3D inside cells.
+    spots = []
+    for lbl, box in enumerate(find_objects(cells), start=1):
+        if box is None:
+            continue
+        ys, xs = np.nonzero(cells[box] == lbl)
+        n = int(rng.integers(spots_per_cell[0], spots_per_cell[1] + 1))
+        for i in rng.integers(0, len(ys), n):
+            spots.append((rng.uniform(0, n_slices - 1), ys[i] + box[0].start, xs[i] + box[1].start))
+    spots = np.array(spots, dtype=np.float64).reshape(-1, 3)
+
+    # >>> Rendering channels, slice per slice.
+    membranes = np.logical_xor(cells > 0, _eroded(cells))
+    bf_focus  = np.full(shape, 0.5)
+    bf_focus[cells > 0] = 0.65
+    bf_focus[membranes] = 0.15
+
+    fluo_base = np.zeros(shape)
+    fluo_base[cells > 0] = 0.05
+    s_coords  = (spots[:, 1].astype(int), spots[:, 2].astype(int))
+
+    nuclei_base = gaussian_filter((nucl > 0).astype(np.float64), 1.0)
+
+    channels = 3 if nuclei else 2
+    stack    = np.zeros((n_slices, channels) + shape, dtype=np.uint16)
+    for s in range(n_slices):
+        blur = 0.5 + 1.5 * abs(s - focus)
+        bf   = gaussian_filter(bf_focus, blur) + rng.normal(0, 0.01, shape)
+        peak = np.zeros(shape)
+        np.add.at(peak, s_coords, np.exp(-((s - spots[:, 0]) ** 2) / 2.0))
+        fl   = fluo_base + 2 * np.pi * spot_sigma**2 * gaussian_filter(peak, spot_sigma) + rng.normal(0, 0.01, shape)
+        stack[s, 0] = _to_uint16(fl, 0.5)
+        stack[s, 1] = _to_uint16(bf, 1.0)
+        if nuclei:
+            nu = gaussian_filter(nuclei_base, 0.5 + 0.5 * abs(s - focus)) + rng.normal(0, 0.01, shape)
+            stack[s, 2] = _to_uint16(nu, 1.0)
+
+    return {
+        'hyperstack'    : stack[0] if (n_slices == 1) else stack,
+        'labeled_cells' : cells,
+        'labeled_nuclei': nucl,
+        'buds'          : buds,
+        'spots'         : spots,
+        'focus'         : focus
+    }
+
+
+def _eroded(labels):
+    """
+    Mask of the pixels whose 4 neighbours have the same label (interior of the cells).
+    """
+    padded = np.pad(labels, 1, mode='edge')
+    same   = np.ones(labels.shape, dtype=bool)
+    for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+        same &= padded[1+dy:1+dy+labels.shape[0], 1+dx:1+dx+labels.shape[1]] == labels
+    return same & (labels > 0)
+
+
+def _to_uint16(image, top):
+    return (np.clip(image / top, 0.0, 1.0) * 30000 + 1000).astype(np.uint16)
@@ -0,0 +1,265 @@
+"""
+Distribution of the CPU cores between the stages of the pipeline.
+Without it, torch's intra-op threads (Cellpose), the BLAS/OpenMP/OpenCV threads (filters of the spots and nuclei stages) and the threads writing control folders all assume they own the machine, and oversubscribe it.
+
+A plan gives a number of threads to each kind of stage:
+ - 'cellpose': torch's intra-op threads, during the cells segmentation.
+ - 'filters': BLAS, OpenMP and OpenCV threads, during the spots and nuclei segmentation.
+ - 'writer': threads of the `ControlWriter`, compressing control folders in the background.
+
+Limits are only applied once a plan has been activated with `configure_threads` (batch mode or headless runs).
+
+Usage:
+    siy-tune-threads --size 2048 --images 3
+"""
+
+from contextlib import contextmanager, nullcontext
+from termcolor import colored
+from pathlib import Path
+import os, sys, json, time, argparse, functools
+
+try:
+    from threadpoolctl import threadpool_limits
+    _threadpoolctl_available = True
+except ImportError:
+    _threadpoolctl_available = False
+
+_noop = nullcontext()
+
+# Plan currently applied (None if limits are not applied).
+_active_plan = None
+
+# Variables limiting the threads of the libraries, set while a plan is active.
+_threads_variables = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+# Values of these variables before the plan was activated (None for an unset variable), restored when it is deactivated.
+_saved_variables = None
+
+# Location of the plan produced by the auto-tune command.
+default_plan_path = os.path.join(str(Path.home()), ".spots-in-yeasts", "threads-plan.json")
+
+
+def available_cores():
+    """
+    Returns:
+        The number of cores this process is allowed to run on.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def default_plan(n_cores=0, writer_threads=2):
+    """
+    Builds a plan from the number of cores: the writer threads get their own cores, and the computing stages share the remaining ones.
+
+    Args:
+        n_cores: Number of cores to use (0 for all the available ones).
+        writer_threads: Maximal number of threads writing control folders.
+
+    Returns:
+        A dictionary with the number of threads of each kind of stage.
+    """
+    n_cores = available_cores() if (n_cores <= 0) else n_cores
+    writer  = max(0, min(writer_threads, n_cores - 1))
+    compute = max(1, n_cores - writer)
+    return {'cores': n_cores, 'cellpose': compute, 'filters': compute, 'writer': writer}
+
+
+def load_plan(path=default_plan_path, n_cores=0):
+    """
+    Loads a plan produced by `tune`.
+
+    Returns:
+        The plan, or None if there is no plan for this number of cores.
+    """
+    n_cores = available_cores() if (n_cores <= 0) else n_cores
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            plan = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return plan if (plan.get('cores') == n_cores) else None
+
+
+def configure_threads(plan):
+    """
+    Activates a plan (or deactivates limits if None).
+    Environment variables are also set, so libraries loaded later and child processes follow the plan.
+    Deactivating the plan gives these variables back their previous values (or unsets them).
+    """
+    global _active_plan, _saved_variables
+    _active_plan = plan
+    if plan is None:
+        if _saved_variables is not None:
+            for var, value in _saved_variables.items():
+                if value is None:
+                    os.environ.pop(var, None)
+                else:
+                    os.environ[var] = value
+            _saved_variables = None
+        return
+    if _saved_variables is None: # Activating a plan over another one keeps the values from before the first.
+        _saved_variables = {var: os.environ.get(var) for var in _threads_variables}
+    for var in _threads_variables:
+        os.environ[var] = str(plan['filters'])
+    print(colored(f"Threads plan: {plan['cellpose']} for Cellpose, {plan['filters']} for filters, {plan['writer']} for writing ({plan['cores']} cores).", 'dark_grey'))
+
+
+def get_plan():
+    return _active_plan
+
+
+def _set_torch_threads(n):
+    torch = sys.modules.get('torch') # Cellpose already imported it, we don't want to import it otherwise.
+    if torch is None:
+        return None
+    previous = torch.get_num_threads()
+    torch.set_num_threads(n)
+    return previous
+
+
+def _set_cv2_threads(n):
+    cv2 = sys.modules.get('cv2')
+    if cv2 is None:
+        return None
+    previous = cv2.getNumThreads()
+    cv2.setNumThreads(n)
+    return previous
+
+
+@contextmanager
+def _limited(n):
+    torch_prev = _set_torch_threads(n)
+    cv2_prev   = _set_cv2_threads(n)
+    blas       = threadpool_limits(limits=n) if _threadpoolctl_available else _noop
+    try:
+        with blas:
+            yield
+    finally:
+        if torch_prev is not None:
+            _set_torch_threads(torch_prev)
+        if cv2_prev is not None:
+            _set_cv2_threads(cv2_prev)
+
+
+def threads_for(stage):
+    """
+    Context manager limiting the number of threads used by the libraries during a stage ('cellpose' or 'filters').
+    It is a no-op if no plan is active.
+    """
+    if (_active_plan is None) or (stage not in _active_plan):
+        return _noop
+    return _limited(_active_plan[stage])
+
+
+def scheduled(stage):
+    """
+    Decorator running a function under the threads limits of `stage`.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with threads_for(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def candidate_plans(n_cores):
+    """
+    Plans evaluated by `tune`: a few writer counts, and the computing stages using either all the remaining cores or half of them.
+    """
+    plans = []
+    for writer in sorted({0, 1, 2, 4}):
+        if writer >= n_cores:
+            continue
+        rest = n_cores - writer
+        for compute in sorted({rest, max(1, rest // 2)}, reverse=True):
+            plans.append({'cores': n_cores, 'cellpose': compute, 'filters': compute, 'writer': writer})
+    return plans
+
+
+def _run_images(fields, plan, backend, folder):
+    """
+    Processes synthetic fields as the batch mode does (cells, spots, control folder) under a plan, and returns the wall time.
+    """
+    from spots_in_yeasts.spotsInYeasts import segment_transmission, segment_spots, create_reference_to, write_labels_image
+    from spots_in_yeasts.controlWriter import ControlWriter
+
+    configure_threads(plan)
+    writer = ControlWriter(plan['writer'])
+    start  = time.perf_counter()
+    for i, field in enumerate(fields):
+        stack = field['hyperstack']
+        labeled, projection = segment_transmission(stack[:, 1], False, 2, backend)
+        locations, labeled_spots, flat_spots = segment_spots(stack[:, 0], labeled, 65535, 3.0, 5, 0.5)
+        indices = write_labels_image(labeled, 0.75)
+        control = os.path.join(folder, f"field-{i}.ysc")
+        os.makedirs(control, exist_ok=True)
+        create_reference_to(labeled, labeled_spots, locations, f"field-{i}", control, "synthetic", projection, flat_spots, indices, None, None, None, writer)
+    writer.close()
+    return time.perf_counter() - start
+
+
+def tune(size=2048, n_images=3, n_cores=0, backend='cellpose', verbose=False):
+    """
+    Processes a few synthetic fields under each candidate plan, and returns the fastest one.
+
+    Args:
+        size: Side (in pixels) of the synthetic fields, as close as possible to the real images.
+        n_images: Number of fields processed per plan.
+        n_cores: Number of cores to distribute (0 for all the available ones).
+        backend: Cells segmentation backend used by the batch.
+        verbose: If False, what the stages print is discarded.
+
+    Returns:
+        The best plan, with the time per image it achieved.
+    """
+    from spots_in_yeasts.syntheticData import make_yeasts_field
+    import tempfile, io, contextlib
+
+    n_cores = available_cores() if (n_cores <= 0) else n_cores
+    fields  = [make_yeasts_field((size, size), cell_radius=18*size/512, seed=i) for i in range(n_images)]
+    plans   = candidate_plans(n_cores)
+    best    = None
+
+    # Warm-up (caches, lazy imports, model loading), so the first plan is not penalized.
+    with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(io.StringIO()):
+        _run_images(fields[:1], plans[0], backend, folder)
+
+    for plan in plans:
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        with tempfile.TemporaryDirectory() as folder, output:
+            elapsed = _run_images(fields, plan, backend, folder)
+        per_image = elapsed / n_images
+        print(f"  cellpose={plan['cellpose']:<3} filters={plan['filters']:<3} writer={plan['writer']:<3} {per_image:8.3f}s/image")
+        if (best is None) or (per_image < best['seconds_per_image']):
+            best = dict(plan, seconds_per_image=round(per_image, 4), size=size, backend=backend)
+
+    configure_threads(None)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Finds the best distribution of the CPU cores between the stages of the pipeline.")
+    parser.add_argument('--size', type=int, default=2048, help="Side (in pixels) of the synthetic images.")
+    parser.add_argument('--images', type=int, default=3, help="Number of images processed per candidate plan.")
+    parser.add_argument('--cores', type=int, default=0, help="Number of cores to distribute (0: all the available ones).")
+    parser.add_argument('--backend', default='cellpose', help="Cells segmentation backend ('cellpose' or 'classical').")
+    parser.add_argument('--verbose', action='store_true', help="Show what the stages print.")
+    parser.add_argument('--output', default=default_plan_path, help="Path of the JSON file receiving the best plan.")
+    args = parser.parse_args(argv)
+
+    best = tune(args.size, args.images, args.cores, args.backend, args.verbose)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(best, f, indent=2)
+    print(colored(f"Best plan saved to: {args.output}", 'green'))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
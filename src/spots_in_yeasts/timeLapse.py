@@ -0,0 +1,289 @@
+"""
+Time-lapses and multi-position hyperstacks.
+Such files are never loaded at once: each (position, frame) is read on its own as a (Z, C, Y, X) or (C, Y, X) hyperstack, so the memory used only depends on the size of a frame.
+Cells keep the same label from one frame to the next as long as they overlap (see `link_labels`).
+
+Positions are either the series of the file (OME-TIFF) or an 'R' (Micro-Manager) or 'M' (mosaic) axis.
+Consecutive brightfield frames are often nearly identical, so the cells segmentation can be reused instead of running Cellpose again (see `IncrementalCells`).
+"""
+
+from tifffile import TiffFile
+from skimage.registration import phase_cross_correlation
+import numpy as np
+import os
+
+# Axes holding positions, in the axes naming of tifffile.
+_position_axes = {'R', 'M'}
+
+
+def frames_layout(path):
+    """
+    Describes how the frames of a time-lapse or multi-position file are stored.
+
+    Args:
+        path: Path of a TIFF file.
+
+    Returns:
+        A dictionary with the number of 'positions' and 'frames', or None if the file is a plain (C, Y, X) or (Z, C, Y, X) hyperstack.
+    """
+    with TiffFile(path) as tif:
+        series = tif.series
+        axes   = series[0].axes
+        shape  = series[0].shape
+
+        # Pages holding samples (RGB) are not streamed.
+        if (not axes.endswith('YX')) or ('S' in axes):
+            return None
+
+        per_series = (len(series) > 1) and all((s.axes == axes) and (s.shape == shape) for s in series)
+        positions  = len(series) if per_series else 1
+        frames     = 1
+        for ax, length in zip(axes, shape):
+            if ax == 'T':
+                frames = length
+            elif (ax in _position_axes) and not per_series:
+                positions = length
+
+    if (positions == 1) and ('T' not in axes):
+        return None
+
+    return {'positions': positions, 'frames': frames, 'per_series': per_series}
+
+
+def list_frames(path):
+    """
+    Lists the items of a file, in the order they should be processed: frames of the first position, then frames of the second one, ...
+
+    Returns:
+        A list of (path, position, frame) tuples. For a plain hyperstack: [(path, None, None)].
+    """
+    layout = frames_layout(path)
+    if layout is None:
+        return [(path, None, None)]
+    return [(path, p, t) for p in range(layout['positions']) for t in range(layout['frames'])]
+
+
+def frame_name(path, position, frame):
+    """
+    Name given to the results of a frame (the name of the file for plain hyperstacks).
+    """
+    name = os.path.basename(path).split('.')[0]
+    if frame is None:
+        return name
+    return f"{name}-p{position}-t{frame}"
+
+
+def read_frame(path, position, frame):
+    """
+    Reads a single frame of a time-lapse or multi-position file, without loading the other ones.
+
+    Args:
+        path: Path of the TIFF file.
+        position: Index of the position.
+        frame: Index of the time point.
+
+    Returns:
+        The frame as a (Z, C, Y, X) or (C, Y, X) array, ready for the channels splitting.
+    """
+    layout = frames_layout(path)
+    if layout is None:
+        raise ValueError(f"{path} is not a time-lapse nor a multi-position file.")
+
+    with TiffFile(path) as tif:
+        s_index = position if layout['per_series'] else 0
+        series  = tif.series[s_index]
+        axes    = series.axes[:-2] # Axes spread over pages.
+
+        # Index of every page of the series, arranged along its axes.
+        pages   = np.arange(int(np.prod(series.shape[:-2], dtype=np.int64))).reshape(series.shape[:-2])
+        slicer  = []
+        kept    = ""
+        for ax in axes:
+            if ax == 'T':
+                slicer.append(frame)
+            elif (ax in _position_axes) and not layout['per_series']:
+                slicer.append(position)
+            else:
+                slicer.append(slice(None))
+                kept += ax
+        keys = pages[tuple(slicer)]
+
+        data = tif.asarray(key=keys.ravel().tolist(), series=s_index)
+        data = data.reshape(keys.shape + series.shape[-2:])
+
+    # The pipeline expects slices before channels.
+    if ('Z' in kept) and ('C' in kept) and (kept.index('Z') > kept.index('C')):
+        data = np.swapaxes(data, kept.index('Z'), kept.index('C'))
+    return data
+
+
+def link_labels(previous, current, next_label, min_overlap=0.5):
+    """
+    Gives to the cells of a frame the labels of the cells they overlap in the previous frame.
+    Pairs are matched one-to-one, largest overlaps first. A cell is linked only if at least `min_overlap` of its area lies on its match.
+    Other cells get new labels, starting from `next_label`.
+
+    Args:
+        previous: Labeled cells of the previous frame (None for the first frame).
+        current: Labeled cells of the current frame.
+        next_label: First label that was never used in this position.
+        min_overlap: Minimal fraction of a cell covered by its match in the previous frame.
+
+    Returns:
+        The relabeled cells (int32), and the new value of `next_label`.
+    """
+    cur    = current.ravel().astype(np.int64)
+    n_c    = int(cur.max()) + 1
+    lut    = np.zeros(n_c, dtype=np.int64)
+    area_c = np.bincount(cur, minlength=n_c)
+
+    if previous is not None:
+        prev  = previous.ravel().astype(np.int64)
+        n_p   = int(prev.max()) + 1
+        both  = (cur > 0) & (prev > 0)
+        keys, inter = np.unique(cur[both] * n_p + prev[both], return_counts=True)
+        c_lbl = keys // n_p
+        p_lbl = keys % n_p
+        good  = inter >= min_overlap * area_c[c_lbl]
+        order = np.argsort(-inter[good], kind="stable")
+        taken = set()
+        for c, p in zip(c_lbl[good][order].tolist(), p_lbl[good][order].tolist()):
+            if (lut[c] == 0) and (p not in taken):
+                lut[c] = p
+                taken.add(p)
+
+    present = np.flatnonzero(area_c)
+    present = present[present > 0]
+    fresh   = present[lut[present] == 0]
+    lut[fresh] = np.arange(next_label, next_label + len(fresh))
+
+    return lut[current].astype(np.int32), next_label + len(fresh)
+
+
+def follow_labels(before, after, image):
+    """
+    Applies to `image` the relabeling that turned `before` into `after`, so labels matching the cells' ones (ex: nuclei labeled as their owner cell) follow them.
+    Labels of `image` that are not in `before` become 0.
+
+    Args:
+        before: Labeled cells before `link_labels`.
+        after: The same cells, as returned by `link_labels`.
+        image: Labeled image to update.
+
+    Returns:
+        The relabeled image (int32).
+    """
+    lut = np.zeros(max(int(before.max()), int(image.max())) + 1, dtype=np.int32)
+    lut[before] = after
+    return lut[image]
+
+
+def _thumbnail(image, side=256):
+    """
+    Downscales (by averaging blocks) and normalizes an image, so two frames can be compared cheaply.
+
+    Returns:
+        The thumbnail, and the downscaling factor.
+    """
+    factor = max(1, int(np.ceil(max(image.shape) / side)))
+    h, w   = (image.shape[0] // factor) * factor, (image.shape[1] // factor) * factor
+    small  = image[:h, :w].astype(np.float32).reshape(h // factor, factor, w // factor, factor).mean(axis=(1, 3))
+    small -= small.mean()
+    std    = small.std()
+    return (small / std if std > 0 else small), factor
+
+
+def _overlap(shape, dy, dx):
+    # Slices of an image and of its version translated by (dy, dx) covering the same area.
+    h, w = shape
+    src  = (slice(max(-dy, 0), h - max(dy, 0)), slice(max(-dx, 0), w - max(dx, 0)))
+    dst  = (slice(max(dy, 0), h - max(-dy, 0)), slice(max(dx, 0), w - max(-dx, 0)))
+    return src, dst
+
+
+def frame_change(previous, current, side=256):
+    """
+    Measures how much the brightfield changed between two frames, on downscaled versions of them.
+
+    Args:
+        previous: Projection of the brightfield of the previous frame.
+        current: Projection of the brightfield of the current frame.
+        side: Side of the thumbnails on which the frames are compared.
+
+    Returns:
+        The translation (dy, dx) moving `previous` onto `current` (in pixels), and the residual: RMS difference of the overlapping areas once registered (in standard deviations).
+    """
+    a, factor = _thumbnail(previous, side)
+    b, _      = _thumbnail(current, side)
+    shift, _, _ = phase_cross_correlation(a, b, upsample_factor=factor)
+    dy, dx   = -int(round(shift[0] * factor)), -int(round(shift[1] * factor))
+    src, dst = _overlap(previous.shape, dy, dx)
+    a, _     = _thumbnail(previous[src], side)
+    b, _     = _thumbnail(current[dst], side)
+    residual = float(np.sqrt(np.mean((a - b)**2)))
+    return (dy, dx), residual
+
+
+def shift_labels(labels, dy, dx):
+    """
+    Translates a labeled image by an integer number of pixels. Uncovered areas are background.
+    """
+    shifted  = np.zeros_like(labels)
+    src, dst = _overlap(labels.shape, dy, dx)
+    shifted[dst] = labels[src]
+    return shifted
+
+
+class IncrementalCells(object):
+    """
+    Decides, frame after frame, whether the cells segmented on a previous frame can be reused.
+    Frames are compared to the last frame actually segmented (and not to the previous one), so slow drifts end up triggering a new segmentation.
+    Its labels are translated by the registration shift when they are reused.
+    """
+    def __init__(self, threshold=0.2, side=256):
+        # Maximal residual (see `frame_change`) for the labels to be reused.
+        self.threshold = threshold
+        # Side of the thumbnails compared.
+        self.side      = side
+        # Position whose frames are being processed (labels are never reused across positions).
+        self.position  = None
+        # Projection and labels of the last frame actually segmented.
+        self.reference = None
+        self.labels    = None
+        # (shift, residual) of the last comparison.
+        self.last      = None
+        # Number of frames on which labels were reused, and on which the segmentation ran.
+        self.reused    = 0
+        self.segmented = 0
+
+    def start(self, position):
+        """
+        Called before each frame: forgets the reference if the position changed.
+        """
+        if position != self.position:
+            self.position  = position
+            self.reference = None
+            self.labels    = None
+
+    def reuse(self, projection):
+        """
+        Returns:
+            The labels of the reference frame moved onto `projection`, or None if the frame changed too much (or there is no reference).
+        """
+        self.last = None
+        if (self.reference is None) or (self.reference.shape != projection.shape):
+            return None
+        (dy, dx), residual = frame_change(self.reference, projection, self.side)
+        self.last = ((dy, dx), residual)
+        if residual > self.threshold:
+            return None
+        self.reused += 1
+        return shift_labels(self.labels, dy, dx)
+
+    def update(self, projection, labels):
+        """
+        Makes of a frame that was just segmented the new reference.
+        """
+        self.reference = np.copy(projection)
+        self.labels    = np.copy(labels)
+        self.segmented += 1